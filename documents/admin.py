@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import GoodsReceiptNote, GoodsDispatchNote
+from .models import GoodsReceiptNote, GoodsDispatchNote, PdfJob, DocumentCounter
 
 
 
@@ -14,5 +14,17 @@ class GoodsDispatchNoteAdmin(admin.ModelAdmin):
     ordering = ['-gdn']
 
 
+class PdfJobAdmin(admin.ModelAdmin):
+    list_display = ['created_time', 'goods_receipt_note', 'goods_dispatch_note', 'status']
+    ordering = ['-created_time']
+
+
+class DocumentCounterAdmin(admin.ModelAdmin):
+    list_display = ['document_type', 'year', 'last_number']
+    ordering = ['document_type', '-year']
+
+
 admin.site.register(GoodsReceiptNote, GoodsReceiptNoteAdmin)
-admin.site.register(GoodsDispatchNote, GoodsDispatchNoteAdmin)
\ No newline at end of file
+admin.site.register(GoodsDispatchNote, GoodsDispatchNoteAdmin)
+admin.site.register(PdfJob, PdfJobAdmin)
+admin.site.register(DocumentCounter, DocumentCounterAdmin)
\ No newline at end of file
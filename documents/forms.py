@@ -1,11 +1,14 @@
 from django import forms
-from django.forms import inlineformset_factory
+from django.forms import inlineformset_factory, BaseInlineFormSet
+from django.utils import timezone
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Fieldset, Div, HTML, ButtonHolder, Submit, Row, Column
 from .custom_layout_objects import TransactionFormset
 
 from .models import GoodsReceiptNote, GoodsDispatchNote
+from partners.models import Vendor, Customer
 from inventories.models import Transaction
+from inventories.bulk import ledger_values, transactions_changed
 
 
 
@@ -115,8 +118,55 @@ class GoodsDispatchNoteTransactionsForm(forms.ModelForm):
         }
 
 
+class BaseGoodsMovementTransactionFormSet(BaseInlineFormSet):
+
+    def bulk_save(self, transaction_type):
+        """
+        Saves the transactions of the note with one bulk insert and one bulk update, their type set
+        before they are written. Bulk writes send no signals, so the ledger, snapshots and reports
+        are updated by transactions_changed(). Call it in the transaction saving the note.
+        """
+        self.new_objects, self.changed_objects, self.deleted_objects = [], [], []
+        previous = []
+        for form in self.initial_forms:
+            obj = form.instance
+            if obj.pk is None:
+                continue
+            if self.can_delete and self._should_delete_form(form):
+                self.deleted_objects.append(obj)
+            elif form.has_changed():
+                previous.append(dict(obj._loaded_values))
+                self.changed_objects.append((form.save(commit=False), form.changed_data))
+        for form in self.extra_forms:
+            if not form.has_changed() or (self.can_delete and self._should_delete_form(form)):
+                continue
+            obj = form.save(commit=False)
+            setattr(obj, self.fk.name, self.instance)
+            self.new_objects.append(obj)
+
+        # deletions are rare, their signals keep the derived data up to date
+        if self.deleted_objects:
+            Transaction.objects.filter(pk__in=[obj.pk for obj in self.deleted_objects]).delete()
+
+        now = timezone.now()
+        changed = [obj for obj, _ in self.changed_objects]
+        for obj in changed + self.new_objects:
+            obj.transaction_type = transaction_type
+            obj.last_modified = now
+        fields = list(self.form._meta.fields) + ['transaction_type', 'last_modified']
+        Transaction.objects.bulk_update(changed, fields)
+        Transaction.objects.bulk_create(self.new_objects)
+
+        current = [ledger_values(obj) for obj in changed + self.new_objects]
+        transactions_changed(previous, current)
+        for obj, values in zip(changed + self.new_objects, current):
+            obj._loaded_values = values
+        return changed + self.new_objects
+
+
 GoodsReceiptTransactionFormSet = inlineformset_factory(GoodsReceiptNote, Transaction, 
     form=GoodsReceiptNoteTransactionsForm,
+    formset=BaseGoodsMovementTransactionFormSet,
     extra=0,
     min_num=1, 
     validate_min=True
@@ -125,7 +175,53 @@ GoodsReceiptTransactionFormSet = inlineformset_factory(GoodsReceiptNote, Transac
 
 GoodsDispatchTransactionFormSet = inlineformset_factory(GoodsDispatchNote, Transaction, 
     form=GoodsDispatchNoteTransactionsForm,
+    formset=BaseGoodsMovementTransactionFormSet,
     extra=0,
     min_num=1, 
     validate_min=True
-)
\ No newline at end of file
+)
+
+
+class GoodsMovementNoteFilterForm(forms.Form):
+    PRINTED_CHOICES = [
+        ('', 'All'),
+        ('yes', 'Printed'),
+        ('no', 'Not printed'),
+    ]
+    # set by subclasses
+    partner_field = None
+    partner_model = None
+
+    date_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}, format=('%Y-%m-%d')))
+    date_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}, format=('%Y-%m-%d')))
+    partner = forms.ModelChoiceField(queryset=None, required=False)
+    printed = forms.ChoiceField(choices=PRINTED_CHOICES, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(GoodsMovementNoteFilterForm, self).__init__(*args, **kwargs)
+        self.fields['partner'].queryset = self.partner_model.objects.order_by('name')
+        self.fields['partner'].label = self.partner_field.capitalize()
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-select' if isinstance(field.widget, forms.Select) else 'form-control'
+
+    def filter_queryset(self, queryset):
+        data = self.cleaned_data
+        if data['date_from'] is not None:
+            queryset = queryset.filter(date__gte=data['date_from'])
+        if data['date_to'] is not None:
+            queryset = queryset.filter(date__lte=data['date_to'])
+        if data['partner'] is not None:
+            queryset = queryset.filter(**{self.partner_field: data['partner']})
+        if data['printed']:
+            queryset = queryset.filter(print_date__isnull=data['printed'] == 'no')
+        return queryset
+
+
+class GoodsReceiptNoteFilterForm(GoodsMovementNoteFilterForm):
+    partner_field = 'vendor'
+    partner_model = Vendor
+
+
+class GoodsDispatchNoteFilterForm(GoodsMovementNoteFilterForm):
+    partner_field = 'customer'
+    partner_model = Customer
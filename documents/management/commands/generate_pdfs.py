@@ -0,0 +1,111 @@
+import datetime
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Q
+
+from documents.models import GoodsReceiptNote, GoodsDispatchNote, PdfJob
+
+
+
+def init_worker():
+    # spawned processes start without Django, forked ones open their own connections
+    django.setup()
+
+
+def run_job(job_id):
+    """ Runs a PDF job in a worker process, returns (job_id, status). """
+    try:
+        PdfJob.run(job_id)
+        return job_id, PdfJob.objects.values_list('status', flat=True).get(pk=job_id)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates the missing (and optionally the stale) PDFs of goods receipt and dispatch notes across '
+        'a process pool. Documents having an up to date PDF are skipped, so an interrupted run can simply be restarted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date-from', type=datetime.date.fromisoformat,
+            help='Only documents dated on or after this date (YYYY-MM-DD).'
+        )
+        parser.add_argument(
+            '--date-to', type=datetime.date.fromisoformat,
+            help='Only documents dated on or before this date (YYYY-MM-DD).'
+        )
+        parser.add_argument(
+            '--include-stale', action='store_true',
+            help='Also render the PDFs whose data has changed since they were rendered.'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes, 0 renders in this process (default: number of CPUs).'
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] is None or options['workers'] < 0:
+            raise CommandError('Invalid number of workers.')
+
+        # stale pdfs are found by PdfJob.enqueue, comparing content hashes
+        q_filter = Q() if options['include_stale'] else Q(pdf='') | Q(pdf__isnull=True)
+        if options['date_from'] is not None:
+            q_filter &= Q(date__gte=options['date_from'])
+        if options['date_to'] is not None:
+            q_filter &= Q(date__lte=options['date_to'])
+
+        # jobs left running by a killed run are queued again below
+        orphaned = PdfJob.fail_orphaned()
+        if orphaned:
+            self.stdout.write(f'{orphaned} job(s) of exited processes failed, queuing them again.')
+
+        # queue a job for every document, documents with a job running elsewhere are left to it
+        job_ids, busy = [], 0
+        for model in (GoodsReceiptNote, GoodsDispatchNote):
+            for doc in model.objects.filter(q_filter).order_by('date'):
+                with transaction.atomic():
+                    job = PdfJob.enqueue(doc, submit=False)
+                if job is None:
+                    continue
+                if job.status == PdfJob.STATUS_QUEUED:
+                    job_ids.append(job.id)
+                else:
+                    busy += 1
+        self.stdout.write(f'{len(job_ids)} document(s) to render, {busy} in progress elsewhere.')
+
+        started = time.monotonic()
+        counts = {PdfJob.STATUS_DONE: 0, PdfJob.STATUS_FAILED: 0}
+        for job_id, status in self.run_jobs(job_ids, options['workers']):
+            if status in counts:
+                counts[status] += 1
+            finished = sum(counts.values())
+            if finished and finished % 100 == 0:
+                self.stdout.write(f'{finished} of {len(job_ids)} document(s) finished.')
+        elapsed = time.monotonic() - started
+
+        rate = counts[PdfJob.STATUS_DONE] / elapsed if elapsed > 0 else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{counts[PdfJob.STATUS_DONE]} PDF(s) generated in {elapsed:.1f} s ({rate:.1f} documents/s), '
+            f'{counts[PdfJob.STATUS_FAILED]} failed.'
+        ))
+
+    def run_jobs(self, job_ids, workers):
+        if workers == 0:
+            for job_id in job_ids:
+                PdfJob.run(job_id)
+                yield job_id, PdfJob.objects.values_list('status', flat=True).get(pk=job_id)
+            return
+        # forked workers must not share the connection of this process
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = [executor.submit(run_job, job_id) for job_id in job_ids]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.4 on 2026-10-19 00:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_auto_20210804_1208'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=7)),
+                ('error', models.TextField(blank=True)),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('started_time', models.DateTimeField(blank=True, null=True)),
+                ('finished_time', models.DateTimeField(blank=True, null=True)),
+                ('goods_dispatch_note', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='pdf_jobs', to='documents.goodsdispatchnote')),
+                ('goods_receipt_note', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='pdf_jobs', to='documents.goodsreceiptnote')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pdfjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'failed'), _negated=True), fields=('goods_receipt_note',), name='unique_goods_receipt_note_pdf_job'),
+        ),
+        migrations.AddConstraint(
+            model_name='pdfjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'failed'), _negated=True), fields=('goods_dispatch_note',), name='unique_goods_dispatch_note_pdf_job'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 3.2.4 on 2026-10-19 01:10
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+# copies of documents.models.PDF_TRANSACTION_FIELDS and pdf_content_hash as of this migration
+PDF_TRANSACTION_FIELDS = ('id', 'created_time', 'material__name', 'gross_weight', 'tare_weight', 'unit_price', 'notes')
+
+
+def pdf_content_hash(number, date, notes, partner_name, transactions):
+    rows = []
+    total_net_value = 0
+    for id, created_time, material_name, gross_weight, tare_weight, unit_price, transaction_notes in sorted(transactions):
+        net_weight = gross_weight - tare_weight
+        net_value = round(net_weight * unit_price, 2)
+        total_net_value += net_value
+        rows.append([
+            str(id), created_time.isoformat(), material_name, str(gross_weight), str(tare_weight),
+            str(net_weight), str(unit_price), str(net_value), transaction_notes
+        ])
+    content = [number, date.isoformat(), notes, partner_name, rows, str(total_net_value)]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+def hash_existing_pdfs(apps, schema_editor):
+    # pdfs printed so far are taken as up to date
+    for model_name, number, partner in (('GoodsReceiptNote', 'grn', 'vendor'), ('GoodsDispatchNote', 'gdn', 'customer')):
+        model = apps.get_model('documents', model_name)
+        for doc in model.objects.exclude(pdf='').exclude(pdf__isnull=True).select_related(partner):
+            partner_obj = getattr(doc, partner)
+            doc.pdf_hash = pdf_content_hash(
+                getattr(doc, number), doc.date, doc.notes, partner_obj.name if partner_obj else None,
+                doc.transactions.values_list(*PDF_TRANSACTION_FIELDS)
+            )
+            doc.save(update_fields=['pdf_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0007_pdfjob'),
+        ('inventories', '0006_transaction_goods_dispatch_note'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='pdfjob',
+            name='unique_goods_receipt_note_pdf_job',
+        ),
+        migrations.RemoveConstraint(
+            model_name='pdfjob',
+            name='unique_goods_dispatch_note_pdf_job',
+        ),
+        migrations.AddField(
+            model_name='goodsdispatchnote',
+            name='pdf_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='goodsreceiptnote',
+            name='pdf_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='pdfjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running'])), fields=('goods_receipt_note',), name='unique_goods_receipt_note_pdf_job'),
+        ),
+        migrations.AddConstraint(
+            model_name='pdfjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['queued', 'running'])), fields=('goods_dispatch_note',), name='unique_goods_dispatch_note_pdf_job'),
+        ),
+        migrations.RunPython(hash_existing_pdfs, migrations.RunPython.noop),
+    ]
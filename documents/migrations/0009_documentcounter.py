@@ -0,0 +1,50 @@
+# Generated by Django 3.2.4 on 2026-10-19 09:12
+
+from django.db import migrations, models
+from django.db.models import IntegerField, Max
+from django.db.models.functions import Cast, Substr
+import uuid
+
+
+def seed_counters(apps, schema_editor):
+    # counters continue from the numbers issued so far (format: GRNyyyy/xxxxxx)
+    DocumentCounter = apps.get_model('documents', 'DocumentCounter')
+    for model_name, field, document_type in (
+        ('GoodsReceiptNote', 'grn', 'GRN'),
+        ('GoodsDispatchNote', 'gdn', 'GDN'),
+    ):
+        model = apps.get_model('documents', model_name)
+        last_numbers = (
+            model.objects
+            .filter(**{f'{field}__regex': rf'^{document_type}[0-9]{{4}}/[0-9]{{6}}$'})
+            .values(year=Cast(Substr(field, 4, 4), IntegerField()))
+            .annotate(last_number=Max(Cast(Substr(field, 9, 6), IntegerField())))
+        )
+        DocumentCounter.objects.bulk_create([
+            DocumentCounter(document_type=document_type, year=row['year'], last_number=row['last_number'])
+            for row in last_numbers
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_pdf_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentCounter',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('document_type', models.CharField(max_length=3)),
+                ('year', models.PositiveSmallIntegerField()),
+                ('last_number', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='documentcounter',
+            constraint=models.UniqueConstraint(fields=('document_type', 'year'), name='unique_document_counter'),
+        ),
+        migrations.RunPython(seed_counters, migrations.RunPython.noop),
+    ]
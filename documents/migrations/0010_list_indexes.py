@@ -0,0 +1,45 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_documentcounter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='goodsdispatchnote',
+            index=models.Index(fields=['gdn'], name='gdn_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsdispatchnote',
+            index=models.Index(fields=['date'], name='gdn_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsdispatchnote',
+            index=models.Index(fields=['customer', 'gdn'], name='gdn_customer_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsdispatchnote',
+            index=models.Index(condition=models.Q(('print_date__isnull', True)), fields=['gdn'], name='gdn_unprinted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsreceiptnote',
+            index=models.Index(fields=['grn'], name='grn_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsreceiptnote',
+            index=models.Index(fields=['date'], name='grn_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsreceiptnote',
+            index=models.Index(fields=['vendor', 'grn'], name='grn_vendor_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='goodsreceiptnote',
+            index=models.Index(condition=models.Q(('print_date__isnull', True)), fields=['grn'], name='grn_unprinted_idx'),
+        ),
+    ]
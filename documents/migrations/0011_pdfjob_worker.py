@@ -0,0 +1,18 @@
+# Generated by Django 3.2.4 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0010_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pdfjob',
+            name='worker',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.4 on 2026-10-19 12:30
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_numbers(apps, schema_editor):
+    # numbers given twice by the numbering used before the counters have to be resolved by hand
+    duplicates = []
+    for model_name, field in (('GoodsReceiptNote', 'grn'), ('GoodsDispatchNote', 'gdn')):
+        model = apps.get_model('documents', model_name)
+        duplicates += model.objects.exclude(**{field: ''})\
+            .values(field)\
+            .annotate(count=Count('id'))\
+            .filter(count__gt=1)\
+            .order_by(field)\
+            .values_list(field, flat=True)
+    if duplicates:
+        raise RuntimeError(f'Documents sharing a number, renumber them before migrating: {", ".join(duplicates)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0011_pdfjob_worker'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_numbers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='goodsdispatchnote',
+            constraint=models.UniqueConstraint(condition=models.Q(('gdn', ''), _negated=True), fields=('gdn',), name='unique_gdn'),
+        ),
+        migrations.AddConstraint(
+            model_name='goodsreceiptnote',
+            constraint=models.UniqueConstraint(condition=models.Q(('grn', ''), _negated=True), fields=('grn',), name='unique_grn'),
+        ),
+    ]
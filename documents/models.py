@@ -1,12 +1,18 @@
 import datetime
+import hashlib
+import json
+import os
+import socket
 import uuid
 from io import BytesIO
 import pytz
 
 from django.conf import settings
 from django.core.files import File
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import Q
 from django.urls import reverse
+from django.utils import timezone
 from django.db.models.expressions import F, ExpressionWrapper
 from django.db.models.aggregates import Sum
 
@@ -23,6 +29,104 @@ def get_deleted_customer():
     return Customer.objects.get_or_create(name='deleted')[0].id
 
 
+# transaction fields printed on goods receipt and dispatch notes
+PDF_TRANSACTION_FIELDS = ('id', 'created_time', 'material__name', 'gross_weight', 'tare_weight', 'unit_price', 'notes')
+
+
+def pdf_content_hash(number, date, notes, partner_name, transactions):
+    """
+    Returns the SHA-256 hash of the data printed on a goods receipt or dispatch note (print date excluded).
+    'transactions' are tuples of PDF_TRANSACTION_FIELDS.
+    """
+    rows = []
+    total_net_value = 0
+    for id, created_time, material_name, gross_weight, tare_weight, unit_price, transaction_notes in sorted(transactions):
+        net_weight = gross_weight - tare_weight
+        net_value = round(net_weight * unit_price, 2)
+        total_net_value += net_value
+        rows.append([
+            str(id), created_time.isoformat(), material_name, str(gross_weight), str(tare_weight),
+            str(net_weight), str(unit_price), str(net_value), transaction_notes
+        ])
+    content = [number, date.isoformat(), notes, partner_name, rows, str(total_net_value)]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+# renderings of a note whose data keeps changing while it is rendered
+PDF_RENDER_ATTEMPTS = 3
+
+
+def generate_note_pdf(note, template):
+    """
+    Renders the pdf of the goods receipt or dispatch 'note' with 'template', unless the stored one was rendered
+    from the same data. Returns True if the pdf has been rendered.
+    Rendering takes seconds, so the note is not locked meanwhile: the lock is taken afterwards, only to check
+    that the printed data has not changed since (the note is rendered again then) and to store the file.
+    """
+    for _ in range(PDF_RENDER_ATTEMPTS):
+        content_hash = note.content_hash()
+        if note.pdf and note.pdf_hash == content_hash and note.pdf.storage.exists(note.pdf.name):
+            return False
+        # the print date appears on the pdf
+        note.print_date = tz.localize(datetime.datetime.now())
+        pdf = Render.render(template, {'goods_movement_note': note})
+        if pdf.status_code != 200:
+            raise ValueError('Error rendering PDF.')
+        with transaction.atomic():
+            current = type(note).objects.select_for_update().get(pk=note.pk)
+            if current.content_hash() == content_hash:
+                if current.pdf:
+                    # replaces the stale file
+                    current.pdf.delete(save=False)
+                current.print_date = note.print_date
+                current.pdf_hash = content_hash
+                current.pdf.save(f'{str(current.id)}.pdf', File(BytesIO(pdf.content)))
+                note.pdf, note.pdf_hash = current.pdf.name, content_hash
+                return True
+        # changed while rendering
+        note.refresh_from_db()
+    raise ValueError('The document has been changed while its PDF was rendered.')
+
+
+class DocumentCounter(models.Model):
+    """ Last number issued per document type (GRN, GDN) and year. """
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False)
+    document_type = models.CharField(max_length=3)
+    year = models.PositiveSmallIntegerField()
+    last_number = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['document_type', 'year'], name='unique_document_counter'),
+        ]
+
+    def __str__(self):
+        return f'{self.document_type}{self.year}: {self.last_number}'
+
+    @classmethod
+    def reserve(cls, document_type, year, count=1):
+        """
+        Reserves 'count' consecutive numbers with a single upsert and returns the first one.
+        The counter row stays locked until the surrounding transaction ends, so numbers are
+        not lost if it is rolled back: reserve them as the last step of the transaction.
+        """
+        if count < 1:
+            raise ValueError('At least one number has to be reserved.')
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (id, document_type, year, last_number) VALUES (%s, %s, %s, %s) '
+                f'ON CONFLICT (document_type, year) DO UPDATE SET last_number = {table}.last_number + EXCLUDED.last_number '
+                f'RETURNING last_number',
+                [uuid.uuid4(), document_type, year, count]
+            )
+            last_number = cursor.fetchone()[0]
+        return last_number - count + 1
+
+
 class GoodsReceiptNote(models.Model):
     id = models.UUIDField(
         primary_key=True,
@@ -40,6 +144,21 @@ class GoodsReceiptNote(models.Model):
     created_time = models.DateTimeField(auto_now_add=True, editable=False)
     last_modified = models.DateTimeField(auto_now=True, editable=False)
     pdf = models.FileField(upload_to='goods_receipt_notes/', null=True, blank=True)
+    # content_hash() of the data the pdf was rendered from
+    pdf_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        # list views: ordered by number, filtered by date, vendor or printed state
+        indexes = [
+            models.Index(fields=['grn'], name='grn_number_idx'),
+            models.Index(fields=['date'], name='grn_date_idx'),
+            models.Index(fields=['vendor', 'grn'], name='grn_vendor_idx'),
+            models.Index(fields=['grn'], condition=Q(print_date__isnull=True), name='grn_unprinted_idx'),
+        ]
+        # notes are unnumbered only until the end of the transaction saving them (see save)
+        constraints = [
+            models.UniqueConstraint(fields=['grn'], condition=~Q(grn=''), name='unique_grn'),
+        ]
 
     @property
     def vendor_name(self):
@@ -54,33 +173,51 @@ class GoodsReceiptNote(models.Model):
 
 
     @staticmethod
-    def get_last_grn(year):
-        year_string = str(year)
-        return GoodsReceiptNote.objects.filter(grn__startswith=f'GRN{year_string}').order_by('grn').last()
+    def format_grn(year, number):
+        return f'GRN{str(year)}/{str(number).zfill(6)}'
 
     @staticmethod
-    def get_next_grn(year, last_grn):
-        suffix = int(last_grn.grn[8:]) + 1 if last_grn else 1
-        return f'GRN{str(year)}/{str(suffix).zfill(6)}'
+    def reserve_grns(count, year=None):
+        """
+        Reserves 'count' consecutive grns of 'year' (default: current year), e.g. for imports.
+        Call it as the last step of the transaction saving the documents.
+        """
+        year = year or datetime.date.today().year
+        first = DocumentCounter.reserve('GRN', year, count)
+        return [GoodsReceiptNote.format_grn(year, number) for number in range(first, first + count)]
+
+    def save(self, *args, assign_number=True, **kwargs):
+        """
+        A new note gets the next grn, unless 'assign_number' is False: the counter of the year stays locked from
+        the reservation until the commit, so callers saving more in the same transaction call assign_grn() last.
+        """
+        with transaction.atomic():
+            if not self.grn and assign_number:
+                # update grn -> get next unique id
+                self.grn = GoodsReceiptNote.reserve_grns(1)[0]
+            super(GoodsReceiptNote, self).save(*args, **kwargs)
 
-    def save(self, *args, **kwargs):
+    def assign_grn(self):
+        """ Numbers a note saved with assign_number=False. """
         if not self.grn:
-            # update grn -> get next unique id
-            current_year = datetime.date.today().year
-            last_grn = GoodsReceiptNote.get_last_grn(current_year)
-            next_grn = GoodsReceiptNote.get_next_grn(current_year, last_grn)
-            self.grn = next_grn
-        super(GoodsReceiptNote, self).save(*args, **kwargs)
+            self.grn = GoodsReceiptNote.reserve_grns(1)[0]
+            GoodsReceiptNote.objects.filter(pk=self.pk).update(grn=self.grn)
+
+    def content_hash(self):
+        transactions = self.transactions.values_list(*PDF_TRANSACTION_FIELDS)
+        return pdf_content_hash(self.grn, self.date, self.notes, self.vendor_name, transactions)
+
+    @property
+    def pdf_is_stale(self):
+        """ The pdf exists but the data printed on it has changed since. """
+        return bool(self.pdf) and self.pdf_hash != self.content_hash()
 
     def generate_pdf(self):
-        context = {'goods_movement_note': self}
-        # we have to add print date before generating pdf so that it appear on the pdf
-        self.print_date = tz.localize(datetime.datetime.now())
-        self.save()
-        # generate pdf file
-        pdf = Render.render('documents/goods_receipt_note_pdf.html', context)
-        filename = f'{str(self.id)}.pdf'
-        self.pdf.save(filename, File(BytesIO(pdf.content)))
+        """
+        Renders the pdf, unless the stored one was rendered from the same data (see generate_note_pdf).
+        Returns True if the pdf has been rendered.
+        """
+        return generate_note_pdf(self, 'documents/goods_receipt_note_pdf.html')
 
     def serialize(self):
         return {
@@ -117,6 +254,21 @@ class GoodsDispatchNote(models.Model):
     created_time = models.DateTimeField(auto_now_add=True, editable=False)
     last_modified = models.DateTimeField(auto_now=True, editable=False)
     pdf = models.FileField(upload_to='goods_dispatch_notes/', null=True, blank=True)
+    # content_hash() of the data the pdf was rendered from
+    pdf_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        # list views: ordered by number, filtered by date, customer or printed state
+        indexes = [
+            models.Index(fields=['gdn'], name='gdn_number_idx'),
+            models.Index(fields=['date'], name='gdn_date_idx'),
+            models.Index(fields=['customer', 'gdn'], name='gdn_customer_idx'),
+            models.Index(fields=['gdn'], condition=Q(print_date__isnull=True), name='gdn_unprinted_idx'),
+        ]
+        # notes are unnumbered only until the end of the transaction saving them (see save)
+        constraints = [
+            models.UniqueConstraint(fields=['gdn'], condition=~Q(gdn=''), name='unique_gdn'),
+        ]
 
     @property
     def customer_name(self):
@@ -130,33 +282,51 @@ class GoodsDispatchNote(models.Model):
         return round(result, 2)
 
     @staticmethod
-    def get_last_gdn(year):
-        year_string = str(year)
-        return GoodsDispatchNote.objects.filter(gdn__startswith=f'GDN{year_string}').order_by('gdn').last()
+    def format_gdn(year, number):
+        return f'GDN{str(year)}/{str(number).zfill(6)}'
 
     @staticmethod
-    def get_next_gdn(year, last_gdn):
-        suffix = int(last_gdn.gdn[8:]) + 1 if last_gdn else 1
-        return f'GDN{str(year)}/{str(suffix).zfill(6)}'
+    def reserve_gdns(count, year=None):
+        """
+        Reserves 'count' consecutive gdns of 'year' (default: current year), e.g. for imports.
+        Call it as the last step of the transaction saving the documents.
+        """
+        year = year or datetime.date.today().year
+        first = DocumentCounter.reserve('GDN', year, count)
+        return [GoodsDispatchNote.format_gdn(year, number) for number in range(first, first + count)]
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, assign_number=True, **kwargs):
+        """
+        A new note gets the next gdn, unless 'assign_number' is False: the counter of the year stays locked from
+        the reservation until the commit, so callers saving more in the same transaction call assign_gdn() last.
+        """
+        with transaction.atomic():
+            if not self.gdn and assign_number:
+                # update gdn -> get next unique id
+                self.gdn = GoodsDispatchNote.reserve_gdns(1)[0]
+            super(GoodsDispatchNote, self).save(*args, **kwargs)
+
+    def assign_gdn(self):
+        """ Numbers a note saved with assign_number=False. """
         if not self.gdn:
-            # update gdn -> get next unique id
-            current_year = datetime.date.today().year
-            last_gdn = GoodsDispatchNote.get_last_gdn(current_year)
-            next_gdn = GoodsDispatchNote.get_next_gdn(current_year, last_gdn)
-            self.gdn = next_gdn
-        super(GoodsDispatchNote, self).save(*args, **kwargs)
+            self.gdn = GoodsDispatchNote.reserve_gdns(1)[0]
+            GoodsDispatchNote.objects.filter(pk=self.pk).update(gdn=self.gdn)
+
+    def content_hash(self):
+        transactions = self.transactions.values_list(*PDF_TRANSACTION_FIELDS)
+        return pdf_content_hash(self.gdn, self.date, self.notes, self.customer_name, transactions)
+
+    @property
+    def pdf_is_stale(self):
+        """ The pdf exists but the data printed on it has changed since. """
+        return bool(self.pdf) and self.pdf_hash != self.content_hash()
 
     def generate_pdf(self):
-        context = {'goods_movement_note': self}
-        # we have to add print date before generating pdf so that it appear on the pdf
-        self.print_date = tz.localize(datetime.datetime.now())
-        self.save()
-        # generate pdf file
-        pdf = Render.render('documents/goods_dispatch_note_pdf.html', context)
-        filename = f'{str(self.id)}.pdf'
-        self.pdf.save(filename, File(BytesIO(pdf.content)))
+        """
+        Renders the pdf, unless the stored one was rendered from the same data (see generate_note_pdf).
+        Returns True if the pdf has been rendered.
+        """
+        return generate_note_pdf(self, 'documents/goods_dispatch_note_pdf.html')
 
     def serialize(self):
         return {
@@ -174,3 +344,175 @@ class GoodsDispatchNote(models.Model):
 
     def get_absolute_url(self):
         return reverse('goods_dispatch_note_detail', args=[str(self.id)])
+
+
+class PdfJob(models.Model):
+    """
+    PDF generation of one goods receipt or dispatch note, executed by the local worker pool (documents.workers).
+    At most one job per document is queued or running, and jobs render only if the data of the document
+    has changed since its pdf was rendered (see generate_pdf), so every version is rendered exactly once.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    id = models.UUIDField(
+        primary_key=True,
+        default=uuid.uuid4,
+        editable=False)
+    goods_receipt_note = models.ForeignKey(
+        GoodsReceiptNote,
+        related_name='pdf_jobs',
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True
+    )
+    goods_dispatch_note = models.ForeignKey(
+        GoodsDispatchNote,
+        related_name='pdf_jobs',
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True
+    )
+    status = models.CharField(max_length=7, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    error = models.TextField(blank=True)
+    created_time = models.DateTimeField(auto_now_add=True, editable=False)
+    started_time = models.DateTimeField(blank=True, null=True)
+    finished_time = models.DateTimeField(blank=True, null=True)
+    # host:pid of the process running the job
+    worker = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['goods_receipt_note'], condition=Q(status__in=['queued', 'running']), name='unique_goods_receipt_note_pdf_job'
+            ),
+            models.UniqueConstraint(
+                fields=['goods_dispatch_note'], condition=Q(status__in=['queued', 'running']), name='unique_goods_dispatch_note_pdf_job'
+            ),
+        ]
+
+    @property
+    def document(self):
+        return self.goods_receipt_note or self.goods_dispatch_note
+
+    @property
+    def is_stale(self):
+        """ Queued or running for longer than PDF_JOB_TIMEOUT: the process executing it is gone. """
+        if self.status not in (PdfJob.STATUS_QUEUED, PdfJob.STATUS_RUNNING):
+            return False
+        since = self.started_time or self.created_time
+        return timezone.now() - since > datetime.timedelta(seconds=settings.PDF_JOB_TIMEOUT)
+
+    @staticmethod
+    def worker_name():
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @staticmethod
+    def fail_orphaned():
+        """
+        Marks failed the jobs left running by processes of this host that have exited (a killed
+        generate_pdfs run, a restarted web process), so they can be queued again. Returns their number.
+        """
+        host = socket.gethostname()
+        orphaned = []
+        running = PdfJob.objects.filter(status=PdfJob.STATUS_RUNNING, worker__startswith=f'{host}:')
+        for job_id, worker in running.values_list('id', 'worker'):
+            pid = int(worker[len(host) + 1:])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                orphaned.append(job_id)
+            except PermissionError:
+                # alive, owned by another user
+                pass
+        return PdfJob.objects.filter(pk__in=orphaned, status=PdfJob.STATUS_RUNNING).update(
+            status=PdfJob.STATUS_FAILED, error='The worker process has exited.', finished_time=timezone.now()
+        )
+
+    @staticmethod
+    def document_field(doc):
+        return 'goods_receipt_note' if isinstance(doc, GoodsReceiptNote) else 'goods_dispatch_note'
+
+    @staticmethod
+    def enqueue(doc, submit=True):
+        """
+        Returns the job generating the PDF of 'doc', creating it if there is none queued or running.
+        Returns None if the PDF exists and is up to date. Must be called in a transaction, the new job is handed
+        to the worker pool when it commits (unless 'submit' is False, the caller runs it then).
+        """
+        field = PdfJob.document_field(doc)
+        # serializes concurrent requests of the same document
+        doc = type(doc).objects.select_for_update().get(pk=doc.pk)
+        if doc.pdf and not doc.pdf_is_stale:
+            return None
+        active = (PdfJob.STATUS_QUEUED, PdfJob.STATUS_RUNNING)
+        job = PdfJob.objects.filter(**{field: doc}, status__in=active).first()
+        if job is not None and job.is_stale:
+            PdfJob.objects.filter(pk=job.pk).update(
+                status=PdfJob.STATUS_FAILED, error='Timed out.', finished_time=timezone.now()
+            )
+            job = None
+        if job is None:
+            try:
+                with transaction.atomic():
+                    job = PdfJob.objects.create(**{field: doc})
+            except IntegrityError:
+                return PdfJob.objects.filter(**{field: doc}, status__in=active).get()
+            if submit:
+                from . import workers
+                transaction.on_commit(lambda: workers.submit(job.id))
+        return job
+
+    @staticmethod
+    def run(job_id):
+        """
+        Executes a queued job. Jobs already claimed by another worker are skipped.
+        Returns True if the job has been executed.
+        """
+        claimed = PdfJob.objects\
+            .filter(pk=job_id, status=PdfJob.STATUS_QUEUED)\
+            .update(status=PdfJob.STATUS_RUNNING, started_time=timezone.now(), worker=PdfJob.worker_name())
+        if not claimed:
+            return False
+        job = PdfJob.objects.select_related('goods_receipt_note', 'goods_dispatch_note').get(pk=job_id)
+        try:
+            # locks the document only to store the rendered file
+            job.document.generate_pdf()
+        except Exception as e:
+            PdfJob.objects.filter(pk=job_id, status=PdfJob.STATUS_RUNNING).update(
+                status=PdfJob.STATUS_FAILED, error=str(e) or type(e).__name__, finished_time=timezone.now()
+            )
+            return True
+        # a job timed out meanwhile stays failed
+        PdfJob.objects.filter(pk=job_id, status=PdfJob.STATUS_RUNNING).update(
+            status=PdfJob.STATUS_DONE, finished_time=timezone.now()
+        )
+        return True
+
+    def serialize(self):
+        result = {
+            'id': str(self.id),
+            'status': self.status,
+            'error': self.error,
+            'document': str(self.document.id),
+            'queued_ahead': 0,
+            'pdf_url': None,
+        }
+        if self.status == PdfJob.STATUS_QUEUED:
+            result['queued_ahead'] = PdfJob.objects.filter(
+                status=PdfJob.STATUS_QUEUED, created_time__lt=self.created_time
+            ).count()
+        if self.status == PdfJob.STATUS_DONE and self.document.pdf:
+            result['pdf_url'] = self.document.pdf.url
+        return result
+
+    def __str__(self):
+        return f'{self.document} | {self.status}'
@@ -1,17 +1,30 @@
 # -*- coding: iso-8859-2 -*-
 
 import datetime
+import shutil
+import subprocess
+import sys
+from io import StringIO
+import tempfile
+import threading
+from unittest import mock
 from django import urls
 import pytz
 
-from django.test import TestCase, Client
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction, IntegrityError
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
 from django.urls import reverse
 from django.conf import settings
 from django.contrib.auth import get_user_model
 
-from .models import GoodsReceiptNote, GoodsDispatchNote
+from .models import GoodsReceiptNote, GoodsDispatchNote, PdfJob, DocumentCounter
 from partners.models import Vendor, Customer
-from inventories.models import MaterialGroup, Material, Transaction
+from inventories.models import MaterialGroup, Material, Transaction, StockSnapshot, update_ledger
+from reports.models import ReportCacheEntry
 
 tz = pytz.timezone(settings.TIME_ZONE)
 
@@ -400,4 +413,707 @@ class GoodsDispatchNoteTests(TestCase):
         self.assertEqual(no_response.status_code, 404)
         self.assertContains(response, 'GDN2021/000002')
         self.assertContains(response, 'delete')
-        self.assertTemplateUsed(response, 'documents/goods_movement_note_delete.html')
\ No newline at end of file
+        self.assertTemplateUsed(response, 'documents/goods_movement_note_delete.html')
+
+
+@override_settings(PDF_WORKERS=0)
+class PdfJobTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        render = mock.patch('documents.models.Render.render', return_value=HttpResponse(b'%PDF-1.4 test', content_type='application/pdf'))
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+        vendor = Vendor.objects.create(name='Test Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        customer = Customer.objects.create(name='Test Customer', country='Hungary', postcode='1234', city='Budapest', address='Main street 2')
+        self.grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=vendor)
+        self.gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,2,3), customer=customer)
+        get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def generate(self, doc):
+        url_name = 'goods_receipt_note_generate' if isinstance(doc, GoodsReceiptNote) else 'goods_dispatch_note_generate'
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.patch(reverse(url_name, args=[str(doc.id)]))
+
+    def test_generate_enqueues_and_runs_job(self):
+        for doc in (self.grn, self.gdn):
+            with self.subTest(doc=doc):
+                response = self.generate(doc)
+                self.assertEqual(response.status_code, 202)
+                job = response.json()
+                self.assertEqual(job['status'], PdfJob.STATUS_QUEUED)
+                self.assertEqual(job['document'], str(doc.id))
+
+                # the job has been run by the worker when the request committed
+                status = self.client.get(job['status_url'])
+                self.assertEqual(status.status_code, 200)
+                self.assertEqual(status.json()['status'], PdfJob.STATUS_DONE)
+                doc.refresh_from_db()
+                self.assertTrue(doc.pdf)
+                self.assertIsNotNone(doc.print_date)
+                self.assertEqual(status.json()['pdf_url'], doc.pdf.url)
+
+                # pdf exists -> nothing to queue
+                self.assertEqual(self.generate(doc).status_code, 400)
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_document_is_rendered_once(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            first = PdfJob.enqueue(self.grn)
+            second = PdfJob.enqueue(self.grn)
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(PdfJob.run(first.id))
+        # a job is claimed by one worker only
+        self.assertFalse(PdfJob.run(first.id))
+        self.assertEqual(self.render.call_count, 1)
+        first.refresh_from_db()
+        self.assertEqual(first.status, PdfJob.STATUS_DONE)
+        self.assertIsNone(PdfJob.enqueue(self.grn))
+
+    def test_failed_job_can_be_requeued(self):
+        self.render.return_value = HttpResponse('Error Rendering PDF', status=400)
+        status = self.client.get(self.generate(self.grn).json()['status_url']).json()
+        self.assertEqual(status['status'], PdfJob.STATUS_FAILED)
+        self.assertEqual(status['error'], 'Error rendering PDF.')
+        self.grn.refresh_from_db()
+        self.assertFalse(self.grn.pdf)
+
+        self.render.return_value = HttpResponse(b'%PDF-1.4 test', content_type='application/pdf')
+        status = self.client.get(self.generate(self.grn).json()['status_url']).json()
+        self.assertEqual(status['status'], PdfJob.STATUS_DONE)
+        self.assertEqual(PdfJob.objects.filter(goods_receipt_note=self.grn).count(), 2)
+
+    def test_stale_job_is_replaced(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            job = PdfJob.enqueue(self.gdn)
+        PdfJob.objects.filter(pk=job.pk).update(
+            status=PdfJob.STATUS_RUNNING, started_time=tz.localize(datetime.datetime(2021,1,1))
+        )
+        response = self.generate(self.gdn)
+        self.assertNotEqual(response.json()['id'], str(job.id))
+        self.assertEqual(self.client.get(response.json()['status_url']).json()['status'], PdfJob.STATUS_DONE)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PdfJob.STATUS_FAILED)
+
+    def test_job_status_not_found(self):
+        response = self.client.get(reverse('pdf_job_status', args=['00000000-0000-0000-0000-000000000000']))
+        self.assertEqual(response.status_code, 404)
+
+    def test_generate_pdfs_command(self):
+        done = GoodsDispatchNote.objects.create(date=datetime.date(2021,3,10), customer=self.gdn.customer)
+        with self.captureOnCommitCallbacks(execute=False):
+            PdfJob.run(PdfJob.enqueue(done).id)
+        old = GoodsReceiptNote.objects.create(date=datetime.date(2020,12,31), vendor=self.grn.vendor)
+        self.render.reset_mock()
+
+        out = StringIO()
+        call_command('generate_pdfs', workers=0, date_from=datetime.date(2021,1,1), stdout=out)
+        self.assertIn('2 document(s) to render, 0 in progress elsewhere.', out.getvalue())
+        self.assertIn('2 PDF(s) generated', out.getvalue())
+        self.assertIn('0 failed.', out.getvalue())
+        self.assertEqual(self.render.call_count, 2)
+        for doc in (self.grn, self.gdn, old):
+            doc.refresh_from_db()
+        self.assertTrue(self.grn.pdf)
+        self.assertTrue(self.gdn.pdf)
+        self.assertFalse(old.pdf)
+
+        # restarted runs skip finished documents
+        out = StringIO()
+        call_command('generate_pdfs', workers=0, date_from=datetime.date(2021,1,1), stdout=out)
+        self.assertIn('0 document(s) to render', out.getvalue())
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_generate_pdfs_command_resumes_queued_jobs(self):
+        # job queued by an interrupted run
+        with self.captureOnCommitCallbacks(execute=False):
+            job = PdfJob.enqueue(self.grn, submit=False)
+        with self.captureOnCommitCallbacks(execute=False):
+            running = PdfJob.enqueue(self.gdn, submit=False)
+        PdfJob.objects.filter(pk=running.pk).update(status=PdfJob.STATUS_RUNNING, started_time=datetime.datetime.now(tz))
+
+        out = StringIO()
+        call_command('generate_pdfs', workers=0, stdout=out)
+        self.assertIn('1 document(s) to render, 1 in progress elsewhere.', out.getvalue())
+        job.refresh_from_db()
+        self.assertEqual(job.status, PdfJob.STATUS_DONE)
+        self.assertEqual(self.render.call_count, 1)
+
+    def test_generate_pdfs_command_requeues_jobs_of_exited_processes(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        host = PdfJob.worker_name().rsplit(':', 1)[0]
+        with self.captureOnCommitCallbacks(execute=False):
+            killed = PdfJob.enqueue(self.grn, submit=False)
+        with self.captureOnCommitCallbacks(execute=False):
+            running = PdfJob.enqueue(self.gdn, submit=False)
+        now = datetime.datetime.now(tz)
+        PdfJob.objects.filter(pk=killed.pk).update(status=PdfJob.STATUS_RUNNING, started_time=now, worker=f'{host}:{exited.pid}')
+        PdfJob.objects.filter(pk=running.pk).update(status=PdfJob.STATUS_RUNNING, started_time=now, worker=PdfJob.worker_name())
+
+        out = StringIO()
+        call_command('generate_pdfs', workers=0, stdout=out)
+        self.assertIn('1 job(s) of exited processes failed, queuing them again.', out.getvalue())
+        self.assertIn('1 document(s) to render, 1 in progress elsewhere.', out.getvalue())
+        killed.refresh_from_db()
+        self.assertEqual(killed.status, PdfJob.STATUS_FAILED)
+        self.assertEqual(PdfJob.objects.get(goods_receipt_note=self.grn, status=PdfJob.STATUS_DONE).worker, PdfJob.worker_name())
+        running.refresh_from_db()
+        self.assertEqual(running.status, PdfJob.STATUS_RUNNING)
+        self.grn.refresh_from_db()
+        self.assertTrue(self.grn.pdf)
+
+    def add_transaction(self, doc, **kwargs):
+        material = Material.objects.get_or_create(
+            name='alu can', material_group=MaterialGroup.objects.get_or_create(name='aluminium')[0]
+        )[0]
+        return Transaction.objects.create(**{
+            'transaction_type': Transaction.TYPE_IN,
+            'material': material,
+            'transaction_time': tz.localize(datetime.datetime(2021,2,3)),
+            'gross_weight': 10.0,
+            'tare_weight': 2.0,
+            'unit_price': 5.0,
+            'goods_receipt_note': doc,
+            **kwargs
+        })
+
+    def test_unchanged_pdf_is_reused(self):
+        self.add_transaction(self.grn)
+        self.assertTrue(self.grn.generate_pdf())
+        name, print_date = self.grn.pdf.name, self.grn.print_date
+        self.assertEqual(self.grn.pdf_hash, self.grn.content_hash())
+        self.assertFalse(self.grn.pdf_is_stale)
+
+        self.grn.refresh_from_db()
+        self.assertFalse(self.grn.generate_pdf())
+        self.assertEqual(self.render.call_count, 1)
+        self.assertEqual(self.grn.pdf.name, name)
+        self.assertEqual(self.grn.print_date, print_date)
+        # pdf exists and is up to date -> nothing to queue
+        self.assertEqual(self.generate(self.grn).status_code, 400)
+
+    def test_changed_data_marks_pdf_stale(self):
+        transaction = self.add_transaction(self.grn)
+        self.grn.generate_pdf()
+        content_hash = self.grn.content_hash()
+
+        for change in (
+            lambda: Transaction.objects.filter(pk=transaction.pk).update(unit_price=6.0),
+            lambda: self.add_transaction(self.grn, notes='second'),
+            lambda: GoodsReceiptNote.objects.filter(pk=self.grn.pk).update(notes='changed'),
+            lambda: Vendor.objects.filter(pk=self.grn.vendor.pk).update(name='Renamed Vendor'),
+            lambda: Transaction.objects.filter(pk=transaction.pk).update(goods_receipt_note=None),
+        ):
+            change()
+            self.grn.refresh_from_db()
+            self.assertTrue(self.grn.pdf_is_stale)
+            self.assertNotEqual(self.grn.content_hash(), content_hash)
+            content_hash = self.grn.content_hash()
+
+            # stale pdf is rendered again, replacing the file
+            old_name = self.grn.pdf.name
+            response = self.generate(self.grn)
+            self.assertEqual(response.status_code, 202)
+            self.grn.refresh_from_db()
+            self.assertFalse(self.grn.pdf_is_stale)
+            self.assertEqual(self.grn.pdf_hash, content_hash)
+            self.assertFalse(self.grn.pdf.storage.exists(old_name) and old_name != self.grn.pdf.name)
+        self.assertEqual(self.render.call_count, 6)
+
+    def test_document_is_not_locked_while_rendering(self):
+        def render(template, context):
+            self.assertFalse([query for query in queries.captured_queries if 'FOR UPDATE' in query['sql']])
+            return HttpResponse(b'%PDF-1.4 test', content_type='application/pdf')
+        self.render.side_effect = render
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.grn.generate_pdf())
+        # the lock is taken to store the file
+        self.assertTrue([query for query in queries.captured_queries if 'FOR UPDATE' in query['sql']])
+        self.grn.refresh_from_db()
+        self.assertTrue(self.grn.pdf)
+        self.assertFalse(self.grn.pdf_is_stale)
+
+    def test_document_changed_while_rendering_is_rendered_again(self):
+        def render(template, context):
+            if self.render.call_count == 1:
+                # edited by another request meanwhile
+                GoodsReceiptNote.objects.filter(pk=self.grn.pk).update(notes='changed')
+            return HttpResponse(b'%PDF-1.4 test', content_type='application/pdf')
+        self.render.side_effect = render
+        self.assertTrue(self.grn.generate_pdf())
+        self.assertEqual(self.render.call_count, 2)
+        self.grn.refresh_from_db()
+        self.assertEqual(self.grn.notes, 'changed')
+        self.assertFalse(self.grn.pdf_is_stale)
+
+        # a document that keeps changing is given up
+        def render(template, context):
+            GoodsReceiptNote.objects.filter(pk=self.grn.pk).update(notes=f'changed {self.render.call_count}')
+            return HttpResponse(b'%PDF-1.4 test', content_type='application/pdf')
+        self.render.side_effect = render
+        self.render.reset_mock()
+        GoodsReceiptNote.objects.filter(pk=self.grn.pk).update(notes='edited')
+        self.grn.refresh_from_db()
+        with self.assertRaises(ValueError):
+            self.grn.generate_pdf()
+        self.assertEqual(self.render.call_count, 3)
+        self.grn.refresh_from_db()
+        self.assertTrue(self.grn.pdf_is_stale)
+
+    def test_print_date_is_not_hashed(self):
+        content_hash = self.gdn.content_hash()
+        GoodsDispatchNote.objects.filter(pk=self.gdn.pk).update(print_date=tz.localize(datetime.datetime(2021,5,5)))
+        self.gdn.refresh_from_db()
+        self.assertEqual(self.gdn.content_hash(), content_hash)
+
+    def test_generate_pdfs_command_includes_stale(self):
+        self.add_transaction(self.grn)
+        self.grn.generate_pdf()
+        self.gdn.generate_pdf()
+        GoodsReceiptNote.objects.filter(pk=self.grn.pk).update(notes='changed')
+        self.render.reset_mock()
+
+        out = StringIO()
+        call_command('generate_pdfs', workers=0, stdout=out)
+        self.assertIn('0 document(s) to render', out.getvalue())
+        out = StringIO()
+        call_command('generate_pdfs', workers=0, include_stale=True, stdout=out)
+        self.assertIn('1 document(s) to render', out.getvalue())
+        self.assertEqual(self.render.call_count, 1)
+        self.grn.refresh_from_db()
+        self.assertFalse(self.grn.pdf_is_stale)
+
+
+@override_settings(PDF_SENDFILE='')
+class PdfDeliveryTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        media = override_settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+
+        vendor = Vendor.objects.create(name='Test Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        self.grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=vendor)
+        self.content = b'%PDF-1.4 ' + bytes(range(256)) * 4
+        self.grn.pdf.save('receipt.pdf', ContentFile(self.content))
+        self.url = reverse('goods_receipt_note_pdf', args=[str(self.grn.id)])
+        get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def test_full_response_has_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('Last-Modified', response)
+
+    def test_conditional_requests(self):
+        response = self.client.get(self.url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        b''.join(response.streaming_content)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # a rerendered pdf does not match
+        self.grn.pdf.save('receipt.pdf', ContentFile(self.content + b'x'))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        b''.join(response.streaming_content)
+
+    def test_byte_ranges(self):
+        size = len(self.content)
+        for header, first, last in (
+            ('bytes=0-99', 0, 99),
+            ('bytes=100-', 100, size - 1),
+            ('bytes=-10', size - 10, size - 1),
+            ('bytes=1000-99999', 1000, size - 1),
+        ):
+            with self.subTest(header=header):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(b''.join(response.streaming_content), self.content[first:last + 1])
+                self.assertEqual(response['Content-Range'], f'bytes {first}-{last}/{size}')
+                self.assertEqual(int(response['Content-Length']), last - first + 1)
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+        # multiple or malformed ranges and outdated If-Range get the whole file
+        for headers in (
+            {'HTTP_RANGE': 'bytes=0-1,5-6'},
+            {'HTTP_RANGE': 'bytes=abc'},
+            {'HTTP_RANGE': 'bytes=0-99', 'HTTP_IF_RANGE': '"outdated"'},
+        ):
+            with self.subTest(headers=headers):
+                response = self.client.get(self.url, **headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-99', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        b''.join(response.streaming_content)
+
+    def test_sendfile_modes(self):
+        with override_settings(PDF_SENDFILE='x-accel-redirect', PDF_SENDFILE_PREFIX='/protected-media/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.grn.pdf.name)
+        self.assertIn('ETag', response)
+
+        with override_settings(PDF_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.grn.pdf.path)
+
+        # permissions are checked before the proxy sends the file
+        self.client.logout()
+        with override_settings(PDF_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_missing_file(self):
+        self.grn.pdf.storage.delete(self.grn.pdf.name)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class DocumentCounterTests(TestCase):
+
+    def setUp(self):
+        self.vendor = Vendor.objects.create(name='Test Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        self.customer = Customer.objects.create(name='Test Customer', country='Hungary', postcode='1234', city='Budapest', address='Main street 2')
+        self.year = datetime.date.today().year
+
+    def test_numbers_are_sequential_per_type_and_year(self):
+        first = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor)
+        second = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor)
+        gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,2,3), customer=self.customer)
+        self.assertEqual(first.grn, f'GRN{self.year}/000001')
+        self.assertEqual(second.grn, f'GRN{self.year}/000002')
+        self.assertEqual(gdn.gdn, f'GDN{self.year}/000001')
+        self.assertEqual(GoodsReceiptNote.reserve_grns(1, year=2020), ['GRN2020/000001'])
+        # saving again keeps the number
+        first.save()
+        self.assertEqual(first.grn, f'GRN{self.year}/000001')
+        self.assertEqual(DocumentCounter.objects.get(document_type='GRN', year=self.year).last_number, 2)
+
+    def test_bulk_reservation(self):
+        GoodsDispatchNote.objects.create(date=datetime.date(2021,2,3), customer=self.customer)
+        with self.assertNumQueries(1):
+            numbers = GoodsDispatchNote.reserve_gdns(3)
+        self.assertEqual(numbers, [f'GDN{self.year}/00000{i}' for i in (2, 3, 4)])
+        gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,2,3), customer=self.customer)
+        self.assertEqual(gdn.gdn, f'GDN{self.year}/000005')
+        with self.assertRaises(ValueError):
+            GoodsDispatchNote.reserve_gdns(0)
+
+    def test_rolled_back_numbers_are_reused(self):
+        try:
+            with transaction.atomic():
+                GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor)
+        self.assertEqual(grn.grn, f'GRN{self.year}/000001')
+
+
+    def test_numbers_are_unique(self):
+        grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            GoodsReceiptNote.objects.create(grn=grn.grn, date=datetime.date(2021,2,3), vendor=self.vendor)
+        # notes are numbered last in their transaction
+        with transaction.atomic():
+            unnumbered = [GoodsReceiptNote(date=datetime.date(2021,2,3), vendor=self.vendor) for _ in range(2)]
+            for note in unnumbered:
+                note.save(assign_number=False)
+            self.assertEqual([note.grn for note in unnumbered], ['', ''])
+            for note in unnumbered:
+                note.assign_grn()
+        self.assertEqual(
+            list(GoodsReceiptNote.objects.filter(pk__in=[note.pk for note in unnumbered]).order_by('grn').values_list('grn', flat=True)),
+            [GoodsReceiptNote.format_grn(self.year, i) for i in (2, 3)]
+        )
+
+
+class ConcurrentNumberingTests(TransactionTestCase):
+
+    def test_concurrent_saves_get_unique_numbers(self):
+        vendor = Vendor.objects.create(name='Test Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        barrier = threading.Barrier(8)
+
+        def create_notes():
+            try:
+                barrier.wait()
+                for _ in range(5):
+                    GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=vendor)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=create_notes) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        year = datetime.date.today().year
+        numbers = sorted(GoodsReceiptNote.objects.values_list('grn', flat=True))
+        self.assertEqual(numbers, [GoodsReceiptNote.format_grn(year, i) for i in range(1, 41)])
+
+
+class BulkFormsetSaveTests(TestCase):
+
+    def setUp(self):
+        self.vendor = Vendor.objects.create(name='Test Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        self.customer = Customer.objects.create(name='Test Customer', country='Hungary', postcode='1234', city='Budapest', address='Main street 2')
+        self.mat_group = MaterialGroup.objects.get_or_create(name='aluminium')[0]
+        self.mat_1 = Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group)[0]
+        self.mat_2 = Material.objects.get_or_create(name='alu can', material_group=self.mat_group)[0]
+        # snapshots of mat_1 exist, those of mat_2 are built by the first save
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN, material=self.mat_1, transaction_time=tz.localize(datetime.datetime(2021,2,1)),
+            gross_weight=1000, tare_weight=0, unit_price=2
+        )
+        get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def post_data(self, header, lines, initial=0):
+        data = dict(header)
+        data.update({
+            'transaction-TOTAL_FORMS': str(len(lines)),
+            'transaction-INITIAL_FORMS': str(initial),
+            'transaction-MIN_NUM_FORMS': '1',
+            'transaction-MAX_NUM_FORMS': '1000',
+        })
+        for i, line in enumerate(lines):
+            for name, value in line.items():
+                data[f'transaction-{i}-{name}'] = value
+        return data
+
+    def line(self, material, day, gross_weight, **kwargs):
+        line = {
+            'material': str(material.id), 'transaction_time': f'2021-02-{day:02d}T10:00',
+            'gross_weight': str(gross_weight), 'tare_weight': '1', 'unit_price': '3.5', 'notes': ''
+        }
+        line.update(kwargs)
+        return line
+
+    def assertDerivedDataIsCurrent(self):
+        for material in (self.mat_1, self.mat_2):
+            self.assertEqual(update_ledger(material.id), 0)
+            incremental = list(StockSnapshot.objects.filter(material=material).order_by('day').values_list('day', 'balance'))
+            StockSnapshot.rebuild(material.id)
+            rebuilt = list(StockSnapshot.objects.filter(material=material).order_by('day').values_list('day', 'balance'))
+            # incremental maintenance may leave days without movement, with the same closing balance
+            for day, closing in incremental:
+                previous = [b for d, b in rebuilt if d <= day]
+                self.assertEqual(closing, previous[-1] if previous else 0)
+            for snapshot in rebuilt:
+                self.assertIn(snapshot, incremental)
+
+    def test_create_saves_lines_in_bulk(self):
+        ReportCacheEntry.objects.create(
+            key='report', report='summary_report', date_from=tz.localize(datetime.datetime(2021,2,1)),
+            date_to=tz.localize(datetime.datetime(2021,2,28)), result=b''
+        )
+        lines = [self.line(self.mat_1 if i % 2 else self.mat_2, 2 + i % 20, 10 + i) for i in range(50)]
+        data = self.post_data({'date': '2021-02-03', 'customer': str(self.customer.id), 'notes': ''}, lines)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('goods_dispatch_note_new'), data)
+        self.assertEqual(response.status_code, 302)
+        # lines are written by one insert, validating the forms costs the queries per line
+        # (dashboard invalidation queries of the database cache aside)
+        queries = [query for query in queries.captured_queries if '"django_cache"' not in query['sql']]
+        writes = [query['sql'] for query in queries if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len([sql for sql in writes if sql.startswith('INSERT INTO "inventories_transaction"')]), 1)
+        self.assertLess(len(writes), 10)
+        saving = [query['sql'] for query in queries if 'FROM "inventories_material"' not in query['sql']]
+        self.assertLess(len(saving), 35)
+        # the number is reserved last, the counter is not locked while the lines are saved
+        counter = [i for i, sql in enumerate(writes) if sql.startswith('INSERT INTO "documents_documentcounter"')]
+        self.assertEqual(len(counter), 1)
+        self.assertFalse([sql for sql in writes[counter[0]:] if 'inventories_' in sql])
+
+        gdn = GoodsDispatchNote.objects.get()
+        self.assertEqual(gdn.gdn, GoodsDispatchNote.format_gdn(datetime.date.today().year, 1))
+        self.assertEqual(gdn.transactions.count(), 50)
+        self.assertEqual(set(gdn.transactions.values_list('transaction_type', flat=True)), {Transaction.TYPE_OUT})
+        self.assertFalse(gdn.transactions.filter(running_balance__isnull=True).exists())
+        self.assertFalse(ReportCacheEntry.objects.exists())
+        self.assertDerivedDataIsCurrent()
+
+    def test_update_saves_changed_and_new_lines(self):
+        data = self.post_data({'date': '2021-02-03', 'vendor': str(self.vendor.id), 'notes': ''}, [
+            self.line(self.mat_1, 5, 100), self.line(self.mat_1, 6, 200), self.line(self.mat_2, 7, 300)
+        ])
+        self.client.post(reverse('goods_receipt_note_new'), data)
+        grn = GoodsReceiptNote.objects.get()
+        first, second, third = grn.transactions.order_by('transaction_time')
+
+        lines = [
+            # moved to another material and day
+            self.line(self.mat_2, 3, 150, id=str(first.id), goods_receipt_note=str(grn.id)),
+            # unchanged
+            self.line(self.mat_1, 6, 200, id=str(second.id), goods_receipt_note=str(grn.id)),
+            self.line(self.mat_2, 7, 300, id=str(third.id), goods_receipt_note=str(grn.id), DELETE='on'),
+            self.line(self.mat_1, 8, 50),
+        ]
+        data = self.post_data({'date': '2021-02-03', 'vendor': str(self.vendor.id), 'notes': 'changed'}, lines, initial=3)
+        response = self.client.post(reverse('goods_receipt_note_edit', args=[str(grn.id)]), data)
+        self.assertEqual(response.status_code, 302)
+
+        grn.refresh_from_db()
+        self.assertEqual(grn.notes, 'changed')
+        self.assertEqual(grn.transactions.count(), 3)
+        first.refresh_from_db()
+        self.assertEqual((first.material, first.gross_weight), (self.mat_2, 150))
+        self.assertFalse(Transaction.objects.filter(pk=third.pk).exists())
+        self.assertEqual(set(grn.transactions.values_list('transaction_type', flat=True)), {Transaction.TYPE_IN})
+        self.assertDerivedDataIsCurrent()
+
+    def test_header_and_lines_are_atomic(self):
+        data = self.post_data({'date': '2021-02-03', 'vendor': str(self.vendor.id), 'notes': ''}, [self.line(self.mat_1, 5, 100)])
+        with mock.patch('documents.forms.transactions_changed', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('goods_receipt_note_new'), data)
+        self.assertFalse(GoodsReceiptNote.objects.exists())
+        self.assertEqual(Transaction.objects.count(), 1)
+
+
+class GoodsMovementNoteListQueryTests(TestCase):
+
+    def setUp(self):
+        self.vendor = Vendor.objects.create(name='Test Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        self.customer = Customer.objects.create(name='Test Customer', country='Hungary', postcode='1234', city='Budapest', address='Main street 2')
+        mat_group = MaterialGroup.objects.get_or_create(name='aluminium')[0]
+        self.material = Material.objects.get_or_create(name='alu can', material_group=mat_group)[0]
+        get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def create_notes(self, count):
+        for i in range(count):
+            grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor)
+            gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,2,3), customer=self.customer)
+            for note in (grn, gdn):
+                for weight in range(i % 3):
+                    Transaction.objects.create(
+                        transaction_type=Transaction.TYPE_IN if note is grn else Transaction.TYPE_OUT,
+                        material=self.material, transaction_time=tz.localize(datetime.datetime(2021,2,3)),
+                        gross_weight=10.5 + weight, tare_weight=1, unit_price=1.25,
+                        goods_receipt_note=note if note is grn else None,
+                        goods_dispatch_note=note if note is gdn else None,
+                    )
+
+    def count_queries(self, url_name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_list_query_count_does_not_depend_on_rows(self):
+        self.create_notes(2)
+        few = {url_name: self.count_queries(url_name) for url_name in ('goods_receipt_note_list', 'goods_dispatch_note_list')}
+        self.create_notes(10)
+        for url_name, count in few.items():
+            with self.subTest(url_name=url_name):
+                self.assertEqual(self.count_queries(url_name), count)
+
+    def test_list_shows_annotated_totals(self):
+        self.create_notes(3)
+        for url_name, model in (('goods_receipt_note_list', GoodsReceiptNote), ('goods_dispatch_note_list', GoodsDispatchNote)):
+            with self.subTest(url_name=url_name):
+                response = self.client.get(reverse(url_name))
+                notes = {note.pk: note for note in response.context['goods_movement_note_list']}
+                self.assertEqual(len(notes), 3)
+                for note in model.objects.all():
+                    self.assertEqual(notes[note.pk].transaction_count, note.transactions.count())
+                    self.assertEqual(notes[note.pk].net_value, note.total_net_value)
+                self.assertContains(response, 'Total Net Value')
+
+
+class GoodsMovementNoteFilterTests(TestCase):
+
+    def setUp(self):
+        self.vendor_1 = Vendor.objects.create(name='Vendor 1', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        self.vendor_2 = Vendor.objects.create(name='Vendor 2', country='Hungary', postcode='1234', city='Budapest', address='Main street 2')
+        self.grn_1 = GoodsReceiptNote.objects.create(date=datetime.date(2021,2,3), vendor=self.vendor_1)
+        self.grn_2 = GoodsReceiptNote.objects.create(
+            date=datetime.date(2021,3,3), vendor=self.vendor_2, print_date=tz.localize(datetime.datetime(2021,3,4))
+        )
+        self.grn_3 = GoodsReceiptNote.objects.create(date=datetime.date(2021,4,3), vendor=self.vendor_1)
+        get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def listed(self, **params):
+        response = self.client.get(reverse('goods_receipt_note_list'), params)
+        self.assertEqual(response.status_code, 200)
+        return [note.grn for note in response.context['goods_movement_note_list']]
+
+    def test_filters(self):
+        self.assertEqual(self.listed(), [self.grn_3.grn, self.grn_2.grn, self.grn_1.grn])
+        self.assertEqual(self.listed(date_from='2021-03-01', date_to='2021-03-31'), [self.grn_2.grn])
+        self.assertEqual(self.listed(partner=str(self.vendor_1.id)), [self.grn_3.grn, self.grn_1.grn])
+        self.assertEqual(self.listed(printed='yes'), [self.grn_2.grn])
+        self.assertEqual(self.listed(printed='no', date_from='2021-03-01'), [self.grn_3.grn])
+        # invalid filters are ignored
+        self.assertEqual(len(self.listed(date_from='someday')), 3)
+
+    @override_settings(LIST_PAGE_SIZE=1)
+    def test_pages_keep_filters(self):
+        response = self.client.get(reverse('goods_receipt_note_list'), {'partner': str(self.vendor_1.id)})
+        self.assertTrue(response.context['is_paginated'])
+        self.assertEqual([note.grn for note in response.context['goods_movement_note_list']], [self.grn_3.grn])
+        self.assertContains(response, f'?page=2&partner={self.vendor_1.id}')
+        self.assertEqual(self.listed(partner=str(self.vendor_1.id), page=2), [self.grn_1.grn])
+        # rows of the page are annotated
+        self.assertEqual(response.context['goods_movement_note_list'][0].transaction_count, 0)
+
+    def test_dispatch_note_filters(self):
+        customer = Customer.objects.create(name='Customer', country='Hungary', postcode='1234', city='Budapest', address='Main street 3')
+        gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,2,3), customer=customer)
+        response = self.client.get(reverse('goods_dispatch_note_list'), {'partner': str(customer.id), 'printed': 'no'})
+        self.assertEqual([note.gdn for note in response.context['goods_movement_note_list']], [gdn.gdn])
+        self.assertContains(response, 'Customer</label>')
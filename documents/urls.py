@@ -3,7 +3,8 @@ from django.urls import path
 from .views import (
     GoodsReceiptNoteListView, GoodsReceiptNoteDetailView, GoodsReceiptNoteCreateView, GoodsReceiptNoteUpdateView, GoodsReceiptNoteDeleteView,
     GoodsDispatchNoteListView, GoodsDispatchNoteDetailView, GoodsDispatchNoteCreateView, GoodsDispatchNoteUpdateView, GoodsDispatchNoteDeleteView,
-    goods_receipt_note_display_pdf, goods_receipt_note_generate_pdf, goods_dispatch_note_display_pdf, goods_dispatch_note_generate_pdf
+    goods_receipt_note_display_pdf, goods_receipt_note_generate_pdf, goods_dispatch_note_display_pdf, goods_dispatch_note_generate_pdf,
+    pdf_job_status
 )
 
 urlpatterns = [
@@ -23,4 +24,6 @@ urlpatterns = [
     path('goods_dispatch_notes/<uuid:pk>/delete/', GoodsDispatchNoteDeleteView.as_view(), name='goods_dispatch_note_delete'),
     path('goods_dispatch_notes/<uuid:pk>/pdf/', goods_dispatch_note_display_pdf, name='goods_dispatch_note_pdf'),
     path('goods_dispatch_notes/generate/<uuid:pk>', goods_dispatch_note_generate_pdf, name='goods_dispatch_note_generate'),
+    # PDF generation jobs
+    path('pdf_jobs/<uuid:pk>', pdf_job_status, name='pdf_job_status'),
 ]
\ No newline at end of file
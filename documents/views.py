@@ -1,18 +1,49 @@
-from django.http.response import HttpResponse, JsonResponse
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http.response import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from django.views.generic import ListView, DetailView, DeleteView, CreateView, UpdateView
 from django.urls import reverse_lazy, reverse
 from django.http import HttpResponseRedirect, FileResponse, Http404
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin, UserPassesTestMixin
 from django.contrib.auth.decorators import login_required, permission_required
+from django.db import models, transaction
+from django.db.models import Count, Sum, F, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 
-from .models import GoodsReceiptNote, GoodsDispatchNote
-from inventories.models import Transaction
+from .models import GoodsReceiptNote, GoodsDispatchNote, PdfJob
+from inventories.models import Transaction, RoundHalfEven
 from .forms import (
     GoodsReceiptNoteHeaderForm, GoodsDispatchNoteHeaderForm, 
-    GoodsReceiptTransactionFormSet, GoodsDispatchTransactionFormSet
+    GoodsReceiptTransactionFormSet, GoodsDispatchTransactionFormSet,
+    GoodsReceiptNoteFilterForm, GoodsDispatchNoteFilterForm
 )
 from .render import Render
-
+from pages.pagination import PaginatedListMixin
+
+
+
+def annotate_list(queryset, note_field):
+    """
+    Annotates goods movement notes with their transaction count and total net value (rounded like
+    total_net_value) by subqueries, so that lists need no query per row. 'note_field' is the foreign key
+    of the transactions to the note. Works on slices too, i.e. only the notes of a page are annotated.
+    """
+    transactions = Transaction.objects.filter(**{note_field: OuterRef('pk')}).order_by().values(note_field)
+    net_value_exp = ExpressionWrapper(
+        (F('gross_weight') - F('tare_weight')) * F('unit_price'),
+        output_field=models.DecimalField()
+    )
+    return queryset.annotate(
+        transaction_count=Coalesce(Subquery(transactions.annotate(count=Count('id')).values('count')), 0),
+        net_value=Coalesce(
+            Subquery(transactions.annotate(total=RoundHalfEven(Sum(net_value_exp))).values('total')),
+            0, output_field=models.DecimalField()
+        ),
+    )
 
 
 # ------------   Goods Receipt Note   ------------
@@ -60,16 +91,14 @@ class GoodsReceiptNoteCreateView(LoginRequiredMixin, CreateView):
             return self.form_invalid(header_form, transaction_formset)
 
     def form_valid(self, header_form, transaction_formset):
-        self.object = header_form.save()
-        transaction_formset.instance = self.object
-        transaction_formset.save()
-
-        for instance in transaction_formset:
-            # set transaction type
-            transaction = instance.save(commit=False)            
-            transaction.transaction_type = Transaction.TYPE_IN
-            transaction.save()
-
+        # header and lines are saved together, lines in bulk with their type set
+        with transaction.atomic():
+            self.object = header_form.save(commit=False)
+            self.object.save(assign_number=False)
+            transaction_formset.instance = self.object
+            transaction_formset.bulk_save(Transaction.TYPE_IN)
+            # numbered last, the counter stays locked until the commit
+            self.object.assign_grn()
         return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, header_form, transaction_formset):
@@ -122,9 +151,10 @@ class GoodsReceiptNoteUpdateView(LoginRequiredMixin, UpdateView):
             return self.form_invalid(header_form, transaction_formset)
 
     def form_valid(self, header_form, transaction_formset):
-        self.object = header_form.save()
-        transaction_formset.instance = self.object
-        transaction_formset.save()
+        with transaction.atomic():
+            self.object = header_form.save()
+            transaction_formset.instance = self.object
+            transaction_formset.bulk_save(Transaction.TYPE_IN)
         return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, header_form, transaction_formset):
@@ -133,11 +163,18 @@ class GoodsReceiptNoteUpdateView(LoginRequiredMixin, UpdateView):
         )
 
 
-class GoodsReceiptNoteListView(LoginRequiredMixin, ListView):
+class GoodsReceiptNoteListView(LoginRequiredMixin, PaginatedListMixin, ListView):
     model = GoodsReceiptNote
     context_object_name = 'goods_movement_note_list'
     template_name = 'documents/goods_movement_note_list.html'
     ordering = ['-grn']
+    filter_form_class = GoodsReceiptNoteFilterForm
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('vendor')
+
+    def annotate_page(self, object_list):
+        return annotate_list(object_list, 'goods_receipt_note')
 
 
 class GoodsReceiptNoteDetailView(LoginRequiredMixin, DetailView):
@@ -209,16 +246,14 @@ class GoodsDispatchNoteCreateView(LoginRequiredMixin, CreateView):
             return self.form_invalid(header_form, transaction_formset)
 
     def form_valid(self, header_form, transaction_formset):
-        self.object = header_form.save()
-        transaction_formset.instance = self.object
-        transaction_formset.save()
-
-        for instance in transaction_formset:
-            # set transaction type
-            transaction = instance.save(commit=False)            
-            transaction.transaction_type = Transaction.TYPE_OUT
-            transaction.save()
-
+        # header and lines are saved together, lines in bulk with their type set
+        with transaction.atomic():
+            self.object = header_form.save(commit=False)
+            self.object.save(assign_number=False)
+            transaction_formset.instance = self.object
+            transaction_formset.bulk_save(Transaction.TYPE_OUT)
+            # numbered last, the counter stays locked until the commit
+            self.object.assign_gdn()
         return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, header_form, transaction_formset):
@@ -271,9 +306,10 @@ class GoodsDispatchNoteUpdateView(LoginRequiredMixin, UpdateView):
             return self.form_invalid(header_form, transaction_formset)
 
     def form_valid(self, header_form, transaction_formset):
-        self.object = header_form.save()
-        transaction_formset.instance = self.object
-        transaction_formset.save()
+        with transaction.atomic():
+            self.object = header_form.save()
+            transaction_formset.instance = self.object
+            transaction_formset.bulk_save(Transaction.TYPE_OUT)
         return HttpResponseRedirect(self.get_success_url())
 
     def form_invalid(self, header_form, transaction_formset):
@@ -282,11 +318,18 @@ class GoodsDispatchNoteUpdateView(LoginRequiredMixin, UpdateView):
         )
 
 
-class GoodsDispatchNoteListView(LoginRequiredMixin, ListView):
+class GoodsDispatchNoteListView(LoginRequiredMixin, PaginatedListMixin, ListView):
     model = GoodsDispatchNote
     context_object_name = 'goods_movement_note_list'
     template_name = 'documents/goods_movement_note_list.html'
     ordering = ['-gdn']
+    filter_form_class = GoodsDispatchNoteFilterForm
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('customer')
+
+    def annotate_page(self, object_list):
+        return annotate_list(object_list, 'goods_dispatch_note')
 
 
 class GoodsDispatchNoteDetailView(LoginRequiredMixin, DetailView):
@@ -317,6 +360,53 @@ def goods_dispatch_note_generate_pdf(request, pk):
 ####################################
 
 
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_byte_range(header, size):
+    """
+    Returns the (first, last) byte positions of a single 'bytes=' range of a 'size' long file or None
+    if the header is not such a range (the whole file is sent). Raises RangeNotSatisfiable if the
+    range lies outside of the file.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first + last).isdigit():
+        return None
+    if not first:
+        # suffix range: the last 'last' bytes
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    last = int(last) if last else None
+    if last is not None and last < first:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable()
+    if last is None:
+        return first, size - 1
+    return first, min(last, size - 1)
+
+
+def file_range(file, first, last, chunk_size=64 * 1024):
+    """ Yields the bytes 'first'..'last' of 'file' and closes it. """
+    try:
+        file.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
 def goods_movement_note_display_pdf(request, pk, goods_movement_note_class):
     # get document
     try:
@@ -328,11 +418,64 @@ def goods_movement_note_display_pdf(request, pk, goods_movement_note_class):
         return JsonResponse({
             "error": "Pdf not yet generated."
         }, status=400)
+    # validators of the file, a rerendered pdf always gets a new modification time
+    try:
+        size = doc.pdf.storage.size(doc.pdf.name)
+        modified = doc.pdf.storage.get_modified_time(doc.pdf.name)
+    except FileNotFoundError:
+        raise Http404()
+    etag = f'"{size:x}-{int(modified.timestamp() * 1000000):x}"'
+    last_modified = int(modified.timestamp())
+    filename = os.path.basename(doc.pdf.name)
+
+    def add_headers(response):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Accept-Ranges'] = 'bytes'
+        # cached copies are revalidated, an unchanged pdf costs a 304 response
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    # If-None-Match / If-Modified-Since
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        return add_headers(response)
+
+    # the proxy sends the file (and handles ranges) after the checks above
+    if settings.PDF_SENDFILE:
+        response = HttpResponse(content_type='application/pdf')
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+        if settings.PDF_SENDFILE == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.PDF_SENDFILE_PREFIX + quote(doc.pdf.name)
+        else:
+            response['X-Sendfile'] = doc.pdf.path
+        return add_headers(response)
+
+    # byte range, ignored if If-Range does not match the current file
+    byte_range = None
+    if request.method in ('GET', 'HEAD') and 'HTTP_RANGE' in request.META:
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range == etag or if_range == http_date(last_modified):
+            try:
+                byte_range = parse_byte_range(request.META['HTTP_RANGE'], size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return add_headers(response)
+
     # display pdf
     try:
-        return FileResponse(doc.pdf, content_type='application/pdf')
+        file = doc.pdf.storage.open(doc.pdf.name, 'rb')
     except FileNotFoundError:
         raise Http404()
+    if byte_range is None:
+        return add_headers(FileResponse(file, content_type='application/pdf', filename=filename))
+    first, last = byte_range
+    response = StreamingHttpResponse(file_range(file, first, last), status=206, content_type='application/pdf')
+    response['Content-Length'] = last - first + 1
+    response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    response['Content-Disposition'] = f'inline; filename="{filename}"'
+    return add_headers(response)
 
 
 def goods_movement_note_generate_pdf(request, pk, goods_movement_note_class):
@@ -344,15 +487,30 @@ def goods_movement_note_generate_pdf(request, pk, goods_movement_note_class):
         doc = goods_movement_note_class.objects.get(pk=pk)
     except goods_movement_note_class.DoesNotExist:
         return JsonResponse({"error": "Document not found."}, status=404)
+    # queue pdf generation, repeated requests get the job already queued
+    with transaction.atomic():
+        job = PdfJob.enqueue(doc)
     # check if pdf is not yet generated
-    if doc.pdf:
+    if job is None:
         return JsonResponse({
             "error": "Pdf already exists."
         }, status=400)
-    # generate pdf
-    doc.generate_pdf()
-    serialized = doc.serialize()
-    return JsonResponse(serialized)
+    job.refresh_from_db()
+    serialized = job.serialize()
+    serialized['status_url'] = reverse('pdf_job_status', args=[str(job.id)])
+    return JsonResponse(serialized, status=202)
+
+
+@login_required
+def pdf_job_status(request, pk):
+    # only GET method is accepted
+    if request.method != "GET":
+        return JsonResponse({"error": "GET request required."}, status=400)
+    try:
+        job = PdfJob.objects.select_related('goods_receipt_note', 'goods_dispatch_note').get(pk=pk)
+    except PdfJob.DoesNotExist:
+        return JsonResponse({"error": "Job not found."}, status=404)
+    return JsonResponse(job.serialize())
 
 
 # https://docs.djangoproject.com/en/3.2/topics/forms/formsets/
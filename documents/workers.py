@@ -0,0 +1,39 @@
+"""
+Local worker pool of PDF generation: jobs are kept in the database (PdfJob) and executed by
+a thread pool of the web process, no outside broker is needed. With PDF_WORKERS = 0 jobs are
+executed synchronously when they are submitted.
+"""
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.PDF_WORKERS, thread_name_prefix='pdf-worker')
+        return _executor
+
+
+def run_job(job_id):
+    from .models import PdfJob
+    try:
+        PdfJob.run(job_id)
+    finally:
+        # every worker thread has its own database connection
+        connection.close()
+
+
+def submit(job_id):
+    if settings.PDF_WORKERS <= 0:
+        from .models import PdfJob
+        PdfJob.run(job_id)
+        return
+    get_executor().submit(run_job, job_id)
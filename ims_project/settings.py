@@ -106,6 +106,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# shared by all worker processes (rendered dashboard panels), create the table with manage.py createcachetable
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -197,4 +209,38 @@ DEFAULT_FROM_EMAIL = 'noreply@inventory-management-system.com'
 
 # django-crispy-forms
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
-CRISPY_TEMPLATE_PACK = "bootstrap5"
\ No newline at end of file
+CRISPY_TEMPLATE_PACK = "bootstrap5"
+
+# inventories
+# weighted average price replays: 'python' (Decimal, default) or 'postgresql' (ordered aggregate)
+WAP_BACKEND = os.environ.get('WAP_BACKEND', default='python')
+# period of one partition of the transaction table, 'year' or 'month' (see manage.py partition_transactions)
+TRANSACTION_PARTITION_INTERVAL = os.environ.get('TRANSACTION_PARTITION_INTERVAL', default='year')
+# rows validated and loaded together by CSV transaction imports (see manage.py import_transactions)
+TRANSACTION_IMPORT_BATCH_SIZE = int(os.environ.get('TRANSACTION_IMPORT_BATCH_SIZE', default=10000))
+# largest CSV file (bytes) imported through the web form, larger files are imported with the command
+TRANSACTION_IMPORT_MAX_UPLOAD_SIZE = int(os.environ.get('TRANSACTION_IMPORT_MAX_UPLOAD_SIZE', default=5 * 1024 * 1024))
+
+# reports
+# results of report functions are cached in the database until a transaction they depend on changes
+REPORT_CACHE_ENABLED = int(os.environ.get('REPORT_CACHE_ENABLED', default=1))
+REPORT_CACHE_TIMEOUT = int(os.environ.get('REPORT_CACHE_TIMEOUT', default=24 * 60 * 60))
+# rendered dashboard panels are shared by all users for up to this many seconds (Django cache)
+DASHBOARD_CACHE_TIMEOUT = int(os.environ.get('DASHBOARD_CACHE_TIMEOUT', default=5 * 60))
+
+# documents
+# PDFs are rendered by a thread pool of this many workers per process (0: synchronously, when requested)
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', default=2))
+# PDF jobs queued or running for longer than this many seconds are considered lost and may be requeued
+PDF_JOB_TIMEOUT = int(os.environ.get('PDF_JOB_TIMEOUT', default=10 * 60))
+# PDFs are sent by Django ('') or, after the permission checks, by the front proxy: 'x-accel-redirect' (nginx)
+# or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+PDF_SENDFILE = os.environ.get('PDF_SENDFILE', default='')
+# internal nginx location serving MEDIA_ROOT, e.g. location /protected-media/ { internal; alias <MEDIA_ROOT>/; }
+PDF_SENDFILE_PREFIX = os.environ.get('PDF_SENDFILE_PREFIX', default='/protected-media/')
+
+# lists
+# rows per page of the paginated list views
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', default=50))
+# above this many (estimated) rows the total of a list is the planner estimate instead of COUNT(*)
+LIST_COUNT_ESTIMATE_THRESHOLD = int(os.environ.get('LIST_COUNT_ESTIMATE_THRESHOLD', default=100000))
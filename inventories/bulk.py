@@ -0,0 +1,68 @@
+from collections import defaultdict
+
+from .models import Transaction, StockSnapshot, update_ledger, signed_movement
+from .signals import transactions_bulk_changed
+
+
+
+# Bulk writes of transactions (bulk_create, bulk_update, queryset update) send no signals,
+# the data derived from transactions is brought up to date by transactions_changed() instead.
+
+
+def ledger_values(transaction):
+    """ Returns the state of 'transaction' the ledger, snapshots and reports depend on. """
+    return {name: getattr(transaction, name) for name in Transaction.LEDGER_FIELDS}
+
+
+class DerivedDataChanges:
+    """
+    Collects the movements of bulk written transactions, so that the ledger, the daily stock snapshots,
+    cached reports and dashboard fragments are brought up to date once per material by apply().
+    """
+    # above this many changed days per material rebuilding the snapshots is cheaper than shifting them
+    SNAPSHOT_REBUILD_DAYS = 366
+
+    def __init__(self):
+        self.since = {}
+        self.until = {}
+        self.movements = defaultdict(lambda: defaultdict(int))
+
+    def __bool__(self):
+        return bool(self.since)
+
+    def add(self, material_id, transaction_time, movement):
+        """ Records a signed net weight 'movement' (inbound positive) of a material at 'transaction_time'. """
+        self.since[material_id] = min(self.since.get(material_id, transaction_time), transaction_time)
+        self.until[material_id] = max(self.until.get(material_id, transaction_time), transaction_time)
+        self.movements[material_id][StockSnapshot.local_day(transaction_time)] += movement
+
+    def add_values(self, values, sign=1):
+        """ Records ledger_values() written ('sign' 1) or removed ('sign' -1). """
+        movement = signed_movement(values['transaction_type'], values['gross_weight'], values['tare_weight'])
+        self.add(values['material_id'], values['transaction_time'], sign * movement)
+
+    def apply(self):
+        for material_id in self.since:
+            update_ledger(material_id, self.since[material_id])
+            if len(self.movements[material_id]) > self.SNAPSHOT_REBUILD_DAYS:
+                StockSnapshot.rebuild(material_id)
+            else:
+                StockSnapshot.apply_movements(material_id, self.movements[material_id])
+        if self:
+            # cached reports and dashboard fragments are evicted by the reports app
+            periods = {material_id: (since, self.until[material_id]) for material_id, since in self.since.items()}
+            transactions_bulk_changed.send(sender=Transaction, periods=periods)
+
+
+def transactions_changed(previous=(), current=()):
+    """
+    Updates the ledger, the daily stock snapshots, cached reports and dashboard fragments after bulk writes.
+    'previous' are the ledger_values() of the states removed (updated transactions before the write,
+    deleted transactions), 'current' those of the states written (created and updated transactions).
+    """
+    changes = DerivedDataChanges()
+    for values in previous:
+        changes.add_values(values, -1)
+    for values in current:
+        changes.add_values(values)
+    changes.apply()
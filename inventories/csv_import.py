@@ -0,0 +1,281 @@
+import csv
+import datetime
+import io
+import uuid
+
+import pytz
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from documents.models import GoodsReceiptNote, GoodsDispatchNote
+from partners.models import Vendor, Customer
+
+from .bulk import DerivedDataChanges
+from .models import Material, Transaction
+
+tz = pytz.timezone(settings.TIME_ZONE)
+
+# CSV columns, 'note' groups rows into goods notes: an existing GRN/GDN number or any key
+# of a new note, which is then dated 'note_date' (default: day of its first row) and issued to 'partner'
+# (vendor of inbound, customer of outbound rows). Other columns are ignored.
+REQUIRED_COLUMNS = ('transaction_type', 'material', 'transaction_time', 'gross_weight', 'unit_price')
+OPTIONAL_COLUMNS = ('tare_weight', 'notes', 'note', 'note_date', 'partner')
+
+COPY_COLUMNS = (
+    'id', 'transaction_type', 'material_id', 'transaction_time', 'created_time', 'last_modified',
+    'gross_weight', 'tare_weight', 'unit_price', 'notes', 'goods_receipt_note_id', 'goods_dispatch_note_id'
+)
+
+# errors kept for the report, further ones are only counted
+MAX_REPORTED_ERRORS = 1000
+
+
+
+def copy_text(value):
+    """ Formats a value for COPY ... FROM STDIN in text format. """
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)\
+        .replace('\\', '\\\\')\
+        .replace('\t', '\\t')\
+        .replace('\n', '\\n')\
+        .replace('\r', '\\r')
+
+
+def copy_transactions(rows):
+    """ Loads rows of COPY_COLUMNS values into the transaction table with a single COPY. """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(map(copy_text, row)))
+        buffer.write('\n')
+    buffer.seek(0)
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {quote(Transaction._meta.db_table)} ({", ".join(map(quote, COPY_COLUMNS))}) FROM STDIN',
+            buffer
+        )
+
+
+class NameLookup:
+    """
+    Resolves names (case insensitive) or ids of the objects of 'queryset' to ids.
+    The lookup table is loaded on first use, names shared by several objects are rejected.
+    """
+    def __init__(self, queryset, label):
+        self.queryset = queryset
+        self.label = label
+        self.ids = None
+        self.ambiguous = set()
+
+    def load(self):
+        self.ids = {}
+        for pk, name in self.queryset.values_list('id', 'name').iterator():
+            key = name.strip().casefold()
+            if key in self.ids:
+                self.ambiguous.add(key)
+            self.ids[key] = pk
+            self.ids[str(pk)] = pk
+
+    def __call__(self, value):
+        if self.ids is None:
+            self.load()
+        key = value.strip().casefold()
+        if not key:
+            raise ValidationError(f'Missing {self.label}.')
+        if key in self.ambiguous:
+            raise ValidationError(f'Ambiguous {self.label} name: {value}')
+        try:
+            return self.ids[key]
+        except KeyError:
+            raise ValidationError(f'Unknown {self.label}: {value}')
+
+
+class ImportResult:
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.notes_created = 0
+        self.error_count = 0
+        self.errors = []    # (line, message)
+
+    def add_error(self, line, error):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, '; '.join(error.messages)))
+
+
+class TransactionImport:
+    """
+    Imports transactions, and optionally their goods notes, from CSV.
+    The file is read row by row and processed in batches: rows are validated against cached
+    material and partner lookups, new notes are created with bulk_create and the valid rows loaded with COPY.
+    Invalid rows are reported in the result and skipped, the rest of the file is imported.
+    The ledger, stock snapshots and cached reports are updated once, after the last batch, and the new notes numbered last.
+    """
+    NOTE_MODELS = {
+        Transaction.TYPE_IN: (GoodsReceiptNote, 'grn', 'vendor_id', GoodsReceiptNote.reserve_grns),
+        Transaction.TYPE_OUT: (GoodsDispatchNote, 'gdn', 'customer_id', GoodsDispatchNote.reserve_gdns),
+    }
+
+    def __init__(self, batch_size=None, dry_run=False):
+        if connection.vendor != 'postgresql':
+            raise ValidationError('Importing transactions requires PostgreSQL.')
+        self.batch_size = batch_size or settings.TRANSACTION_IMPORT_BATCH_SIZE
+        self.dry_run = dry_run
+        self.materials = NameLookup(Material.objects.all(), 'material')
+        self.partners = {
+            Transaction.TYPE_IN: NameLookup(Vendor.objects.all(), 'vendor'),
+            Transaction.TYPE_OUT: NameLookup(Customer.objects.all(), 'customer'),
+        }
+        self.fields = {name: Transaction._meta.get_field(name) for name in (
+            'transaction_type', 'gross_weight', 'tare_weight', 'unit_price'
+        )}
+        # (transaction_type, note key) -> note id, existing notes are loaded on first use
+        self.existing_notes = None
+        self.notes = {}
+        self.changes = DerivedDataChanges()
+        self.result = ImportResult()
+
+    def run(self, file):
+        """ Imports the CSV text 'file' (any iterable of lines), returns an ImportResult. """
+        reader = csv.DictReader(file)
+        columns = [column.strip() for column in reader.fieldnames or []]
+        missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+        if missing:
+            raise ValidationError(f'Missing column(s): {", ".join(missing)}')
+        reader.fieldnames = columns
+
+        if self.dry_run:
+            self.import_rows(reader)
+            return self.result
+        with transaction.atomic():
+            self.import_rows(reader)
+            self.changes.apply()
+            self.number_notes()
+        return self.result
+
+    def import_rows(self, reader):
+        now = timezone.now()
+        batch, new_notes = [], {}
+        for row in reader:
+            self.result.rows += 1
+            try:
+                batch.append(self.parse_row(row, now, new_notes))
+            except ValidationError as error:
+                self.result.add_error(reader.line_num, error)
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch, new_notes)
+                batch, new_notes = [], {}
+        self.write_batch(batch, new_notes)
+
+    def parse_row(self, row, now, new_notes):
+        """ Validates a CSV row, returns its COPY_COLUMNS values. """
+        def value(column):
+            return (row.get(column) or '').strip()
+
+        errors = []
+        def clean(column, parse):
+            try:
+                return parse(value(column))
+            except ValidationError as error:
+                errors.extend(f'{column}: {message}' for message in error.messages)
+
+        transaction_type = clean('transaction_type', lambda v: self.fields['transaction_type'].clean(v.upper(), None))
+        material_id = clean('material', self.materials)
+        transaction_time = clean('transaction_time', self.parse_time)
+        gross_weight = clean('gross_weight', lambda v: self.fields['gross_weight'].clean(v, None))
+        tare_weight = clean('tare_weight', lambda v: self.fields['tare_weight'].clean(v or '0', None))
+        unit_price = clean('unit_price', lambda v: self.fields['unit_price'].clean(v, None))
+        notes = value('notes')
+        if len(notes) > Transaction._meta.get_field('notes').max_length:
+            errors.append('notes: Too long.')
+        if errors:
+            raise ValidationError(errors)
+
+        note_ids = {Transaction.TYPE_IN: None, Transaction.TYPE_OUT: None}
+        if value('note'):
+            note_ids[transaction_type] = self.note_id(transaction_type, value('note'), row, transaction_time, new_notes)
+
+        self.changes.add(
+            material_id, transaction_time,
+            gross_weight - tare_weight if transaction_type == Transaction.TYPE_IN else tare_weight - gross_weight
+        )
+        return (
+            uuid.uuid4(), transaction_type, material_id, transaction_time, now, now,
+            gross_weight, tare_weight, unit_price, notes, note_ids[Transaction.TYPE_IN], note_ids[Transaction.TYPE_OUT]
+        )
+
+    @staticmethod
+    def parse_time(value):
+        try:
+            result = parse_datetime(value)
+        except ValueError:
+            result = None
+        if result is None:
+            raise ValidationError(f'Invalid date and time: {value}')
+        return tz.localize(result) if timezone.is_naive(result) else result
+
+    @staticmethod
+    def local_date(transaction_time):
+        return transaction_time.astimezone(tz).date()
+
+    def note_id(self, transaction_type, key, row, transaction_time, new_notes):
+        """ Returns the id of the note 'key' refers to, new notes are added to 'new_notes'. """
+        model, _, partner_field, _ = self.NOTE_MODELS[transaction_type]
+        if self.existing_notes is None:
+            self.existing_notes = {}
+            for t_type, (note_model, number_field, _, _) in self.NOTE_MODELS.items():
+                for pk, number in note_model.objects.values_list('id', number_field).iterator():
+                    self.existing_notes[(t_type, number)] = pk
+        if (transaction_type, key) in self.existing_notes:
+            return self.existing_notes[(transaction_type, key)]
+        if (transaction_type, key) in self.notes:
+            return self.notes[(transaction_type, key)].id
+
+        # first row of a new note
+        try:
+            partner_id = self.partners[transaction_type](row.get('partner') or '')
+        except ValidationError as error:
+            raise ValidationError([f'partner: {message}' for message in error.messages])
+        note_date = (row.get('note_date') or '').strip()
+        try:
+            date = parse_date(note_date) if note_date else self.local_date(transaction_time)
+        except ValueError:
+            date = None
+        if date is None:
+            raise ValidationError(f'note_date: Invalid date: {note_date}')
+        note = model(date=date, **{partner_field: partner_id})
+        self.notes[(transaction_type, key)] = new_notes[(transaction_type, key)] = note
+        return note.id
+
+    def write_batch(self, batch, new_notes):
+        self.result.notes_created += len(new_notes)
+        self.result.imported += len(batch)
+        if self.dry_run:
+            return
+        # numbered by number_notes()
+        for transaction_type, (model, _, _, _) in self.NOTE_MODELS.items():
+            notes = [note for (t_type, _), note in new_notes.items() if t_type == transaction_type]
+            model.objects.bulk_create(notes, batch_size=1000)
+        if batch:
+            copy_transactions(batch)
+
+    def number_notes(self):
+        """
+        Numbers the new notes in the year of their date. This is the last step of the import:
+        the counters stay locked from the reservation until the commit.
+        """
+        for transaction_type, (model, number_field, _, reserve) in self.NOTE_MODELS.items():
+            notes = [note for (t_type, _), note in self.notes.items() if t_type == transaction_type]
+            for year in sorted({note.date.year for note in notes}):
+                notes_of_year = [note for note in notes if note.date.year == year]
+                for note, number in zip(notes_of_year, reserve(len(notes_of_year), year)):
+                    setattr(note, number_field, number)
+            model.objects.bulk_update(notes, [number_field], batch_size=1000)
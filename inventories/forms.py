@@ -0,0 +1,26 @@
+from django import forms
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
+
+
+
+class TransactionImportForm(forms.Form):
+    file = forms.FileField(label='CSV file')
+    dry_run = forms.BooleanField(label='Only validate', required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['file'].help_text = (
+            f'UTF-8, comma separated, with a header row, at most {filesizeformat(settings.TRANSACTION_IMPORT_MAX_UPLOAD_SIZE)}. '
+            'Larger files are imported with manage.py import_transactions.'
+        )
+
+    def clean_file(self):
+        # the import runs within the request, in a single database transaction
+        file = self.cleaned_data['file']
+        if file.size > settings.TRANSACTION_IMPORT_MAX_UPLOAD_SIZE:
+            raise forms.ValidationError(
+                f'The file is larger than {filesizeformat(settings.TRANSACTION_IMPORT_MAX_UPLOAD_SIZE)}, '
+                'import it with manage.py import_transactions.'
+            )
+        return file
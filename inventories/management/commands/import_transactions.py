@@ -0,0 +1,56 @@
+import sys
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from inventories.csv_import import TransactionImport, REQUIRED_COLUMNS, OPTIONAL_COLUMNS
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports transactions, and optionally their goods notes, from a CSV file with the columns '
+        f'{", ".join(REQUIRED_COLUMNS)} and optionally {", ".join(OPTIONAL_COLUMNS)}. '
+        'Invalid rows are reported and skipped, the valid ones are loaded with PostgreSQL COPY.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file (UTF-8), - reads standard input.')
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Rows validated and loaded together (default: TRANSACTION_IMPORT_BATCH_SIZE setting).'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only validate the file, nothing is written.'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('Invalid batch size.')
+
+        started = time.monotonic()
+        try:
+            importer = TransactionImport(batch_size=options['batch_size'], dry_run=options['dry_run'])
+            if options['path'] == '-':
+                result = importer.run(sys.stdin)
+            else:
+                with open(options['path'], newline='', encoding='utf-8-sig') as file:
+                    result = importer.run(file)
+        except (OSError, ValidationError) as error:
+            raise CommandError('; '.join(getattr(error, 'messages', [str(error)])))
+        elapsed = time.monotonic() - started
+
+        for line, message in result.errors:
+            self.stderr.write(f'Line {line}: {message}')
+        if result.error_count > len(result.errors):
+            self.stderr.write(f'... {result.error_count - len(result.errors)} more error(s).')
+
+        rate = result.imported / elapsed * 60 if elapsed > 0 else 0
+        verb = 'validated' if options['dry_run'] else 'imported'
+        self.stdout.write(self.style.SUCCESS(
+            f'{result.imported} of {result.rows} transaction(s) {verb} in {elapsed:.1f} s ({rate:.0f} rows/min), '
+            f'{result.notes_created} new note(s), {result.error_count} invalid row(s).'
+        ))
+
@@ -0,0 +1,369 @@
+import datetime
+import re
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import pytz
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from inventories.models import Transaction, update_ledger
+from inventories.signals import transactions_bulk_changed
+
+tz = pytz.timezone(settings.TIME_ZONE)
+
+INTERVALS = ('year', 'month')
+
+OPENING_BALANCE_NOTES = 'Opening balance'
+
+
+
+def partition_start(dt, interval):
+    """ Returns the local start of the partition period containing 'dt'. """
+    dt = dt.astimezone(tz)
+    return tz.localize(datetime.datetime(dt.year, dt.month if interval == 'month' else 1, 1))
+
+
+def next_partition_start(start, interval):
+    if interval == 'month':
+        year, month = (start.year + 1, 1) if start.month == 12 else (start.year, start.month + 1)
+        return tz.localize(datetime.datetime(year, month, 1))
+    return tz.localize(datetime.datetime(start.year + 1, 1, 1))
+
+
+def partition_name(start, interval):
+    table = Transaction._meta.db_table
+    if interval == 'month':
+        return f'{table}_p{start.year}_{start.month:02d}'
+    return f'{table}_p{start.year}'
+
+
+def partition_bounds(name):
+    """ Returns (start, end) of a partition named by partition_name() or None for other tables. """
+    match = re.fullmatch(re.escape(Transaction._meta.db_table) + r'_p(\d{4})(?:_(\d{2}))?', name)
+    if match is None:
+        return None
+    year, month = int(match.group(1)), match.group(2)
+    if month is None:
+        start = tz.localize(datetime.datetime(year, 1, 1))
+        return start, next_partition_start(start, 'year')
+    start = tz.localize(datetime.datetime(year, int(month), 1))
+    return start, next_partition_start(start, 'month')
+
+
+def opening_partition_name(cutoff):
+    """ Returns the name of the partition holding the opening balances at 'cutoff'. """
+    return f'{Transaction._meta.db_table}_before_{cutoff.astimezone(tz):%Y_%m}'
+
+
+def is_opening_partition(name):
+    return re.fullmatch(re.escape(Transaction._meta.db_table) + r'_before_\d{4}_\d{2}', name) is not None
+
+
+def opening_balance_transactions(material_id, balance, wap, cutoff):
+    """
+    Returns unsaved transactions of a material before 'cutoff' that replay to 'balance' at the
+    weighted average price 'wap' rounded to the cent: receipts of at most the largest gross weight
+    (negative weights for a negative balance), or for an empty stock with a price, a receipt and a dispatch of 0.01.
+    """
+    weight_field = Transaction._meta.get_field('gross_weight')
+    price_field = Transaction._meta.get_field('unit_price')
+    unit = Decimal(1).scaleb(-weight_field.decimal_places)
+    max_weight = Decimal(10 ** (weight_field.max_digits - weight_field.decimal_places)) - unit
+    price = Decimal(wap).quantize(Decimal(1).scaleb(-price_field.decimal_places), rounding=ROUND_HALF_EVEN)
+    if abs(price) >= 10 ** (price_field.max_digits - price_field.decimal_places):
+        raise CommandError(f'The weighted average price {price} of material {material_id} does not fit an opening balance.')
+
+    def opening(transaction_type, gross_weight, unit_price, before):
+        return Transaction(
+            transaction_type=transaction_type,
+            material_id=material_id,
+            transaction_time=cutoff - datetime.timedelta(microseconds=before),
+            gross_weight=gross_weight,
+            tare_weight=0,
+            unit_price=unit_price,
+            notes=OPENING_BALANCE_NOTES,
+        )
+
+    if balance == 0:
+        if price == 0:
+            return []
+        # the dispatch exhausts the stock, which keeps the price
+        return [opening(Transaction.TYPE_IN, unit, price, 2), opening(Transaction.TYPE_OUT, unit, 0, 1)]
+    result = []
+    remaining = abs(balance)
+    while remaining > 0:
+        weight = min(remaining, max_weight)
+        result.append(opening(Transaction.TYPE_IN, weight if balance > 0 else -weight, price, 1))
+        remaining -= weight
+    return result
+
+
+def is_partitioned(cursor):
+    cursor.execute(
+        'SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass)',
+        [Transaction._meta.db_table]
+    )
+    return cursor.fetchone()[0]
+
+
+def id_registry_name():
+    return f'{Transaction._meta.db_table}_id'
+
+
+def has_id_registry(cursor):
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [id_registry_name()])
+    return cursor.fetchone()[0]
+
+
+def attached_partitions(cursor):
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass',
+        [Transaction._meta.db_table]
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+class Command(BaseCommand):
+    help = (
+        'Partitions the transaction table by transaction time (PostgreSQL declarative partitioning). '
+        'The first run converts the table, every run creates the partitions of the coming periods '
+        'and optionally detaches old partitions. Detached partitions are kept as plain tables. '
+        'As the primary key includes the transaction time, ids are kept unique by a registry table. '
+        'Before detaching, the balance and weighted average price (rounded to the cent) of every material '
+        f'at the end of the last detached period are written as "{OPENING_BALANCE_NOTES}" transactions '
+        'into a partition covering all earlier time, so balances, prices and the ledger carry on from them; '
+        'reports of the detached periods only see these opening balances. Detaching requires a complete '
+        'ledger (see manage.py rebuild_ledger) and no transactions of the detached time in the default partition.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', choices=INTERVALS, default=settings.TRANSACTION_PARTITION_INTERVAL,
+            help='Period covered by one partition (default: TRANSACTION_PARTITION_INTERVAL setting).'
+        )
+        parser.add_argument(
+            '--ahead', type=int, default=2,
+            help='Number of future periods to create partitions for (default: 2).'
+        )
+        parser.add_argument(
+            '--detach-before', type=datetime.date.fromisoformat,
+            help='Detach partitions ending on or before this date (YYYY-MM-DD), keeping opening balances.'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Partitioning requires PostgreSQL.')
+        if options['interval'] not in INTERVALS:
+            raise CommandError(f'Invalid interval: {options["interval"]}')
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {self.quote(Transaction._meta.db_table)} IN ACCESS EXCLUSIVE MODE')
+            if not is_partitioned(cursor):
+                self.convert(cursor, options['interval'])
+            # tables partitioned before ids were registered
+            self.ensure_unique_ids(cursor)
+            self.create_partitions(cursor, options['interval'], options['ahead'])
+            if options['detach_before'] is not None:
+                self.detach_partitions(cursor, tz.localize(datetime.datetime.combine(options['detach_before'], datetime.time())))
+
+    def quote(self, name):
+        return connection.ops.quote_name(name)
+
+    def convert(self, cursor, interval):
+        """
+        Replaces the transaction table by a table partitioned by transaction time with a default partition.
+        Indexes and foreign keys are recreated under their original names, the primary key is extended
+        with the partition key (ids are kept unique by ensure_unique_ids).
+        """
+        table = Transaction._meta.db_table
+        # deferred foreign key checks of pending writes would block dropping the table
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype <> 'p'",
+            [table]
+        )
+        constraints = cursor.fetchall()
+        cursor.execute(
+            'SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid = %s::regclass AND NOT indisprimary',
+            [table]
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+            [table]
+        )
+        pk_name = cursor.fetchone()[0]
+
+        old_table = f'{table}_unpartitioned'
+        cursor.execute(f'ALTER TABLE {self.quote(table)} RENAME TO {self.quote(old_table)}')
+        cursor.execute(
+            f'CREATE TABLE {self.quote(table)} (LIKE {self.quote(old_table)} INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ({self.quote("transaction_time")})'
+        )
+        cursor.execute(f'CREATE TABLE {self.quote(table + "_default")} PARTITION OF {self.quote(table)} DEFAULT')
+
+        # partitions for the periods holding transactions
+        cursor.execute(f'SELECT min(transaction_time), max(transaction_time) FROM {self.quote(old_table)}')
+        first, last = cursor.fetchone()
+        if first is not None:
+            start = partition_start(first, interval)
+            while start <= last:
+                self.create_partition(cursor, start, interval)
+                start = next_partition_start(start, interval)
+
+        cursor.execute(f'INSERT INTO {self.quote(table)} SELECT * FROM {self.quote(old_table)}')
+        count = cursor.rowcount
+        cursor.execute(f'DROP TABLE {self.quote(old_table)}')
+
+        cursor.execute(
+            f'ALTER TABLE {self.quote(table)} ADD CONSTRAINT {self.quote(pk_name)} PRIMARY KEY (id, transaction_time)'
+        )
+        for name, definition in constraints:
+            cursor.execute(f'ALTER TABLE {self.quote(table)} ADD CONSTRAINT {self.quote(name)} {definition}')
+        for definition in indexes:
+            cursor.execute(definition)
+        self.stdout.write(f'{table} partitioned by {interval}, {count} transaction(s) moved.')
+
+    def ensure_unique_ids(self, cursor):
+        """
+        A primary key of a partitioned table must include the partition key, so transaction ids are
+        kept unique by a registry table with id as its primary key: triggers of the transaction table
+        add the ids of inserted rows and remove those of deleted rows (rows moved to another partition
+        are both). Ids of detached partitions stay registered.
+        Existing duplicate ids are reported before the registry is created.
+        """
+        if has_id_registry(cursor):
+            return
+        table = Transaction._meta.db_table
+        registry = id_registry_name()
+        cursor.execute(f'SELECT id FROM {self.quote(table)} GROUP BY id HAVING count(*) > 1 ORDER BY id LIMIT 10')
+        duplicates = [str(row[0]) for row in cursor.fetchall()]
+        if duplicates:
+            raise CommandError(f'Duplicate transaction id(s): {", ".join(duplicates)}')
+
+        cursor.execute(f'CREATE TABLE {self.quote(registry)} (id uuid PRIMARY KEY)')
+        cursor.execute(f'INSERT INTO {self.quote(registry)} (id) SELECT id FROM {self.quote(table)}')
+        cursor.execute(
+            f'CREATE FUNCTION {self.quote(registry + "_update")}() RETURNS trigger AS $$\n'
+            f'BEGIN\n'
+            f'    IF TG_OP IN (\'DELETE\', \'UPDATE\') THEN\n'
+            f'        DELETE FROM {self.quote(registry)} WHERE id = OLD.id;\n'
+            f'    END IF;\n'
+            f'    IF TG_OP IN (\'INSERT\', \'UPDATE\') THEN\n'
+            f'        INSERT INTO {self.quote(registry)} (id) VALUES (NEW.id);\n'
+            f'    END IF;\n'
+            f'    RETURN NULL;\n'
+            f'END;\n'
+            f'$$ LANGUAGE plpgsql'
+        )
+        cursor.execute(
+            f'CREATE TRIGGER {self.quote(registry)} AFTER INSERT OR DELETE ON {self.quote(table)} '
+            f'FOR EACH ROW EXECUTE FUNCTION {self.quote(registry + "_update")}()'
+        )
+        cursor.execute(
+            f'CREATE TRIGGER {self.quote(registry + "_changed")} AFTER UPDATE OF id ON {self.quote(table)} '
+            f'FOR EACH ROW WHEN (OLD.id <> NEW.id) EXECUTE FUNCTION {self.quote(registry + "_update")}()'
+        )
+        self.stdout.write(f'Transaction ids registered in {registry}.')
+
+    def create_partition(self, cursor, start, interval):
+        """
+        Creates the partition of the period starting at 'start', moving its transactions
+        out of the default partition.
+        """
+        table = Transaction._meta.db_table
+        name = partition_name(start, interval)
+        end = next_partition_start(start, interval)
+        cursor.execute(f'CREATE TABLE {self.quote(name)} (LIKE {self.quote(table)} INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'WITH moved AS ('
+            f'DELETE FROM {self.quote(table + "_default")} WHERE transaction_time >= %s AND transaction_time < %s RETURNING *'
+            f') INSERT INTO {self.quote(name)} SELECT * FROM moved',
+            [start, end]
+        )
+        cursor.execute(
+            f'ALTER TABLE {self.quote(table)} ATTACH PARTITION {self.quote(name)} FOR VALUES FROM (%s) TO (%s)',
+            [start, end]
+        )
+        # the moved rows left the registry with the default partition
+        if has_id_registry(cursor):
+            cursor.execute(f'INSERT INTO {self.quote(id_registry_name())} (id) SELECT id FROM {self.quote(name)}')
+        self.stdout.write(f'Partition {name} created.')
+
+    def create_partitions(self, cursor, interval, ahead):
+        """ Creates the missing partitions from the current period to 'ahead' periods later. """
+        existing = [bounds for bounds in map(partition_bounds, attached_partitions(cursor)) if bounds is not None]
+        start = partition_start(timezone.now(), interval)
+        for _ in range(ahead + 1):
+            end = next_partition_start(start, interval)
+            # periods of an earlier interval setting are kept
+            if not any(s < end and start < e for s, e in existing):
+                self.create_partition(cursor, start, interval)
+            start = end
+
+    def detach_partitions(self, cursor, before):
+        """
+        Detaches the partitions ending on or before 'before', they are kept as plain tables.
+        The history they hold is replaced by opening balances at the end of the last detached period
+        (see opening_balance_transactions), written from the ledger into a new partition for all time
+        before it. A partition of earlier opening balances is detached as well.
+        """
+        table = Transaction._meta.db_table
+        partitions = sorted(attached_partitions(cursor))
+        detached = []
+        for name in partitions:
+            bounds = partition_bounds(name)
+            if bounds is not None and bounds[1] <= before:
+                detached.append((name, bounds[1]))
+        if not detached:
+            return
+        cutoff = max(end for _, end in detached)
+
+        cursor.execute(
+            f'SELECT count(*) FROM {self.quote(table + "_default")} WHERE transaction_time < %s',
+            [cutoff]
+        )
+        count = cursor.fetchone()[0]
+        if count:
+            raise CommandError(
+                f'The default partition holds {count} transaction(s) before {cutoff:%Y-%m-%d}, '
+                'they would be lost from the opening balances.'
+            )
+        # state of every material at the cutoff, read from the ledger
+        ledger = Transaction.objects\
+            .filter(transaction_time__lt=cutoff)\
+            .order_by('material_id', '-transaction_time', '-id')\
+            .distinct('material_id')\
+            .values_list('material_id', 'running_balance', 'running_wap')
+        openings = []
+        for material_id, balance, wap in ledger:
+            if balance is None or wap is None:
+                raise CommandError('The ledger is incomplete, run manage.py rebuild_ledger first.')
+            openings.append((material_id, balance, wap))
+        transactions = [
+            transaction
+            for material_id, balance, wap in openings
+            for transaction in opening_balance_transactions(material_id, balance, wap, cutoff)
+        ]
+
+        for name in partitions:
+            if is_opening_partition(name) or name in dict(detached):
+                cursor.execute(f'ALTER TABLE {self.quote(table)} DETACH PARTITION {self.quote(name)}')
+                self.stdout.write(f'Partition {name} detached.')
+
+        opening_partition = opening_partition_name(cutoff)
+        cursor.execute(f'CREATE TABLE {self.quote(opening_partition)} (LIKE {self.quote(table)} INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'ALTER TABLE {self.quote(table)} ATTACH PARTITION {self.quote(opening_partition)} FOR VALUES FROM (MINVALUE) TO (%s)',
+            [cutoff]
+        )
+        Transaction.objects.bulk_create(transactions, batch_size=1000)
+        changed = sum(update_ledger(material_id) for material_id, _, _ in openings)
+        transactions_bulk_changed.send(sender=Transaction, periods=None)
+        self.stdout.write(
+            f'Opening balances of {len(openings)} material(s) at {cutoff:%Y-%m-%d} written to {opening_partition}, '
+            f'{changed} ledger row(s) updated.'
+        )
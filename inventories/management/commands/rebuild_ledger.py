@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from inventories.models import Material, update_ledger
+
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the running balance and weighted average price ledger of all transactions.'
+
+    def handle(self, *args, **options):
+        for material in Material.objects.order_by('name'):
+            changed = update_ledger(material.id)
+            self.stdout.write(f'{material.name}: {changed} transaction(s) updated')
+        self.stdout.write(self.style.SUCCESS('Ledger rebuilt.'))
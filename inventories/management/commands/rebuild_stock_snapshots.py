@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from inventories.models import StockSnapshot
+
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily stock snapshots of all materials from transactions.'
+
+    def handle(self, *args, **options):
+        snapshots = StockSnapshot.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{len(snapshots)} stock snapshot(s) rebuilt.'))
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.4 on 2026-10-18 19:52
+
+from django.db import migrations, models
+
+
+def populate_ledger(apps, schema_editor):
+    Material = apps.get_model('inventories', 'Material')
+    Transaction = apps.get_model('inventories', 'Transaction')
+    for material_id in Material.objects.values_list('id', flat=True):
+        b = 0   # balance
+        wap = 0 # weighted_average_price
+        transactions = []
+        for transaction in Transaction.objects.filter(material_id=material_id).order_by('transaction_time', 'id'):
+            net_weight = transaction.gross_weight - transaction.tare_weight
+            p = transaction.unit_price if transaction.transaction_type == 'IN' else wap
+            w = net_weight if transaction.transaction_type == 'IN' else -net_weight
+            if b + w != 0:
+                wap = (b * wap + w * p) / (b + w)
+            b += w
+            transaction.running_balance = b
+            transaction.running_wap = wap
+            transactions.append(transaction)
+        Transaction.objects.bulk_update(transactions, ['running_balance', 'running_wap'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventories', '0007_alter_transaction_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='running_balance',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='running_wap',
+            field=models.DecimalField(blank=True, decimal_places=32, editable=False, max_digits=60, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['material', 'transaction_time', 'id'], name='transaction_ledger_idx'),
+        ),
+        migrations.RunPython(populate_ledger, migrations.RunPython.noop),
+    ]
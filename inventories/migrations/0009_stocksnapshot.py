@@ -0,0 +1,57 @@
+# Generated by Django 3.2.4 on 2026-10-18 19:54
+
+import pytz
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Sum, Case, When, ExpressionWrapper
+from django.db.models.functions import TruncDate
+import django.db.models.deletion
+
+
+def populate_stock_snapshots(apps, schema_editor):
+    Transaction = apps.get_model('inventories', 'Transaction')
+    StockSnapshot = apps.get_model('inventories', 'StockSnapshot')
+    tz = pytz.timezone(settings.TIME_ZONE)
+    net_weight_exp = ExpressionWrapper((F('gross_weight') - F('tare_weight')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
+    movements = Transaction.objects\
+        .annotate(day=TruncDate('transaction_time', tzinfo=tz))\
+        .values('material_id', 'day')\
+        .annotate(movement=Sum(Case(
+            When(transaction_type='IN', then=net_weight_exp),
+            default=-net_weight_exp,
+            output_field=models.DecimalField(max_digits=15, decimal_places=2)
+        )))\
+        .order_by('material_id', 'day')
+    snapshots = []
+    current_material_id, b = None, 0
+    for row in movements:
+        if row['material_id'] != current_material_id:
+            current_material_id, b = row['material_id'], 0
+        b += row['movement']
+        snapshots.append(StockSnapshot(material_id=row['material_id'], day=row['day'], balance=b))
+    StockSnapshot.objects.bulk_create(snapshots, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventories', '0008_transaction_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='inventories.material')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='stocksnapshot',
+            constraint=models.UniqueConstraint(fields=('material', 'day'), name='unique_stock_snapshot'),
+        ),
+        migrations.RunPython(populate_stock_snapshots, migrations.RunPython.noop),
+    ]
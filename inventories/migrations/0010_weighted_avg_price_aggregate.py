@@ -0,0 +1,95 @@
+# Generated by Django 3.2.4 on 2026-10-18 21:12
+
+from django.db import migrations
+
+
+# Running weighted average price as an ordered aggregate. Every arithmetic step is rounded
+# to 'digits' significant digits, half to even, like Python's decimal context does, so the
+# result equals the Decimal recurrence of inventories.models.weighted_avg_price_step.
+CREATE_SQL = """
+CREATE FUNCTION inventories_round_quotient(n numeric, d numeric, digits integer) RETURNS numeric AS $$
+DECLARE
+    s integer;
+    scaled numeric;
+    q numeric;
+    r numeric;
+BEGIN
+    IF n = 0 THEN
+        RETURN 0;
+    END IF;
+    -- find the scale giving a quotient of exactly 'digits' digits
+    s := digits - 1 - (floor(log(abs(n))) - floor(log(abs(d))))::integer;
+    LOOP
+        scaled := n * power(10::numeric, s);
+        q := div(scaled, d);
+        IF abs(q) >= power(10::numeric, digits) THEN
+            s := s - 1;
+        ELSIF abs(q) < power(10::numeric, digits - 1) THEN
+            s := s + 1;
+        ELSE
+            EXIT;
+        END IF;
+    END LOOP;
+    -- round half to even on the exact remainder
+    r := abs(scaled - q * d) * 2;
+    IF r > abs(d) OR (r = abs(d) AND mod(q, 2) <> 0) THEN
+        q := q + sign(scaled) * sign(d);
+    END IF;
+    RETURN round(q * power(10::numeric, -s), greatest(s, 0));
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE FUNCTION inventories_wap_step(state numeric[], transaction_type text, net_weight numeric, unit_price numeric, digits integer) RETURNS numeric[] AS $$
+DECLARE
+    b numeric := state[1];
+    wap numeric := state[2];
+    w numeric;
+    p numeric;
+BEGIN
+    IF transaction_type = 'IN' THEN
+        w := net_weight;
+        p := unit_price;
+    ELSE
+        w := -net_weight;
+        p := wap;
+    END IF;
+    IF b + w = 0 THEN
+        -- stock is exhausted -> price is kept
+        RETURN ARRAY[b + w, wap];
+    END IF;
+    wap := inventories_round_quotient(
+        inventories_round_quotient(b * wap, 1, digits) + inventories_round_quotient(w * p, 1, digits), 1, digits
+    );
+    RETURN ARRAY[b + w, inventories_round_quotient(wap, b + w, digits)];
+END;
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE FUNCTION inventories_wap_final(state numeric[]) RETURNS numeric AS $$
+    SELECT state[2];
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE AGGREGATE inventories_weighted_avg_price(text, numeric, numeric, integer) (
+    SFUNC = inventories_wap_step,
+    STYPE = numeric[],
+    FINALFUNC = inventories_wap_final,
+    INITCOND = '{0,0}'
+);
+"""
+
+DROP_SQL = """
+DROP AGGREGATE IF EXISTS inventories_weighted_avg_price(text, numeric, numeric, integer);
+DROP FUNCTION IF EXISTS inventories_wap_final(numeric[]);
+DROP FUNCTION IF EXISTS inventories_wap_step(numeric[], text, numeric, numeric, integer);
+DROP FUNCTION IF EXISTS inventories_round_quotient(numeric, numeric, integer);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventories', '0009_stocksnapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, DROP_SQL),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.4 on 2026-10-18 23:05
+
+from django.db import migrations
+
+
+# round() of PostgreSQL rounds ties away from zero, Python rounds Decimals to even
+CREATE_SQL = """
+CREATE FUNCTION inventories_round_half_even(x numeric, places integer) RETURNS numeric AS $$
+    SELECT CASE
+        WHEN abs(y - trunc(y)) = 0.5 THEN round((trunc(y) + abs(mod(trunc(y), 2)) * sign(y)) / power(10::numeric, places), places)
+        ELSE round(x, places)
+    END
+    FROM (SELECT x * power(10::numeric, places) AS y) AS scaled;
+$$ LANGUAGE sql IMMUTABLE STRICT;
+"""
+
+DROP_SQL = """
+DROP FUNCTION IF EXISTS inventories_round_half_even(numeric, integer);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventories', '0010_weighted_avg_price_aggregate'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, DROP_SQL),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.4 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventories', '0011_round_half_even'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_type', 'transaction_time'], include=('gross_weight', 'tare_weight', 'unit_price'), name='transaction_type_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['material', 'transaction_type', 'transaction_time'], include=('gross_weight', 'tare_weight', 'unit_price'), name='transaction_mat_type_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_time', 'id'], include=('transaction_type', 'gross_weight', 'tare_weight', 'unit_price'), name='transaction_time_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventories', '0012_report_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='material',
+            index=models.Index(fields=['name'], name='material_name_idx'),
+        ),
+    ]
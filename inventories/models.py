@@ -1,19 +1,39 @@
+import datetime
+import decimal
 import uuid
-
-from django.db import models
-from django.db.models import Q, Sum, ExpressionWrapper, F, When, Case, Window
+import pytz
+
+from django.conf import settings
+from django.contrib.postgres.aggregates.mixins import OrderableAggMixin
+from django.db import connection, models
+from django.db.transaction import atomic
+from django.db.models import Q, Sum, ExpressionWrapper, F, When, Case, Window, OuterRef, Subquery, Exists, Aggregate, Value, Func
+from django.db.models.functions import TruncDate
 from django.urls import reverse
 
 from documents.models import GoodsReceiptNote, GoodsDispatchNote
 
+tz = pytz.timezone(settings.TIME_ZONE)
+
+
+def get_default_material_group(name):
+    """
+    Returns the id of the material group 'name', created without signals if missing: it is only
+    used while a material is saved or a group deleted, which invalidate reports themselves.
+    This also runs in migrations (inventories 0002) before the tables of the receivers exist.
+    """
+    pk = MaterialGroup.objects.filter(name=name).values_list('id', flat=True).first()
+    if pk is None:
+        pk = MaterialGroup.objects.bulk_create([MaterialGroup(name=name)])[0].id
+    return pk
 
 
 def get_deleted_material_group():
-    return MaterialGroup.objects.get_or_create(name='deleted')[0].id
+    return get_default_material_group('deleted')
 
 
 def get_undefined_material_group():
-    return MaterialGroup.objects.get_or_create(name='undefined')[0].id
+    return get_default_material_group('undefined')
 
 
 class MaterialGroup(models.Model):
@@ -40,6 +60,28 @@ class MaterialGroup(models.Model):
         return [material_group.serialize() for material_group in MaterialGroup.objects.order_by('name').all()]
 
 
+def delete_materials(materials, delete):
+    """
+    Deletes the transactions of the 'materials' queryset with a single query, then the materials with 'delete'.
+    Their ledger, snapshots and cached reports need no update per transaction (the delete receivers of
+    Transaction would also make Django load every row), reports are invalidated once on deleting the material.
+    Returns the result of 'delete' with the transactions counted in.
+    """
+    with atomic():
+        transactions = Transaction.objects.filter(material__in=materials)
+        count = transactions._raw_delete(transactions.db)
+        deleted, per_model = delete()
+    if count:
+        per_model[Transaction._meta.label] = count
+    return deleted + count, per_model
+
+
+class MaterialQuerySet(models.QuerySet):
+
+    def delete(self):
+        return delete_materials(self, super().delete)
+
+
 class Material(models.Model):
     id = models.UUIDField(
         primary_key=True,
@@ -53,12 +95,22 @@ class Material(models.Model):
             default=get_undefined_material_group
             )
 
+    objects = MaterialQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['name'], name='material_name_idx'),
+        ]
+
     def __str__(self):
         return f'{self.name}'
 
     def get_absolute_url(self):
         return reverse('material_detail', args=[str(self.id)])
 
+    def delete(self, *args, **kwargs):
+        return delete_materials(Material.objects.filter(pk=self.pk), lambda: super(Material, self).delete(*args, **kwargs))
+
     def serialize(self):
         return {
             'id': str(self.id),
@@ -74,6 +126,17 @@ class Material(models.Model):
             return [material.serialize() for material in Material.objects.order_by('name').all()]
 
 
+class RoundHalfEven(Func):
+    """
+    Rounds to 'places' decimal places with ties to even, like Python's round() of Decimals (see migration 0011).
+    """
+    function = 'inventories_round_half_even'
+    output_field = models.DecimalField()
+
+    def __init__(self, expression, places=2, **extra):
+        super().__init__(expression, Value(places), **extra)
+
+
 class Transaction(models.Model):
     TYPE_IN = 'IN'
     TYPE_OUT = 'OUT'
@@ -107,11 +170,47 @@ class Transaction(models.Model):
         on_delete=models.SET_NULL, 
         null=True, 
         blank=True)
+    # per-material ledger: balance and weighted average price after this transaction
+    running_balance = models.DecimalField(max_digits=15, decimal_places=2, null=True, blank=True, editable=False)
+    running_wap = models.DecimalField(max_digits=60, decimal_places=32, null=True, blank=True, editable=False)
+
+    LEDGER_FIELDS = ('material_id', 'transaction_time', 'transaction_type', 'gross_weight', 'tare_weight', 'unit_price')
 
     class Meta:
         permissions = [
             ('can_view_all_transactions', 'Can view all transactions'),
         ]
+        indexes = [
+            models.Index(fields=['material', 'transaction_time', 'id'], name='transaction_ledger_idx'),
+            # report queries: type and time range, optionally per material, summing weights and values
+            models.Index(
+                fields=['transaction_type', 'transaction_time'], name='transaction_type_time_idx',
+                include=['gross_weight', 'tare_weight', 'unit_price']
+            ),
+            models.Index(
+                fields=['material', 'transaction_type', 'transaction_time'], name='transaction_mat_type_time_idx',
+                include=['gross_weight', 'tare_weight', 'unit_price']
+            ),
+            # weighted average price replays of all materials
+            models.Index(
+                fields=['transaction_time', 'id'], name='transaction_time_idx',
+                include=['transaction_type', 'gross_weight', 'tare_weight', 'unit_price']
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Transaction, cls).from_db(db, field_names, values)
+        # keep the loaded state so that ledger updates can tell what has changed
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if name in Transaction.LEDGER_FIELDS
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        # the post_save receivers update the ledger and snapshots in the same database transaction
+        with atomic(savepoint=False):
+            super().save(*args, **kwargs)
 
     @property
     def net_weight(self):
@@ -150,8 +249,61 @@ class Transaction(models.Model):
         }
 
     @staticmethod
-    def serialized_filtered_transactions(transaction_types=None, material_group=None, material=None,
-                                         date_from=None, date_to=None):
+    def bulk_serialize(transactions, chunk_size=None, extra_fields=()):
+        """
+        Yields serialize() of every transaction of the 'transactions' queryset, read with one .values() query.
+        Names of related objects, net weight, net value and partner are computed in SQL.
+        If 'chunk_size' is given, rows are read through a server-side cursor.
+        Values of 'extra_fields' (fields or annotations of the queryset) are added to each row under their names.
+        """
+        net_weight_exp = ExpressionWrapper(F('gross_weight') - F('tare_weight'), output_field=models.DecimalField())
+        rows = transactions\
+            .annotate(
+                serialized_net_weight=net_weight_exp,
+                serialized_net_value=RoundHalfEven(ExpressionWrapper(net_weight_exp * F('unit_price'), output_field=models.DecimalField())),
+                serialized_partner=Case(
+                    When(goods_receipt_note__isnull=False, then=F('goods_receipt_note__vendor__name')),
+                    When(goods_dispatch_note__isnull=False, then=F('goods_dispatch_note__customer__name')),
+                    default=None,
+                    output_field=models.CharField()
+                ),
+            )\
+            .values_list(
+                'id', 'transaction_type', 'material__material_group__name', 'material__name', 'transaction_time',
+                'created_time', 'last_modified', 'gross_weight', 'tare_weight', 'serialized_net_weight', 'unit_price',
+                'serialized_net_value', 'notes', 'goods_receipt_note_id', 'goods_dispatch_note_id', 'serialized_partner',
+                *extra_fields
+            )
+        if chunk_size is not None:
+            rows = rows.iterator(chunk_size=chunk_size)
+        for row in rows:
+            (id, transaction_type, material_group, material, transaction_time, created_time, last_modified,
+             gross_weight, tare_weight, net_weight, unit_price, net_value, notes,
+             goods_receipt_note_id, goods_dispatch_note_id, partner) = row[:16]
+            serialized = {
+                'id': str(id),
+                'transaction_type': transaction_type,
+                'material_group': material_group,
+                'material': material,
+                'transaction_time': transaction_time.strftime('%Y-%m-%d %H:%M'),
+                'created_time': created_time,
+                'last_modified': last_modified,
+                'gross_weight': gross_weight,
+                'tare_weight': tare_weight,
+                'net_weight': net_weight,
+                'unit_price': unit_price,
+                'net_value': net_value,
+                'notes': notes,
+                'goods_receipt_note': str(goods_receipt_note_id) if goods_receipt_note_id else None,
+                'goods_dispatch_note': str(goods_dispatch_note_id) if goods_dispatch_note_id else None,
+                'partner': partner
+            }
+            serialized.update(zip(extra_fields, row[16:]))
+            yield serialized
+
+    @staticmethod
+    def filtered_transactions(transaction_types=None, material_group=None, material=None,
+                              date_from=None, date_to=None):
         q = Q()
         if transaction_types is not None:
             if isinstance(transaction_types, list):
@@ -170,8 +322,13 @@ class Transaction(models.Model):
         if date_to is not None:
             q &= Q(transaction_time__lte=date_to)
 
-        transactions = Transaction.objects.filter(q).order_by('-transaction_time').all()
-        return [transaction.serialize() for transaction in transactions]
+        return Transaction.objects.filter(q).order_by('-transaction_time')
+
+    @staticmethod
+    def serialized_filtered_transactions(transaction_types=None, material_group=None, material=None,
+                                         date_from=None, date_to=None):
+        transactions = Transaction.filtered_transactions(transaction_types, material_group, material, date_from, date_to)
+        return list(Transaction.bulk_serialize(transactions))
 
     def __str__(self):
         return f'{self.transaction_time} | {self.transaction_type} | {self.net_weight}  |  {self.material.name} | $({self.net_value})'
@@ -181,9 +338,335 @@ class Transaction(models.Model):
 
 
 
+class StockSnapshot(models.Model):
+    """
+    Closing balance of a material on a day (in settings.TIME_ZONE).
+    Rows exist only for days with movements, balance on other days is the one of the latest previous row.
+    """
+    material = models.ForeignKey(Material, related_name='stock_snapshots', on_delete=models.CASCADE)
+    day = models.DateField()
+    balance = models.DecimalField(max_digits=15, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['material', 'day'], name='unique_stock_snapshot'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} | {self.material} | {self.balance}'
+
+    @staticmethod
+    def local_day(date):
+        return date.astimezone(tz).date()
+
+    @staticmethod
+    def is_end_of_day(date):
+        local = date.astimezone(tz)
+        return (local + datetime.timedelta(microseconds=1)).date() != local.date()
+
+    @staticmethod
+    def apply_movement(material_id, day, movement):
+        """
+        Adds 'movement' to the closing balance of 'day' and of all following snapshot days.
+        If snapshots of the material were never built, they are rebuilt from transactions instead
+        (already including the movement) and False is returned.
+        """
+        return StockSnapshot.apply_movements(material_id, {day: movement})
+
+    @staticmethod
+    def apply_movements(material_id, movements):
+        """
+        Applies the movements of several days ({day: movement}) with a single update, see apply_movement.
+        """
+        snapshots = StockSnapshot.objects.filter(material_id=material_id)
+        first = min(movements)
+        closing = dict(snapshots.filter(day__gte=first).values_list('day', 'balance'))
+        previous = snapshots.filter(day__lt=first).order_by('-day').values_list('balance', flat=True).first()
+        if not closing and previous is None and not snapshots.exists():
+            StockSnapshot.rebuild(material_id)
+            return False
+        # days without snapshot start from the closing balance of the day before
+        missing = []
+        for day in sorted(movements):
+            if day not in closing:
+                earlier = [d for d in closing if d < day]
+                balance = closing[max(earlier)] if earlier else previous or 0
+                missing.append(StockSnapshot(material_id=material_id, day=day, balance=balance))
+                closing[day] = balance
+        StockSnapshot.objects.bulk_create(missing, ignore_conflicts=True)
+        # every snapshot day gets the sum of the movements up to that day
+        cumulative, total = [], 0
+        for day, movement in sorted(movements.items()):
+            total += movement
+            cumulative.append((day, total))
+        if any(movement for movement in movements.values()):
+            snapshots.filter(day__gte=first).update(balance=F('balance') + Case(
+                *[When(day__gte=day, then=Value(total)) for day, total in reversed(cumulative)],
+                output_field=models.DecimalField(max_digits=15, decimal_places=2)
+            ))
+        return True
+
+    @staticmethod
+    def rebuild(material_id=None):
+        """
+        Rebuilds snapshots of a material (or all materials) from transactions.
+        """
+        q_filter = Q(material_id=material_id) if material_id is not None else Q()
+        net_weight_exp = ExpressionWrapper((F('gross_weight') - F('tare_weight')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
+        movements = Transaction.objects\
+            .filter(q_filter)\
+            .annotate(day=TruncDate('transaction_time', tzinfo=tz))\
+            .values('material_id', 'day')\
+            .annotate(movement=Sum(Case(
+                When(transaction_type=Transaction.TYPE_IN, then=net_weight_exp),
+                default=-net_weight_exp,
+                output_field=models.DecimalField(max_digits=15, decimal_places=2)
+            )))\
+            .order_by('material_id', 'day')
+
+        snapshots = []
+        current_material_id, b = None, 0
+        for row in movements:
+            if row['material_id'] != current_material_id:
+                current_material_id, b = row['material_id'], 0
+            b += row['movement']
+            snapshots.append(StockSnapshot(material_id=row['material_id'], day=row['day'], balance=b))
+        StockSnapshot.objects.filter(q_filter).delete()
+        StockSnapshot.objects.bulk_create(snapshots, batch_size=500)
+        return snapshots
+
+
+class WeightedAvgPrice(OrderableAggMixin, Aggregate):
+    """
+    Running weighted average price computed inside PostgreSQL (see migration 0010), rounded
+    at every step like the Decimal recurrence of weighted_avg_price_step.
+    Usage: WeightedAvgPrice('transaction_type', net_weight_exp, 'unit_price', ordering=('transaction_time', 'id'))
+    """
+    function = 'inventories_weighted_avg_price'
+    template = '%(function)s(%(expressions)s %(ordering)s)'
+    output_field = models.DecimalField()
+
+    def __init__(self, transaction_type, net_weight, unit_price, **extra):
+        precision = Value(decimal.getcontext().prec, output_field=models.IntegerField())
+        super().__init__(transaction_type, net_weight, unit_price, precision, **extra)
+
+
+def get_q_filter(filter_by=None):
+    assert isinstance(filter_by, (MaterialGroup, Material)) or filter_by is None
+
+    if isinstance(filter_by, Material):
+        return Q(material=filter_by)
+    elif isinstance(filter_by, MaterialGroup):
+        return Q(material__material_group=filter_by)
+    return Q()
+
+
+def signed_movement(transaction_type, gross_weight, tare_weight):
+    """ Returns the net weight moved by a transaction, inbound positive. """
+    net_weight = gross_weight - tare_weight
+    return net_weight if transaction_type == Transaction.TYPE_IN else -net_weight
+
+
+def weighted_avg_price_step(b, wap, transaction_type, net_weight, unit_price):
+    """
+    Applies one transaction to the running balance 'b' and weighted average price 'wap'.
+    Returns tuple (new_balance, new_weighted_avg_price).
+    """
+    p = unit_price if transaction_type == Transaction.TYPE_IN else wap
+    w = net_weight if transaction_type == Transaction.TYPE_IN else -net_weight
+    if b + w == 0:
+        # stock is exhausted -> price is kept
+        return b + w, wap
+    wap = (b * wap + w * p) / (b + w)
+    return b + w, wap
+
+
+def lock_ledger(material_id):
+    """
+    Serializes ledger updates of a material until the end of the current database transaction.
+    FOR NO KEY UPDATE does not block the foreign key checks of transactions inserted meanwhile.
+    """
+    list(Material.objects.select_for_update(no_key=True).filter(pk=material_id).values_list('pk', flat=True))
+
+
+def update_ledger(material_id, since=None, instance=None):
+    """
+    Recomputes the running balance and weighted average price of the transactions
+    of a material from 'since' onward (whole history if 'since' is None).
+    Updates of a material are serialized, rows are read through a server-side cursor and
+    only those whose ledger values change are written, in chunks. The ledger values of the
+    Transaction 'instance' are updated in memory too. Returns the number of rows written.
+    """
+    with atomic(savepoint=False):
+        lock_ledger(material_id)
+        transactions = Transaction.objects.filter(material_id=material_id)
+
+        b = 0   # balance
+        wap = 0 # weighted_average_price
+        if since is not None:
+            previous = transactions\
+                .filter(transaction_time__lt=since)\
+                .order_by('-transaction_time', '-id')\
+                .values('running_balance', 'running_wap')\
+                .first()
+            if previous is not None:
+                if previous['running_balance'] is None or previous['running_wap'] is None:
+                    # ledger is incomplete before 'since' -> start from the beginning
+                    return update_ledger(material_id, instance=instance)
+                b, wap = previous['running_balance'], previous['running_wap']
+            transactions = transactions.filter(transaction_time__gte=since)
+
+        count = 0
+        changed = []
+        for transaction in transactions.order_by('transaction_time', 'id').only(
+                'id', 'transaction_type', 'gross_weight', 'tare_weight', 'unit_price', 'running_balance', 'running_wap'
+                ).iterator(chunk_size=LEDGER_WRITE_CHUNK_SIZE):
+            b, wap = weighted_avg_price_step(b, wap, transaction.transaction_type, transaction.net_weight, transaction.unit_price)
+            if transaction.running_balance != b or transaction.running_wap != wap:
+                transaction.running_balance = b
+                transaction.running_wap = wap
+                changed.append(transaction)
+                if instance is not None and transaction.pk == instance.pk:
+                    instance.running_balance, instance.running_wap = b, wap
+                if len(changed) == LEDGER_WRITE_CHUNK_SIZE:
+                    write_ledger(changed)
+                    count += len(changed)
+                    changed = []
+        write_ledger(changed)
+    return count + len(changed)
+
+
+# rows per statement of write_ledger
+LEDGER_WRITE_CHUNK_SIZE = 5000
+
+
+def write_ledger(transactions):
+    """
+    Writes the running balance and weighted average price of 'transactions'.
+    On PostgreSQL each chunk is a single UPDATE joined to a VALUES list, the CASE expressions
+    of bulk_update get slow to build and evaluate for the ledgers of large imports.
+    """
+    if connection.vendor != 'postgresql':
+        Transaction.objects.bulk_update(transactions, ['running_balance', 'running_wap'], batch_size=500)
+        return
+    table = connection.ops.quote_name(Transaction._meta.db_table)
+    balance_field = Transaction._meta.get_field('running_balance')
+    wap_field = Transaction._meta.get_field('running_wap')
+    with connection.cursor() as cursor:
+        for i in range(0, len(transactions), LEDGER_WRITE_CHUNK_SIZE):
+            chunk = transactions[i:i + LEDGER_WRITE_CHUNK_SIZE]
+            params = []
+            for transaction in chunk:
+                params += [
+                    transaction.id,
+                    balance_field.get_db_prep_save(transaction.running_balance, connection),
+                    wap_field.get_db_prep_save(transaction.running_wap, connection),
+                ]
+            cursor.execute(
+                f'UPDATE {table} AS t SET running_balance = v.running_balance, running_wap = v.running_wap '
+                f'FROM (VALUES {", ".join(["(%s::uuid, %s::numeric, %s::numeric)"] * len(chunk))}) '
+                f'AS v (id, running_balance, running_wap) WHERE t.id = v.id',
+                params
+            )
+
+
+def ledger_balance(date, filter_by=None):
+    """
+    Returns the balance at 'date' read from the per-material ledger
+    or None if the ledger is not complete for the materials concerned.
+    """
+    assert isinstance(filter_by, (MaterialGroup, Material)) or filter_by is None
+
+    latest = Transaction.objects\
+        .filter(material=OuterRef('pk'), transaction_time__lte=date)\
+        .order_by('-transaction_time', '-id')
+    if isinstance(filter_by, Material):
+        q_filter = Q(pk=filter_by.pk)
+    elif isinstance(filter_by, MaterialGroup):
+        q_filter = Q(material_group=filter_by)
+    else:
+        q_filter = Q()
+
+    rows = Material.objects\
+        .filter(q_filter)\
+        .annotate(
+            latest_id=Subquery(latest.values('id')[:1]),
+            latest_balance=Subquery(latest.values('running_balance')[:1])
+        )\
+        .values_list('latest_id', 'latest_balance')
+
+    result = 0
+    for latest_id, latest_balance in rows:
+        if latest_id is None:
+            continue
+        if latest_balance is None:
+            return None
+        result += latest_balance
+    return result
+
+
+def ledger_weighted_avg_price(date, material):
+    """
+    Returns the weighted average price of 'material' at 'date' read from the ledger
+    or None if the ledger is not complete.
+    """
+    assert isinstance(material, Material)
+
+    latest = Transaction.objects\
+        .filter(material=material, transaction_time__lte=date)\
+        .order_by('-transaction_time', '-id')\
+        .values('running_wap')\
+        .first()
+    if latest is None:
+        return 0
+    return latest['running_wap']
+
+
+def snapshot_balance(date, filter_by=None):
+    """
+    Returns the closing balance of the day of 'date' read from the daily snapshots
+    or None if snapshots are missing for any material concerned.
+    """
+    assert isinstance(filter_by, (MaterialGroup, Material)) or filter_by is None
+
+    day = StockSnapshot.local_day(date)
+    latest = StockSnapshot.objects\
+        .filter(material=OuterRef('pk'), day__lte=day)\
+        .order_by('-day')
+    if isinstance(filter_by, Material):
+        q_filter = Q(pk=filter_by.pk)
+    elif isinstance(filter_by, MaterialGroup):
+        q_filter = Q(material_group=filter_by)
+    else:
+        q_filter = Q()
+
+    rows = Material.objects\
+        .filter(q_filter)\
+        .annotate(
+            latest_balance=Subquery(latest.values('balance')[:1]),
+            has_snapshots=Exists(StockSnapshot.objects.filter(material=OuterRef('pk'))),
+            has_transactions=Exists(Transaction.objects.filter(material=OuterRef('pk'), transaction_time__lte=date))
+        )\
+        .values_list('latest_balance', 'has_snapshots', 'has_transactions')
+
+    result = 0
+    for latest_balance, has_snapshots, has_transactions in rows:
+        if has_transactions and not has_snapshots:
+            return None
+        result += latest_balance or 0
+    return result
+
+
 def balance(date, filter_by=None):
     assert isinstance(filter_by, (MaterialGroup, Material)) or filter_by is None
 
+    # daily snapshots hold closing balances, other points of time are read from the ledger
+    result = snapshot_balance(date, filter_by) if StockSnapshot.is_end_of_day(date) else None
+    if result is None:
+        result = ledger_balance(date, filter_by)
+    if result is not None:
+        return result
+
     net_weight_exp = ExpressionWrapper((F('gross_weight') - F('tare_weight')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
     q_type_in = Q(transaction_type=Transaction.TYPE_IN)
     q_type_out =  Q(transaction_type=Transaction.TYPE_OUT)    
@@ -261,6 +744,12 @@ def movement_between(transaction_type, date_from, date_to, filter_by=None):
 
 def weighted_avg_price(date, filter_by=None):
     assert isinstance(filter_by, (MaterialGroup, Material)) or filter_by is None
+
+    # the ledger is kept per material, groups are replayed
+    if isinstance(filter_by, Material):
+        result = ledger_weighted_avg_price(date, filter_by)
+        if result is not None:
+            return result
     
     net_weight_exp = ExpressionWrapper((F('gross_weight') - F('tare_weight')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
     q_date_to = Q(transaction_time__lte=date)
@@ -271,20 +760,24 @@ def weighted_avg_price(date, filter_by=None):
     else:
         q_filter = Q()
 
+    if settings.WAP_BACKEND == 'postgresql':
+        # replay inside the database, only the final price is returned
+        result = Transaction.objects\
+            .filter(q_filter & q_date_to)\
+            .aggregate(wap=WeightedAvgPrice('transaction_type', net_weight_exp, 'unit_price', ordering=('transaction_time', 'id')))
+        return result['wap']
+
     raw = Transaction.objects\
         .filter(q_filter & q_date_to)\
         .annotate(net_weight=net_weight_exp)\
-        .order_by('transaction_time')\
-        .values('transaction_type', 'net_weight', 'unit_price')
+        .order_by('transaction_time', 'id')\
+        .values_list('transaction_type', 'net_weight', 'unit_price')\
+        .iterator()
 
     b = 0   # balance
-    p = 0   # price
     wap = 0 # weighted_average_price
-    for transaction in raw:
-        p = transaction['unit_price'] if transaction['transaction_type'] == Transaction.TYPE_IN else wap
-        w = transaction['net_weight'] if transaction['transaction_type'] == Transaction.TYPE_IN else -transaction['net_weight']
-        wap = (b * wap + w * p) / (b + w)
-        b += w
+    for transaction_type, net_weight, unit_price in raw:
+        b, wap = weighted_avg_price_step(b, wap, transaction_type, net_weight, unit_price)
     
     return wap
 
@@ -308,9 +801,14 @@ def period_weighted_avg_price(transaction_type, date_from, date_to, filter_by=No
         .filter(q_type & q_filter & q_date_from & q_date_to)\
         .annotate(net_weight=net_weight_exp)\
         .order_by('transaction_time')\
-        .values('net_weight', 'unit_price')
+        .values_list('net_weight', 'unit_price')\
+        .iterator()
+    sum_values, sum_weights = 0, 0
+    for net_weight, unit_price in raw:
+        sum_values += net_weight * unit_price
+        sum_weights += net_weight
     try:
-        wap = sum([tr['net_weight'] * tr['unit_price'] for tr in raw]) / sum([tr['net_weight'] for tr in raw])
+        wap = sum_values / sum_weights
     except ZeroDivisionError:
         wap = 0
     
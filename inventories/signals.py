@@ -0,0 +1,88 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from .models import Transaction, StockSnapshot, update_ledger, signed_movement
+
+
+# Sent after bulk writes of transactions (see bulk.transactions_changed), which send no model signals.
+# 'periods' maps the id of every changed material to the (since, until) span of the transaction times
+# written, it is None if transactions of any material and time may have changed.
+transactions_bulk_changed = Signal()
+
+
+def ledger_changes(instance, created):
+    """
+    Returns list of (material_id, since) tuples whose ledger is affected by saving 'instance'.
+    """
+    previous = getattr(instance, '_loaded_values', None)
+    if not previous:
+        # previous state is unknown for updates -> whole history of the material
+        return [(instance.material_id, instance.transaction_time if created else None)]
+    if all(previous[name] == getattr(instance, name) for name in previous):
+        return []
+    if previous.get('material_id', instance.material_id) != instance.material_id:
+        return [
+            (previous['material_id'], previous.get('transaction_time', instance.transaction_time)),
+            (instance.material_id, instance.transaction_time),
+        ]
+    return [(instance.material_id, min(previous.get('transaction_time', instance.transaction_time), instance.transaction_time))]
+
+
+def snapshot_changes(instance):
+    """
+    Returns list of (material_id, day, movement) tuples to be applied to daily snapshots after saving 'instance'.
+    """
+    changes = [(
+        instance.material_id,
+        StockSnapshot.local_day(instance.transaction_time),
+        signed_movement(instance.transaction_type, instance.gross_weight, instance.tare_weight)
+    )]
+    previous = getattr(instance, '_loaded_values', None)
+    if previous and len(previous) == len(Transaction.LEDGER_FIELDS):
+        changes.insert(0, (
+            previous['material_id'],
+            StockSnapshot.local_day(previous['transaction_time']),
+            -signed_movement(previous['transaction_type'], previous['gross_weight'], previous['tare_weight'])
+        ))
+    return changes
+
+
+@receiver(post_save, sender=Transaction)
+def update_ledger_on_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    for material_id, since in ledger_changes(instance, created):
+        update_ledger(material_id, since, instance=instance)
+
+
+@receiver(post_save, sender=Transaction)
+def update_stock_snapshots_on_save(sender, instance, created, raw, **kwargs):
+    if raw or not ledger_changes(instance, created):
+        return
+    if not created and len(getattr(instance, '_loaded_values', None) or {}) != len(Transaction.LEDGER_FIELDS):
+        # previous state is unknown -> rebuild the material
+        StockSnapshot.rebuild(instance.material_id)
+        return
+    rebuilt = set()
+    for material_id, day, movement in snapshot_changes(instance):
+        if material_id not in rebuilt and not StockSnapshot.apply_movement(material_id, day, movement):
+            rebuilt.add(material_id)
+
+
+@receiver(post_save, sender=Transaction)
+def reset_loaded_values(sender, instance, **kwargs):
+    instance._loaded_values = {name: getattr(instance, name) for name in Transaction.LEDGER_FIELDS}
+
+
+@receiver(post_delete, sender=Transaction)
+def update_ledger_on_delete(sender, instance, **kwargs):
+    update_ledger(instance.material_id, instance.transaction_time)
+
+
+@receiver(post_delete, sender=Transaction)
+def update_stock_snapshots_on_delete(sender, instance, **kwargs):
+    StockSnapshot.apply_movement(
+        instance.material_id,
+        StockSnapshot.local_day(instance.transaction_time),
+        -signed_movement(instance.transaction_type, instance.gross_weight, instance.tare_weight)
+    )
@@ -1,15 +1,35 @@
 import datetime
+import os
+import random
+import tempfile
+import threading
 import pytz
 
-from django.test import TestCase, Client
+from decimal import Decimal
+
+from io import StringIO
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase, Client, override_settings
 from django.urls import reverse
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.auth import get_user_model
+from django.db import connection, IntegrityError
+from django.db.transaction import atomic
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+
+from documents.models import GoodsReceiptNote, GoodsDispatchNote
+from partners.models import Vendor, Customer
 
 from .models import (
-    MaterialGroup, Material, Transaction,
-    balance, sales_and_purchases, movement_between, weighted_avg_price, period_weighted_avg_price
+    MaterialGroup, Material, Transaction, StockSnapshot,
+    balance, sales_and_purchases, movement_between, weighted_avg_price, period_weighted_avg_price,
+    weighted_avg_price_step, update_ledger, ledger_balance
 )
 
 tz = pytz.timezone(settings.TIME_ZONE)
@@ -211,6 +231,17 @@ class MaterialTests(TestCase):
         self.assertContains(response, 'alu cooler')
         self.assertTemplateUsed(response, 'inventories/inventory_list.html')
 
+
+    @override_settings(LIST_PAGE_SIZE=1)
+    def test_material_list_view_is_paginated(self):
+        Material.objects.create(name='alu can', material_group=self.material.material_group)
+        self.client.login(email='user@email.com', password='testPass123')
+        response = self.client.get(reverse('material_list'))
+        self.assertTrue(response.context['is_paginated'])
+        self.assertEqual([material.name for material in response.context['inventory_list']], ['alu can'])
+        response = self.client.get(reverse('material_list'), {'page': 2})
+        self.assertEqual([material.name for material in response.context['inventory_list']], ['alu cooler'])
+
     def test_material_detail_view_for_logged_out_user(self):
         url = self.material.get_absolute_url()
         # log-out user
@@ -596,4 +627,852 @@ class CalculationTests(TestCase):
                 tz.localize(datetime.datetime(2021,3,5)), 
                 tz.localize(datetime.datetime(2021,3,10) - datetime.timedelta(microseconds=1)), 
                 filter_by=alu
-            ), 0)   
\ No newline at end of file
+            ), 0)   
+
+
+
+class LedgerTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_1 = Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0]
+        self.mat_2 = Material.objects.get_or_create(name='alu can', material_group=mat_group)[0]
+
+        self.t1 = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,2,3)),
+            gross_weight=102.0,
+            tare_weight=2.0,
+            unit_price=10.0,
+        )
+        self.t2 = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_OUT,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,3,4)),
+            gross_weight=50.0,
+            tare_weight=0.0,
+            unit_price=30.0,
+        )
+        self.t3 = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,6,3)),
+            gross_weight=152.0,
+            tare_weight=2.0,
+            unit_price=15.0,
+        )
+
+    def assertLedgerConsistent(self, material):
+        b, wap = 0, 0
+        for transaction in Transaction.objects.filter(material=material).order_by('transaction_time', 'id'):
+            b, wap = weighted_avg_price_step(b, wap, transaction.transaction_type, transaction.net_weight, transaction.unit_price)
+            self.assertEqual(transaction.running_balance, b)
+            self.assertEqual(transaction.running_wap, wap)
+
+    def test_ledger_on_create(self):
+        self.t3.refresh_from_db()
+        self.assertEqual(self.t3.running_balance, 200)
+        self.assertEqual(self.t3.running_wap, 13.75)
+        self.assertLedgerConsistent(self.mat_1)
+
+    def test_ledger_on_back_dated_create(self):
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,3,1)),
+            gross_weight=100.0,
+            tare_weight=0.0,
+            unit_price=20.0,
+        )
+        self.t1.refresh_from_db()
+        self.t3.refresh_from_db()
+        self.assertEqual(self.t1.running_balance, 100)
+        self.assertEqual(self.t3.running_balance, 300)
+        self.assertEqual(self.t3.running_wap, 15)
+        self.assertLedgerConsistent(self.mat_1)
+
+    def test_ledger_on_edit(self):
+        self.t2.transaction_time = tz.localize(datetime.datetime(2021,7,1))
+        self.t2.save()
+        self.t3.refresh_from_db()
+        self.assertEqual(self.t3.running_balance, 250)
+        self.assertEqual(self.t3.running_wap, 13)
+        self.assertLedgerConsistent(self.mat_1)
+
+    def test_ledger_on_material_change(self):
+        self.t3.material = self.mat_2
+        self.t3.save()
+        self.assertEqual(weighted_avg_price(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1), 10)
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1), 50)
+        self.assertEqual(weighted_avg_price(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_2), 15)
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_2), 150)
+        self.assertLedgerConsistent(self.mat_1)
+        self.assertLedgerConsistent(self.mat_2)
+
+    def test_ledger_on_delete(self):
+        self.t2.delete()
+        self.t3.refresh_from_db()
+        self.assertEqual(self.t3.running_balance, 250)
+        self.assertEqual(self.t3.running_wap, 13)
+        self.assertLedgerConsistent(self.mat_1)
+
+    def test_material_delete_skips_ledger_updates(self):
+        with mock.patch('inventories.signals.update_ledger') as update, CaptureQueriesContext(connection) as queries:
+            deleted, per_model = self.mat_1.delete()
+        update.assert_not_called()
+        self.assertEqual(per_model['inventories.Transaction'], 3)
+        self.assertFalse(Transaction.objects.filter(material_id=self.mat_1.id).exists())
+        self.assertFalse(StockSnapshot.objects.filter(material_id=self.mat_1.id).exists())
+        # transactions are deleted with one query, nothing derived from them is updated
+        statements = [query['sql'] for query in queries]
+        self.assertEqual(len([sql for sql in statements if sql.startswith('DELETE FROM "inventories_transaction"')]), 1)
+        self.assertFalse([sql for sql in statements if sql.startswith('UPDATE "inventories_')])
+
+    def test_material_queryset_delete_skips_ledger_updates(self):
+        with mock.patch('inventories.signals.update_ledger') as update:
+            Material.objects.filter(pk=self.mat_1.pk).delete()
+        update.assert_not_called()
+        self.assertFalse(Transaction.objects.filter(material_id=self.mat_1.id).exists())
+
+    def test_edit_without_ledger_change_writes_nothing(self):
+        transaction = Transaction.objects.get(pk=self.t2.pk)
+        transaction.notes = 'changed notes'
+        with self.assertNumQueries(1):
+            transaction.save()
+
+    def test_incomplete_ledger_falls_back_to_replay(self):
+        Transaction.objects.update(running_balance=None, running_wap=None)
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1), 200)
+        self.assertEqual(weighted_avg_price(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1), 13.75)
+        update_ledger(self.mat_1.id)
+        self.assertLedgerConsistent(self.mat_1)
+
+    def test_lookups_are_single_queries(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(weighted_avg_price(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1), 13.75)
+        with self.assertNumQueries(1):
+            self.assertEqual(balance(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1), 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(balance(tz.localize(datetime.datetime(2021,6,5)), filter_by=self.mat_1.material_group), 200)
+
+    def test_stock_exhaustion_keeps_price(self):
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_OUT,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,7,1)),
+            gross_weight=200.0,
+            tare_weight=0.0,
+            unit_price=20.0,
+        )
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,7,2)), filter_by=self.mat_1), 0)
+        self.assertEqual(weighted_avg_price(tz.localize(datetime.datetime(2021,7,2)), filter_by=self.mat_1), 13.75)
+
+
+
+class ConcurrentLedgerTests(TransactionTestCase):
+
+    def test_interleaved_writes_leave_a_consistent_ledger(self):
+        mat_group = MaterialGroup.objects.create(name='aluminium')
+        material = Material.objects.create(name='alu cooler', material_group=mat_group)
+        start = tz.localize(datetime.datetime(2021,1,1))
+        barrier = threading.Barrier(6)
+
+        def write_transactions(seed):
+            rnd = random.Random(seed)
+            try:
+                barrier.wait()
+                for _ in range(8):
+                    # back-dated inserts replay the tail other threads are writing
+                    transaction = Transaction.objects.create(
+                        transaction_type=Transaction.TYPE_IN if rnd.random() < 0.7 else Transaction.TYPE_OUT,
+                        material=material,
+                        transaction_time=start + datetime.timedelta(hours=rnd.randint(0, 24 * 60)),
+                        gross_weight=Decimal(rnd.randint(1000, 99999)) / 100,
+                        tare_weight=Decimal(rnd.randint(0, 999)) / 100,
+                        unit_price=Decimal(rnd.randint(100, 9999)) / 100,
+                    )
+                    if rnd.random() < 0.3:
+                        transaction.delete()
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write_transactions, args=(seed,)) for seed in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(Transaction.objects.exists())
+        b, wap = 0, 0
+        for transaction in Transaction.objects.filter(material=material).order_by('transaction_time', 'id'):
+            b, wap = weighted_avg_price_step(b, wap, transaction.transaction_type, transaction.net_weight, transaction.unit_price)
+            self.assertEqual((transaction.running_balance, transaction.running_wap), (b, wap))
+        self.assertEqual(update_ledger(material.id), 0)
+
+
+class WeightedAvgPriceBackendTests(TestCase):
+
+    def setUp(self):
+        self.mat_group_1 = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_group_2 = MaterialGroup.objects.get_or_create(name = 'steel')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='alu can', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='steel can', material_group=self.mat_group_2)[0],
+        ]
+        # awkward weights and prices -> non-terminating quotients, rounding at every step
+        rnd = random.Random(7)
+        start = tz.localize(datetime.datetime(2021,1,1))
+        for i in range(120):
+            Transaction.objects.create(
+                transaction_type=Transaction.TYPE_IN if rnd.random() < 0.6 else Transaction.TYPE_OUT,
+                material=rnd.choice(self.materials),
+                transaction_time=start + datetime.timedelta(hours=rnd.randint(0, 24 * 300)),
+                gross_weight=Decimal(rnd.randint(1, 99999)) / 100,
+                tare_weight=Decimal(rnd.randint(0, 99)) / 100,
+                unit_price=Decimal(rnd.randint(1, 9999)) / 100,
+            )
+        # material lookups are served by the ledger otherwise
+        Transaction.objects.update(running_balance=None, running_wap=None)
+
+    def reference_weighted_avg_price(self, date, transactions):
+        b, wap = 0, 0
+        for transaction in transactions.filter(transaction_time__lte=date).order_by('transaction_time', 'id'):
+            b, wap = weighted_avg_price_step(b, wap, transaction.transaction_type, transaction.net_weight, transaction.unit_price)
+        return wap
+
+    @override_settings(WAP_BACKEND='postgresql')
+    def test_postgresql_backend_matches_decimal_recurrence(self):
+        filters = [
+            (None, Transaction.objects.all()),
+            (self.mat_group_1, Transaction.objects.filter(material__material_group=self.mat_group_1)),
+        ] + [(material, Transaction.objects.filter(material=material)) for material in self.materials]
+        for date in (tz.localize(datetime.datetime(2020,12,31)), tz.localize(datetime.datetime(2021,5,1)), tz.localize(datetime.datetime(2021,12,31))):
+            for filter_by, transactions in filters:
+                with self.subTest(date=date, filter_by=filter_by):
+                    expected = self.reference_weighted_avg_price(date, transactions)
+                    self.assertEqual(weighted_avg_price(date, filter_by=filter_by), expected)
+
+    @override_settings(WAP_BACKEND='postgresql')
+    def test_postgresql_backend_matches_decimal_recurrence_on_long_history(self):
+        material = Material.objects.create(name='alu wire', material_group=self.mat_group_1)
+        rnd = random.Random(0)
+        start = tz.localize(datetime.datetime(2022,1,1))
+        # runs of dispatches drive the stock negative, so later receipts amplify earlier rounding
+        Transaction.objects.bulk_create(
+            Transaction(
+                transaction_type=Transaction.TYPE_IN if rnd.random() < (0.3 if (i // 500) % 3 == 2 else 0.6) else Transaction.TYPE_OUT,
+                material=material,
+                transaction_time=start + datetime.timedelta(minutes=i),
+                gross_weight=Decimal(rnd.randint(1, 9999999)) / 100,
+                tare_weight=Decimal(rnd.randint(0, 999)) / 100,
+                unit_price=Decimal(rnd.randint(1, 999999)) / 100,
+            )
+            for i in range(6000)
+        )
+        # groups are replayed, not read from the ledger
+        transactions = Transaction.objects.filter(material__material_group=self.mat_group_1)
+        for date in [start + datetime.timedelta(minutes=minutes) for minutes in range(499, 6000, 500)]:
+            with self.subTest(date=date):
+                expected = self.reference_weighted_avg_price(date, transactions)
+                self.assertEqual(weighted_avg_price(date, filter_by=self.mat_group_1), expected)
+
+    @override_settings(WAP_BACKEND='postgresql')
+    def test_postgresql_backend_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            weighted_avg_price(tz.localize(datetime.datetime(2021,12,31)), filter_by=self.mat_group_1)
+
+
+
+class StockSnapshotTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_1 = Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0]
+        self.mat_2 = Material.objects.get_or_create(name='alu can', material_group=mat_group)[0]
+
+        self.t1 = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,2,3,10)),
+            gross_weight=102.0,
+            tare_weight=2.0,
+            unit_price=10.0,
+        )
+        self.t2 = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_OUT,
+            material=self.mat_1,
+            # local day is 2021-03-04, UTC day is 2021-03-03
+            transaction_time=tz.localize(datetime.datetime(2021,3,4,0,30)),
+            gross_weight=50.0,
+            tare_weight=0.0,
+            unit_price=30.0,
+        )
+
+    def snapshots(self, material):
+        return list(StockSnapshot.objects.filter(material=material).order_by('day').values_list('day', 'balance'))
+
+    def assertSnapshotsConsistent(self):
+        incremental = {material.id: self.snapshots(material) for material in Material.objects.all()}
+        StockSnapshot.rebuild()
+        rebuilt = {material.id: self.snapshots(material) for material in Material.objects.all()}
+        for material_id, snapshots in rebuilt.items():
+            # incremental maintenance may leave days without movement, with the same closing balance
+            expected = dict(snapshots)
+            for day, closing in incremental[material_id]:
+                previous = [b for d, b in snapshots if d <= day]
+                self.assertEqual(closing, previous[-1] if previous else 0)
+            for day, closing in expected.items():
+                self.assertIn((day, closing), incremental[material_id])
+
+    def test_snapshots_on_create(self):
+        self.assertListEqual(self.snapshots(self.mat_1), [
+            (datetime.date(2021,2,3), 100),
+            (datetime.date(2021,3,4), 50),
+        ])
+        self.assertSnapshotsConsistent()
+
+    def test_snapshots_on_back_dated_create(self):
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,2,10)),
+            gross_weight=10.0,
+            tare_weight=0.0,
+            unit_price=20.0,
+        )
+        self.assertListEqual(self.snapshots(self.mat_1), [
+            (datetime.date(2021,2,3), 100),
+            (datetime.date(2021,2,10), 110),
+            (datetime.date(2021,3,4), 60),
+        ])
+        self.assertSnapshotsConsistent()
+
+    def test_snapshots_on_edit(self):
+        self.t1.material = self.mat_2
+        self.t1.gross_weight = 52.0
+        self.t1.save()
+        self.assertListEqual(self.snapshots(self.mat_2), [
+            (datetime.date(2021,2,3), 50),
+        ])
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,3,5) - datetime.timedelta(microseconds=1)), filter_by=self.mat_1), -50)
+        self.assertSnapshotsConsistent()
+
+    def test_snapshots_on_delete(self):
+        self.t1.delete()
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,3,5) - datetime.timedelta(microseconds=1)), filter_by=self.mat_1), -50)
+        self.assertSnapshotsConsistent()
+
+    def test_balance_reads_snapshots_at_end_of_day(self):
+        end_of_day = tz.localize(datetime.datetime(2021,3,5) - datetime.timedelta(microseconds=1))
+        StockSnapshot.objects.filter(material=self.mat_1).update(balance=F('balance') + 1000)
+        self.assertEqual(balance(end_of_day, filter_by=self.mat_1), 1050)
+        self.assertEqual(balance(end_of_day, filter_by=self.mat_1.material_group), 1050)
+        # other points of time are not served from snapshots
+        self.assertEqual(balance(tz.localize(datetime.datetime(2021,3,5,12)), filter_by=self.mat_1), 50)
+
+    def test_balance_falls_back_when_snapshots_are_missing(self):
+        StockSnapshot.objects.all().delete()
+        end_of_day = tz.localize(datetime.datetime(2021,3,5) - datetime.timedelta(microseconds=1))
+        self.assertEqual(balance(end_of_day, filter_by=self.mat_1), 50)
+        # first change after a missing snapshot rebuilds the material
+        self.t2.gross_weight = 40.0
+        self.t2.save()
+        self.assertListEqual(self.snapshots(self.mat_1), [
+            (datetime.date(2021,2,3), 100),
+            (datetime.date(2021,3,4), 60),
+        ])
+
+    def test_rebuild_stock_snapshots_command(self):
+        StockSnapshot.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_stock_snapshots', stdout=out)
+        self.assertIn('2 stock snapshot(s) rebuilt.', out.getvalue())
+        self.assertListEqual(self.snapshots(self.mat_1), [
+            (datetime.date(2021,2,3), 100),
+            (datetime.date(2021,3,4), 50),
+        ])
+
+
+class QueryPlanTests(TestCase):
+    """
+    Report queries over a short span of a seeded table must be answered from an index:
+    a Seq Scan of the transactions in their plans means that no index fits the query.
+    """
+
+    def setUp(self):
+        self.mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.materials = [
+            Material.objects.get_or_create(name=f'alu {i}', material_group=self.mat_group)[0]
+            for i in range(5)
+        ]
+        rnd = random.Random(3)
+        start = tz.localize(datetime.datetime(2021,1,1))
+        Transaction.objects.bulk_create([
+            Transaction(
+                transaction_type=Transaction.TYPE_IN if rnd.random() < 0.6 else Transaction.TYPE_OUT,
+                material=rnd.choice(self.materials),
+                transaction_time=start + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 365)),
+                gross_weight=Decimal(rnd.randint(1000, 99999)) / 100,
+                tare_weight=Decimal(rnd.randint(0, 999)) / 100,
+                unit_price=Decimal(rnd.randint(100, 9999)) / 100,
+            )
+            for _ in range(5000)
+        ], batch_size=2000)
+        for material in self.materials:
+            update_ledger(material.id)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE inventories_transaction')
+        self.date_from = tz.localize(datetime.datetime(2021,6,1))
+        self.date_to = tz.localize(datetime.datetime(2021,6,7,23,59,59))
+        self.date = tz.localize(datetime.datetime(2021,1,7,12,0))
+
+    def seq_scans(self, plan):
+        """ Returns the relations read by a sequential scan in 'plan' (EXPLAIN FORMAT JSON node). """
+        result = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+        for child in plan.get('Plans', []):
+            result += self.seq_scans(child)
+        return result
+
+    def assertNoTransactionSeqScan(self, function, *args):
+        with CaptureQueriesContext(connection) as queries:
+            function(*args)
+        self.assertTrue(queries.captured_queries)
+        with connection.cursor() as cursor:
+            for query in queries.captured_queries:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {query["sql"]}')
+                plan = cursor.fetchone()[0][0]['Plan']
+                self.assertNotIn('inventories_transaction', self.seq_scans(plan), query['sql'])
+
+    def test_report_queries_use_indexes(self):
+        for filter_by in (None, self.mat_group, self.materials[0]):
+            with self.subTest(filter_by=filter_by):
+                self.assertNoTransactionSeqScan(balance, self.date, filter_by)
+                self.assertNoTransactionSeqScan(movement_between, Transaction.TYPE_IN, self.date_from, self.date_to, filter_by)
+                self.assertNoTransactionSeqScan(movement_between, Transaction.TYPE_OUT, self.date_from, self.date_to, filter_by)
+                self.assertNoTransactionSeqScan(sales_and_purchases, self.date_from, self.date_to, filter_by)
+                self.assertNoTransactionSeqScan(weighted_avg_price, self.date, filter_by)
+
+    def test_ledger_fallback_queries_use_indexes(self):
+        # without the ledger balances and prices are aggregated from the transactions
+        Transaction.objects.update(running_balance=None, running_wap=None)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE inventories_transaction')
+        for filter_by in (None, self.mat_group, self.materials[0]):
+            with self.subTest(filter_by=filter_by):
+                self.assertIsNone(ledger_balance(self.date, filter_by))
+                self.assertNoTransactionSeqScan(balance, self.date, filter_by)
+                self.assertNoTransactionSeqScan(weighted_avg_price, self.date, filter_by)
+        with override_settings(WAP_BACKEND='postgresql'):
+            self.assertNoTransactionSeqScan(weighted_avg_price, self.date, None)
+            self.assertNoTransactionSeqScan(weighted_avg_price, self.date, self.mat_group)
+
+
+class PartitionTransactionsTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_1 = Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0]
+        self.mat_2 = Material.objects.get_or_create(name='alu can', material_group=mat_group)[0]
+        rnd = random.Random(5)
+        start = tz.localize(datetime.datetime(2020,11,1))
+        for _ in range(40):
+            Transaction.objects.create(
+                transaction_type=Transaction.TYPE_IN if rnd.random() < 0.7 else Transaction.TYPE_OUT,
+                material=rnd.choice([self.mat_1, self.mat_2]),
+                transaction_time=start + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 300)),
+                gross_weight=Decimal(rnd.randint(1000, 99999)) / 100,
+                tare_weight=Decimal(rnd.randint(0, 999)) / 100,
+                unit_price=Decimal(rnd.randint(100, 9999)) / 100,
+            )
+        # a transaction exactly on a period boundary (local midnight)
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,6,1)),
+            gross_weight=10.0,
+            tare_weight=0.0,
+            unit_price=10.0,
+        )
+
+    def rows(self):
+        return list(Transaction.objects.order_by('id').values_list(
+            'id', 'transaction_type', 'material', 'transaction_time', 'gross_weight', 'tare_weight', 'unit_price',
+            'running_balance', 'running_wap'
+        ))
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                "WHERE i.inhparent = 'inventories_transaction'::regclass ORDER BY c.relname"
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def scanned_partitions(self, queryset):
+        with connection.cursor() as cursor:
+            sql, params = queryset.query.sql_with_params()
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0][0]['Plan']
+        result, nodes = set(), [plan]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Relation Name', '').startswith('inventories_transaction'):
+                result.add(node['Relation Name'])
+            nodes += node.get('Plans', [])
+        return result
+
+    def test_convert_keeps_transactions(self):
+        rows = self.rows()
+        out = StringIO()
+        call_command('partition_transactions', interval='month', ahead=1, stdout=out)
+        self.assertIn('inventories_transaction partitioned by month, 41 transaction(s) moved.', out.getvalue())
+        self.assertListEqual(self.rows(), rows)
+        partitions = self.partitions()
+        for name in ('inventories_transaction_default', 'inventories_transaction_p2020_11', 'inventories_transaction_p2021_08'):
+            self.assertIn(name, partitions)
+        # the boundary transaction belongs to the later period
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM inventories_transaction_p2021_06 WHERE transaction_time = %s", [tz.localize(datetime.datetime(2021,6,1))])
+            self.assertEqual(cursor.fetchone()[0], 1)
+            cursor.execute('SELECT count(*) FROM inventories_transaction_default')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_partitioned_table_is_writable(self):
+        call_command('partition_transactions', interval='year', stdout=StringIO())
+        t = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_OUT,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2021,3,1)),
+            gross_weight=1.0,
+            tare_weight=0.0,
+            unit_price=10.0,
+        )
+        # row moves to another partition, ledger keeps up
+        t.transaction_time = tz.localize(datetime.datetime(2020,12,1))
+        t.save()
+        t.refresh_from_db()
+        self.assertEqual(t.transaction_time, tz.localize(datetime.datetime(2020,12,1)))
+        b, wap = 0, 0
+        for transaction in Transaction.objects.filter(material=self.mat_1).order_by('transaction_time', 'id'):
+            b, wap = weighted_avg_price_step(b, wap, transaction.transaction_type, transaction.net_weight, transaction.unit_price)
+            self.assertEqual(transaction.running_balance, b)
+        # rows outside of all partitions are kept in the default partition until their partition is created
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_2,
+            transaction_time=tz.localize(datetime.datetime(2015,5,5)),
+            gross_weight=1.0,
+            tare_weight=0.0,
+            unit_price=10.0,
+        )
+        t.delete()
+        self.assertEqual(Transaction.objects.count(), 42)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM inventories_transaction_default')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_date_bounded_queries_are_pruned(self):
+        call_command('partition_transactions', interval='month', stdout=StringIO())
+        date_from = tz.localize(datetime.datetime(2021,3,1))
+        date_to = tz.localize(datetime.datetime(2021,3,31,23,59,59))
+        self.assertSetEqual(
+            self.scanned_partitions(Transaction.objects.filter(transaction_time__gte=date_from, transaction_time__lte=date_to)),
+            {'inventories_transaction_p2021_03'}
+        )
+        self.assertSetEqual(
+            self.scanned_partitions(Transaction.filtered_transactions(material=self.mat_1, date_from=date_from, date_to=date_to)),
+            {'inventories_transaction_p2021_03'}
+        )
+        self.assertNotIn(
+            'inventories_transaction_p2021_08',
+            self.scanned_partitions(Transaction.objects.filter(material=self.mat_1, transaction_time__lte=date_to))
+        )
+
+    def test_future_partitions_and_detach(self):
+        call_command('partition_transactions', interval='month', ahead=0, stdout=StringIO())
+        count = Transaction.objects.filter(transaction_time__gte=tz.localize(datetime.datetime(2021,1,1))).count()
+        out = StringIO()
+        with mock.patch('inventories.management.commands.partition_transactions.timezone.now',
+                        return_value=tz.localize(datetime.datetime(2021,11,15))):
+            call_command('partition_transactions', interval='month', ahead=2, detach_before=datetime.date(2021,1,1), stdout=out)
+        self.assertIn('Partition inventories_transaction_p2022_01 created.', out.getvalue())
+        self.assertIn('Partition inventories_transaction_p2020_12 detached.', out.getvalue())
+        self.assertNotIn('inventories_transaction_p2021_01 detached', out.getvalue())
+        partitions = self.partitions()
+        self.assertNotIn('inventories_transaction_p2020_11', partitions)
+        self.assertIn('inventories_transaction_p2021_12', partitions)
+        # the detached history is replaced by opening balances
+        self.assertEqual(Transaction.objects.exclude(notes='Opening balance').count(), count)
+
+        # repeated runs are idempotent, periods of another interval are kept
+        out = StringIO()
+        call_command('partition_transactions', interval='year', ahead=0, stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+    def test_duplicate_ids_are_rejected(self):
+        out = StringIO()
+        call_command('partition_transactions', interval='year', ahead=0, stdout=out)
+        self.assertIn('Transaction ids registered in inventories_transaction_id.', out.getvalue())
+        existing = Transaction.objects.filter(transaction_time__year=2021).first()
+        for transaction_time in (existing.transaction_time, tz.localize(datetime.datetime(2020,12,1))):
+            with self.subTest(transaction_time=transaction_time), self.assertRaises(IntegrityError), atomic():
+                Transaction.objects.bulk_create([Transaction(
+                    id=existing.id,
+                    transaction_type=Transaction.TYPE_IN,
+                    material=self.mat_1,
+                    transaction_time=transaction_time,
+                    gross_weight=1.0,
+                    unit_price=1.0,
+                )])
+        # ids of moved and deleted rows can be used again
+        existing.transaction_time = tz.localize(datetime.datetime(2020,12,1))
+        existing.save()
+        existing.delete()
+        existing.transaction_time = tz.localize(datetime.datetime(2021,2,1))
+        existing.save(force_insert=True)
+        self.assertEqual(Transaction.objects.filter(id=existing.id).count(), 1)
+
+    def test_ids_of_tables_partitioned_before_are_checked(self):
+        call_command('partition_transactions', interval='year', ahead=0, stdout=StringIO())
+        existing = Transaction.objects.first()
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE inventories_transaction_id')
+            cursor.execute('DROP FUNCTION inventories_transaction_id_update CASCADE')
+        Transaction.objects.bulk_create([Transaction(
+            id=existing.id,
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_1,
+            transaction_time=tz.localize(datetime.datetime(2015,1,1)),
+            gross_weight=1.0,
+            unit_price=1.0,
+        )])
+        with self.assertRaisesMessage(CommandError, f'Duplicate transaction id(s): {existing.id}'):
+            call_command('partition_transactions', interval='year', ahead=0, stdout=StringIO())
+
+        with connection.cursor() as cursor:
+            # the ORM deletes by id, i.e. both rows
+            cursor.execute('DELETE FROM inventories_transaction WHERE transaction_time = %s', [tz.localize(datetime.datetime(2015,1,1))])
+        out = StringIO()
+        call_command('partition_transactions', interval='year', ahead=0, stdout=out)
+        self.assertIn('Transaction ids registered in inventories_transaction_id.', out.getvalue())
+        with self.assertRaises(IntegrityError), atomic():
+            Transaction.objects.filter(pk=Transaction.objects.exclude(pk=existing.pk).first().pk).update(id=existing.id)
+
+    def ledger_state(self, material, date):
+        return Transaction.objects\
+            .filter(material=material, transaction_time__lt=date)\
+            .order_by('-transaction_time', '-id')\
+            .values_list('running_balance', 'running_wap')\
+            .first()
+
+    def test_detach_writes_opening_balances(self):
+        call_command('partition_transactions', interval='month', ahead=0, stdout=StringIO())
+        # an empty stock keeps its price
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_OUT,
+            material=self.mat_2,
+            transaction_time=tz.localize(datetime.datetime(2021,2,28,23)),
+            gross_weight=self.ledger_state(self.mat_2, tz.localize(datetime.datetime(2021,2,28,23)))[0],
+            unit_price=1.0,
+        )
+        dates = [tz.localize(datetime.datetime(2021,month,1)) for month in (1, 3, 5, 9)]
+        materials = [self.mat_1, self.mat_2]
+        balances = {(m, d): ledger_balance(d, m) for m in materials for d in dates[1:]}
+        states = {(m, d): self.ledger_state(m, d) for m in materials for d in dates[:2]}
+        self.assertEqual(states[(self.mat_2, dates[1])][0], 0)
+
+        for detach_before, cutoff in ((datetime.date(2021,1,15), dates[0]), (datetime.date(2021,3,1), dates[1])):
+            out = StringIO()
+            call_command('partition_transactions', interval='month', ahead=0, detach_before=detach_before, stdout=out)
+            name = f'inventories_transaction_before_{cutoff:%Y_%m}'
+            self.assertIn(f'Opening balances of 2 material(s) at {cutoff:%Y-%m-%d} written to {name}', out.getvalue())
+            self.assertIn(name, self.partitions())
+            self.assertFalse(Transaction.objects.filter(transaction_time__lt=cutoff).exclude(notes='Opening balance').exists())
+            for material in materials:
+                with self.subTest(cutoff=cutoff, material=material):
+                    # opening balance is exact, the price is rounded to the cent
+                    balance_before, wap_before = states[(material, cutoff)]
+                    self.assertEqual(self.ledger_state(material, cutoff), (balance_before, wap_before.quantize(Decimal('0.01'))))
+                    for date in dates[1:]:
+                        self.assertEqual(ledger_balance(date, material), balances[(material, date)])
+                    # the ledger was replayed from the opening balances
+                    self.assertEqual(update_ledger(material.id), 0)
+        # earlier opening balances are detached with the partitions
+        self.assertNotIn('inventories_transaction_before_2021_01', self.partitions())
+        self.assertIn('Partition inventories_transaction_before_2021_01 detached.', out.getvalue())
+
+    def test_detach_requires_complete_ledger_and_partitioned_history(self):
+        call_command('partition_transactions', interval='month', ahead=0, stdout=StringIO())
+        partitions = self.partitions()
+        Transaction.objects.filter(transaction_time__lt=tz.localize(datetime.datetime(2021,1,1))).update(running_wap=None)
+        with self.assertRaisesMessage(CommandError, 'The ledger is incomplete, run manage.py rebuild_ledger first.'):
+            call_command('partition_transactions', interval='month', ahead=0, detach_before=datetime.date(2021,1,1), stdout=StringIO())
+        self.assertListEqual(self.partitions(), partitions)
+
+        update_ledger(self.mat_1.id)
+        update_ledger(self.mat_2.id)
+        Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.mat_2,
+            transaction_time=tz.localize(datetime.datetime(2015,5,5)),
+            gross_weight=1.0,
+            unit_price=10.0,
+        )
+        with self.assertRaisesMessage(CommandError, 'The default partition holds 1 transaction(s) before 2021-01-01'):
+            call_command('partition_transactions', interval='month', ahead=0, detach_before=datetime.date(2021,1,1), stdout=StringIO())
+        self.assertListEqual(self.partitions(), partitions)
+
+
+
+class TransactionImportTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_1 = Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0]
+        self.mat_2 = Material.objects.get_or_create(name='alu can', material_group=mat_group)[0]
+        self.vendor = Vendor.objects.create(name='Vendor 1')
+        self.customer = Customer.objects.create(name='Customer 1')
+        self.grn = GoodsReceiptNote.objects.create(date=datetime.date(2020,3,3), vendor=self.vendor)
+        for day, gross_weight in [(2, 500), (20, 10)]:
+            Transaction.objects.create(
+                transaction_type=Transaction.TYPE_IN,
+                material=self.mat_1,
+                transaction_time=tz.localize(datetime.datetime(2020,2 if day == 2 else 3,day,12)),
+                gross_weight=gross_weight,
+                tare_weight=0.0,
+                unit_price=8.0,
+            )
+        self.user = get_user_model().objects.create_user(
+            username='importuser',
+            email='user@email.com',
+            password='testPass123'
+        )
+
+        # line 3-4: quoted notes spanning two lines, lines 8-11: invalid rows
+        self.csv = (
+            'transaction_type,material,transaction_time,gross_weight,tare_weight,unit_price,notes,note,note_date,partner\n'
+            'IN,alu cooler,2020-03-01 08:00,100.00,1.00,10.00,,A,2020-03-01,Vendor 1\n'
+            'IN,Alu Can,2020-03-01T09:00:00+01:00,50,,12.5,"first\nline",A,,\n'
+            'OUT,alu cooler,2020-03-02 10:00,20,0,0,,B,,customer 1\n'
+            f'IN,alu cooler,2020-03-03 10:00,5,0,11,tab\there,{self.grn.grn},,\n'
+            'in,alu can,2020-03-04 10:00,1,0,1,,,,\n'
+            'IN,copper,2020-03-04 10:00,1,0,1,,,,\n'
+            'OUT,alu can,2020-13-01 10:00,1,0,1,,,,\n'
+            'IN,alu can,2020-03-05 10:00,abc,0,123456.00,,,,\n'
+            'OUT,alu can,2020-03-05 10:00,1,0,1,,C,,Nobody\n'
+        )
+
+    def call_import(self, content, **options):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'transactions.csv')
+            with open(path, 'w', newline='', encoding='utf-8') as file:
+                file.write(content)
+            out, err = StringIO(), StringIO()
+            call_command('import_transactions', path, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def assert_derived_data_consistent(self):
+        for material in (self.mat_1, self.mat_2):
+            ledger = list(Transaction.objects.filter(material=material).order_by('transaction_time', 'id')
+                .values_list('running_balance', 'running_wap'))
+            self.assertNotIn(None, [balance for balance, _ in ledger])
+            Transaction.objects.filter(material=material).update(running_balance=None, running_wap=None)
+            update_ledger(material.id)
+            self.assertListEqual(ledger, list(Transaction.objects.filter(material=material)
+                .order_by('transaction_time', 'id').values_list('running_balance', 'running_wap')))
+
+            snapshots = list(StockSnapshot.objects.filter(material=material).order_by('day').values_list('day', 'balance'))
+            StockSnapshot.rebuild(material.id)
+            self.assertListEqual(snapshots, list(StockSnapshot.objects.filter(material=material)
+                .order_by('day').values_list('day', 'balance')))
+
+    def test_import_command(self):
+        out, err = self.call_import(self.csv)
+        self.assertIn('5 of 9 transaction(s) imported', out)
+        self.assertIn('2 new note(s), 4 invalid row(s)', out)
+        self.assertIn('Line 8: material: Unknown material: copper', err)
+        self.assertIn('Line 9: transaction_time: Invalid date and time', err)
+        self.assertIn('Line 10: gross_weight:', err)
+        self.assertIn('; unit_price: Ensure that there are no more than 6 digits in total.', err)
+        self.assertIn('Line 11: partner: Unknown customer: Nobody', err)
+
+        self.assertEqual(Transaction.objects.count(), 7)
+        transaction = Transaction.objects.get(material=self.mat_2, transaction_type=Transaction.TYPE_IN, gross_weight=50)
+        self.assertEqual(transaction.transaction_time, tz.localize(datetime.datetime(2020,3,1,9)))
+        self.assertEqual(transaction.tare_weight, Decimal('0.00'))
+        self.assertEqual(transaction.unit_price, Decimal('12.50'))
+        self.assertEqual(transaction.notes, 'first\nline')
+
+        # new notes are numbered in the year of their date, rows referring to a note number join it
+        grn = GoodsReceiptNote.objects.get(grn='GRN2020/000001')
+        self.assertEqual(grn.date, datetime.date(2020,3,1))
+        self.assertEqual(grn.vendor, self.vendor)
+        self.assertEqual(grn.transactions.count(), 2)
+        gdn = GoodsDispatchNote.objects.get(gdn='GDN2020/000001')
+        self.assertEqual(gdn.date, datetime.date(2020,3,2))
+        self.assertEqual(gdn.customer, self.customer)
+        self.assertQuerysetEqual(
+            self.grn.transactions.values_list('notes', flat=True), ['tab\there'], transform=lambda notes: notes
+        )
+        self.assertEqual(Transaction.objects.filter(goods_receipt_note__isnull=True, goods_dispatch_note__isnull=True).count(), 3)
+
+        self.assert_derived_data_consistent()
+
+    def test_import_in_batches(self):
+        out, _ = self.call_import(self.csv, batch_size=1)
+        self.assertIn('5 of 9 transaction(s) imported', out)
+        # rows of a note created in an earlier batch join it
+        self.assertEqual(GoodsReceiptNote.objects.get(grn='GRN2020/000001').transactions.count(), 2)
+        self.assertEqual(GoodsReceiptNote.objects.count() + GoodsDispatchNote.objects.count(), 3)
+        self.assert_derived_data_consistent()
+
+    def test_dry_run(self):
+        out, err = self.call_import(self.csv, dry_run=True)
+        self.assertIn('5 of 9 transaction(s) validated', out)
+        self.assertIn('Line 8:', err)
+        self.assertEqual(Transaction.objects.count(), 2)
+        self.assertEqual(GoodsReceiptNote.objects.count(), 1)
+        self.assertEqual(GoodsDispatchNote.objects.count(), 0)
+
+    def test_invalid_file(self):
+        with self.assertRaisesMessage(CommandError, 'Missing column(s): unit_price'):
+            self.call_import('transaction_type,material,transaction_time,gross_weight\nIN,alu can,2020-03-01 08:00,1\n')
+        with self.assertRaises(CommandError):
+            call_command('import_transactions', '/nonexistent/transactions.csv', stdout=StringIO())
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    def test_import_view(self):
+        url = reverse('transaction_import')
+        response = self.client.get(url)
+        self.assertRedirects(response, f'{reverse("account_login")}?next={url}')
+        self.client.login(email='user@email.com', password='testPass123')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        self.user.user_permissions.add(Permission.objects.get(codename='add_transaction'))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'inventories/transaction_import.html')
+
+        upload = SimpleUploadedFile('transactions.csv', ('\ufeff' + self.csv).encode('utf-8'), content_type='text/csv')
+        response = self.client.post(url, {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '5 of 9 transaction(s) imported')
+        self.assertContains(response, 'Unknown material: copper')
+        self.assertEqual(Transaction.objects.count(), 7)
+
+        upload = SimpleUploadedFile('transactions.csv', b'material\nalu can\n', content_type='text/csv')
+        response = self.client.post(url, {'file': upload})
+        self.assertContains(response, 'Missing column(s)')
+        upload = SimpleUploadedFile('transactions.csv', (self.csv + 'IN,\xe1,2020-03-06 10:00,1,0,1,,,,\n').encode('latin-1'), content_type='text/csv')
+        response = self.client.post(url, {'file': upload})
+        self.assertContains(response, 'not UTF-8 encoded')
+        self.assertEqual(Transaction.objects.count(), 7)
+
+        upload = SimpleUploadedFile('transactions.csv', self.csv.encode('utf-8'), content_type='text/csv')
+        with self.settings(TRANSACTION_IMPORT_MAX_UPLOAD_SIZE=len(self.csv) - 1):
+            response = self.client.post(url, {'file': upload})
+        self.assertContains(response, 'import it with manage.py import_transactions')
+        self.assertEqual(Transaction.objects.count(), 7)
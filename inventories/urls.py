@@ -3,6 +3,7 @@ from django.urls import path
 from .views import (
     MaterialGroupListView, MaterialGroupDetailView, MaterialGroupCreateView, MaterialGroupUpdateView, MaterialGroupDeleteView, 
     MaterialListView, MaterialDetailView, MaterialCreateView, MaterialUpdateView, MaterialDeleteView,
+    TransactionImportView,
 )
 
 urlpatterns = [
@@ -19,4 +20,7 @@ urlpatterns = [
     path('materials/new/', MaterialCreateView.as_view(), name='material_new'),
     path('materials/<uuid:pk>/edit/', MaterialUpdateView.as_view(), name='material_edit'),
     path('materials/<uuid:pk>/delete/', MaterialDeleteView.as_view(), name='material_delete'),
+
+    # Transaction import
+    path('transactions/import/', TransactionImportView.as_view(), name='transaction_import'),
 ]
\ No newline at end of file
@@ -1,7 +1,14 @@
-from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
+import codecs
+
+from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, FormView
 from django.urls import reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
+from django.core.exceptions import ValidationError
+
+from pages.pagination import PaginatedListMixin
 
+from .csv_import import TransactionImport, REQUIRED_COLUMNS, OPTIONAL_COLUMNS
+from .forms import TransactionImportForm
 from .models import MaterialGroup, Material
 
 
@@ -52,11 +59,14 @@ class MaterialGroupDeleteView(LoginRequiredMixin, PermissionRequiredMixin, Delet
 # ------------   Materials   ------------
 
 
-class MaterialListView(LoginRequiredMixin, ListView):
+class MaterialListView(LoginRequiredMixin, PaginatedListMixin, ListView):
     model = Material
     context_object_name = 'inventory_list'
     template_name = 'inventories/inventory_list.html'
-    ordering = ['name']
+    ordering = ['name', 'id']
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('material_group')
 
 
 class MaterialDetailView(LoginRequiredMixin, DetailView):
@@ -85,4 +95,34 @@ class MaterialDeleteView(LoginRequiredMixin, PermissionRequiredMixin, DeleteView
     model = Material
     context_object_name = 'item'
     template_name = 'inventories/inventory_delete.html'
-    success_url = reverse_lazy('material_list')
\ No newline at end of file
+    success_url = reverse_lazy('material_list')
+
+
+
+# ------------   Transaction import   ------------
+
+
+class TransactionImportView(LoginRequiredMixin, PermissionRequiredMixin, FormView):
+    permission_required = 'inventories.add_transaction'
+    form_class = TransactionImportForm
+    template_name = 'inventories/transaction_import.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['required_columns'] = REQUIRED_COLUMNS
+        context['optional_columns'] = OPTIONAL_COLUMNS
+        return context
+
+    def form_valid(self, form):
+        form_data = form.cleaned_data
+        try:
+            importer = TransactionImport(dry_run=form_data['dry_run'])
+            # the upload is decoded and parsed line by line, not read into memory
+            result = importer.run(codecs.iterdecode(form_data['file'], 'utf-8-sig'))
+        except ValidationError as error:
+            form.add_error('file', error)
+            return self.form_invalid(form)
+        except UnicodeDecodeError:
+            form.add_error('file', 'The file is not UTF-8 encoded.')
+            return self.form_invalid(form)
+        return self.render_to_response(self.get_context_data(form=form, result=result))
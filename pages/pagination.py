@@ -0,0 +1,128 @@
+import json
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator taking the total from the PostgreSQL planner estimate (based on the reltuples statistics)
+    instead of COUNT(*) when the estimate exceeds LIST_COUNT_ESTIMATE_THRESHOLD. Below it rows are
+    counted, at most LIST_COUNT_ESTIMATE_THRESHOLD of them, as the estimate may also be too low.
+    The estimate is corrected by the rows around the requested page (see correct_estimate): pages past
+    the last row of an overestimate fall back to the last page, the last page of an underestimate links
+    to the next one as long as rows follow.
+    """
+    count_is_estimate = False
+
+    @cached_property
+    def count(self):
+        threshold = settings.LIST_COUNT_ESTIMATE_THRESHOLD
+        estimate = self.estimated_count()
+        if estimate is None:
+            return super().count
+        if estimate < threshold:
+            count = self.object_list.order_by()[:threshold].count()
+            if count < threshold:
+                return count
+        self.count_is_estimate = True
+        return max(estimate, threshold)
+
+    def validate_number(self, number):
+        # sets count_is_estimate
+        self.count
+        if self.count_is_estimate:
+            try:
+                number = self.correct_estimate(int(number))
+            except (TypeError, ValueError):
+                # rejected by validate_number
+                pass
+        return super().validate_number(number)
+
+    def correct_estimate(self, number):
+        """ Corrects the estimated total by the rows around page 'number', returns the page to serve. """
+        if number < 1:
+            return number
+        rows = self.object_list.order_by()
+        bottom, top = (number - 1) * self.per_page, number * self.per_page
+        if number > 1 and not rows[bottom:bottom + 1].exists():
+            # fewer rows than estimated -> the total is exact now
+            self.set_count(rows[:bottom].count(), is_estimate=False)
+            return self.num_pages
+        if number >= self.num_pages:
+            if rows[top:top + 1].exists():
+                # more rows than estimated -> the next page is reachable
+                self.set_count(max(self.count, top + 1), is_estimate=True)
+            else:
+                # the requested page is the last one
+                self.set_count(bottom + rows[bottom:top].count(), is_estimate=False)
+        return number
+
+    def set_count(self, count, is_estimate):
+        self.__dict__['count'] = count
+        self.__dict__.pop('num_pages', None)
+        self.count_is_estimate = is_estimate
+
+    def estimated_count(self):
+        """ Returns the estimated number of rows of the queryset or None if there is no estimate. """
+        queryset = self.object_list
+        if not hasattr(queryset, 'query'):
+            return None
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class PaginatedListMixin:
+    """
+    Server-side pagination of list views. If 'filter_form_class' is set, the queryset is filtered
+    by the form's filter_queryset() with the GET parameters. Costly per-row annotations belong to
+    annotate_page(), keeping them out of the count.
+    """
+    paginator_class = EstimatedCountPaginator
+    filter_form_class = None
+
+    def get_paginate_by(self, queryset):
+        return settings.LIST_PAGE_SIZE
+
+    def get_filter_form(self):
+        if self.filter_form_class is None:
+            return None
+        if not hasattr(self, '_filter_form'):
+            self._filter_form = self.filter_form_class(self.request.GET or None)
+        return self._filter_form
+
+    def annotate_page(self, object_list):
+        """ Adds data needed by the rows of the current page only (not by filtering or counting). """
+        return object_list
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, object_list, is_paginated = super().paginate_queryset(queryset, page_size)
+        page.object_list = self.annotate_page(page.object_list)
+        return paginator, page, page.object_list, is_paginated
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        filter_form = self.get_filter_form()
+        if filter_form is not None and filter_form.is_valid():
+            queryset = filter_form.filter_queryset(queryset)
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['filter_form'] = self.get_filter_form()
+        # page links keep the filters
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context['query_string'] = query.urlencode()
+        return context
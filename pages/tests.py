@@ -1,8 +1,15 @@
-from django.test import TestCase, Client
+from unittest import mock
+
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, resolve
 from django.contrib.auth import get_user_model
+from django.db import connection
+
+from partners.models import Vendor
 
 from .views import HomePageView
+from .pagination import EstimatedCountPaginator
 
 
 class HomepageTests(TestCase):
@@ -37,4 +44,88 @@ class HomepageTests(TestCase):
 
     def test_homepage_url_resolves_homepageview(self):
         view = resolve('/')
-        self.assertEqual(view.func.__name__, HomePageView.as_view().__name__)
\ No newline at end of file
+        self.assertEqual(view.func.__name__, HomePageView.as_view().__name__)
+
+class EstimatedCountPaginatorTests(TestCase):
+
+    def setUp(self):
+        for i in range(30):
+            get_user_model().objects.create_user(username=f'user{i}', email=f'user{i}@email.com', password='testPass123')
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {get_user_model()._meta.db_table}')
+
+    @override_settings(LIST_COUNT_ESTIMATE_THRESHOLD=10)
+    def test_large_tables_are_not_counted(self):
+        paginator = EstimatedCountPaginator(get_user_model().objects.order_by('username'), 10)
+        with CaptureQueriesContext(connection) as queries:
+            count = paginator.count
+        self.assertTrue(paginator.count_is_estimate)
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql']])
+        self.assertEqual(count, 30)
+        self.assertEqual(len(paginator.page(2).object_list), 10)
+
+    @override_settings(LIST_COUNT_ESTIMATE_THRESHOLD=1000)
+    def test_small_tables_are_counted(self):
+        paginator = EstimatedCountPaginator(get_user_model().objects.filter(username__startswith='user1').order_by('username'), 10)
+        self.assertEqual(paginator.count, 11)
+        self.assertFalse(paginator.count_is_estimate)
+
+    @override_settings(LIST_COUNT_ESTIMATE_THRESHOLD=20)
+    def test_underestimates_are_counted_up_to_the_threshold(self):
+        paginator = EstimatedCountPaginator(get_user_model().objects.order_by('username'), 10)
+        with mock.patch.object(paginator, 'estimated_count', return_value=5), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, 20)
+        self.assertTrue(paginator.count_is_estimate)
+        self.assertIn('LIMIT 20', queries.captured_queries[-1]['sql'])
+
+    @override_settings(LIST_COUNT_ESTIMATE_THRESHOLD=10)
+    def test_pages_past_the_end_of_an_overestimate_fall_back_to_the_last_page(self):
+        paginator = EstimatedCountPaginator(get_user_model().objects.order_by('username'), 10)
+        with mock.patch.object(paginator, 'estimated_count', return_value=100):
+            self.assertEqual(paginator.num_pages, 10)
+            page = paginator.page(7)
+        self.assertEqual(page.number, 3)
+        self.assertListEqual(list(page.object_list), list(get_user_model().objects.order_by('username')[20:30]))
+        self.assertFalse(page.has_next())
+        self.assertEqual((paginator.count, paginator.num_pages), (30, 3))
+        self.assertFalse(paginator.count_is_estimate)
+
+    @override_settings(LIST_COUNT_ESTIMATE_THRESHOLD=10)
+    def test_pages_past_the_end_of_an_underestimate_are_reachable(self):
+        queryset = get_user_model().objects.order_by('username')
+        with mock.patch.object(EstimatedCountPaginator, 'estimated_count', return_value=5):
+            paginator = EstimatedCountPaginator(queryset, 10)
+            self.assertEqual(paginator.num_pages, 1)
+            page = paginator.page(1)
+            # rows follow the last estimated page
+            self.assertTrue(page.has_next())
+            self.assertTrue(paginator.count_is_estimate)
+
+            paginator = EstimatedCountPaginator(queryset, 10)
+            page = paginator.page(2)
+            self.assertListEqual(list(page.object_list), list(queryset[10:20]))
+            self.assertTrue(page.has_next())
+
+            paginator = EstimatedCountPaginator(queryset, 10)
+            page = paginator.page(3)
+            self.assertListEqual(list(page.object_list), list(queryset[20:30]))
+            self.assertFalse(page.has_next())
+            self.assertEqual((paginator.count, paginator.num_pages), (30, 3))
+            self.assertFalse(paginator.count_is_estimate)
+
+            # pages before the last estimated one cost no extra query
+            paginator = EstimatedCountPaginator(queryset, 5)
+            paginator.count
+            with self.assertNumQueries(1):
+                paginator.page(1).object_list[0]
+
+    @override_settings(LIST_COUNT_ESTIMATE_THRESHOLD=10, LIST_PAGE_SIZE=10)
+    def test_list_view_serves_last_page_past_the_end_of_an_overestimate(self):
+        for i in range(25):
+            Vendor.objects.create(name=f'Vendor {i:02d}')
+        self.client.force_login(get_user_model().objects.get(username='user0'))
+        with mock.patch.object(EstimatedCountPaginator, 'estimated_count', return_value=1000):
+            response = self.client.get(reverse('vendor_list'), {'page': 50})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].number, 3)
+        self.assertContains(response, '21-25 of 25')
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('partners', '0003_auto_20210629_1618'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='partner',
+            index=models.Index(fields=['name'], name='partner_name_idx'),
+        ),
+    ]
@@ -20,6 +20,11 @@ class Partner(models.Model):
     contact_phone = models.CharField(max_length=20, blank=True)
     contact_email = models.EmailField(blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['name'], name='partner_name_idx'),
+        ]
+
     @property
     def full_address(self):
         return f'{self.postcode} {self.city}, {self.address} ({self.country})'
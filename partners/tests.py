@@ -1,6 +1,6 @@
 # -*- coding: iso-8859-2 -*-
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import Permission
 from django.contrib.auth import get_user_model
@@ -68,6 +68,18 @@ class VendorTests(TestCase):
         self.assertContains(response, 'Test Vendor')
         self.assertTemplateUsed(response, 'partners/partner_list.html')
 
+
+    @override_settings(LIST_PAGE_SIZE=1)
+    def test_vendor_list_view_is_paginated(self):
+        Vendor.objects.create(name='Another Vendor', country='Hungary', postcode='1234', city='Budapest', address='Main street 1')
+        self.client.login(email='user@email.com', password='testPass123')
+        response = self.client.get(reverse('vendor_list'))
+        self.assertTrue(response.context['is_paginated'])
+        self.assertEqual([partner.name for partner in response.context['partner_list']], ['Another Vendor'])
+        self.assertContains(response, '?page=2')
+        response = self.client.get(reverse('vendor_list'), {'page': 2})
+        self.assertEqual([partner.name for partner in response.context['partner_list']], ['Test Vendor'])
+
     def test_vendor_detail_view_for_logged_out_user(self):
         url = self.vendor.get_absolute_url()
         # log-out user
@@ -2,6 +2,8 @@ from django.views.generic import ListView, DetailView, CreateView, UpdateView, D
 from django.urls import reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 
+from pages.pagination import PaginatedListMixin
+
 from .models import Vendor, Customer
 
 
@@ -9,11 +11,11 @@ from .models import Vendor, Customer
 # ------------   Vendors   ------------
 
 
-class VendorListView(LoginRequiredMixin, ListView):
+class VendorListView(LoginRequiredMixin, PaginatedListMixin, ListView):
     model = Vendor
     context_object_name = 'partner_list'
     template_name = 'partners/partner_list.html'
-    ordering = ['name']
+    ordering = ['name', 'id']
 
 class VendorDetailView(LoginRequiredMixin, DetailView):
     model = Vendor
@@ -48,11 +50,11 @@ class VendorDeleteView(LoginRequiredMixin, PermissionRequiredMixin, DeleteView):
 # ------------   Customers   ------------
 
 
-class CustomerListView(LoginRequiredMixin, ListView):
+class CustomerListView(LoginRequiredMixin, PaginatedListMixin, ListView):
     model = Customer
     context_object_name = 'partner_list'
     template_name = 'partners/partner_list.html'
-    ordering = ['name']
+    ordering = ['name', 'id']
     
 class CustomerDetailView(LoginRequiredMixin, DetailView):
     model = Customer
@@ -0,0 +1,96 @@
+import csv
+import io
+import json
+import zlib
+
+import pytz
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.db.models import F, ExpressionWrapper
+from django.db.models.functions import Coalesce
+
+from inventories.models import RoundHalfEven
+
+tz = pytz.timezone(settings.TIME_ZONE)
+
+# rows fetched per round trip of the server-side cursor and written per chunk of the output
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FIELDS = (
+    'id', 'transaction_time', 'transaction_type', 'material_group', 'material', 'partner',
+    'goods_receipt_note', 'goods_dispatch_note', 'gross_weight', 'tare_weight', 'net_weight',
+    'unit_price', 'net_value', 'notes', 'created_time', 'last_modified',
+)
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+
+
+def export_rows(transactions, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields a dict of EXPORT_FIELDS for every transaction of the 'transactions' queryset, in time order.
+    Material group, partner and GRN/GDN numbers are joined in SQL and rows are read through
+    a server-side cursor, so memory use does not grow with the number of transactions.
+    Times are ISO 8601 strings in settings.TIME_ZONE.
+    """
+    net_weight_exp = ExpressionWrapper(F('gross_weight') - F('tare_weight'), output_field=models.DecimalField())
+    rows = transactions\
+        .order_by('transaction_time', 'id')\
+        .annotate(
+            export_net_weight=net_weight_exp,
+            export_net_value=RoundHalfEven(ExpressionWrapper(net_weight_exp * F('unit_price'), output_field=models.DecimalField())),
+            export_partner=Coalesce('goods_receipt_note__vendor__name', 'goods_dispatch_note__customer__name'),
+        )\
+        .values_list(
+            'id', 'transaction_time', 'transaction_type', 'material__material_group__name', 'material__name',
+            'export_partner', 'goods_receipt_note__grn', 'goods_dispatch_note__gdn', 'gross_weight', 'tare_weight',
+            'export_net_weight', 'unit_price', 'export_net_value', 'notes', 'created_time', 'last_modified'
+        )\
+        .iterator(chunk_size=chunk_size)
+    for row in rows:
+        row = dict(zip(EXPORT_FIELDS, row))
+        row['id'] = str(row['id'])
+        for field in ('transaction_time', 'created_time', 'last_modified'):
+            row[field] = row[field].astimezone(tz).isoformat()
+        yield row
+
+
+def csv_stream(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Yields the CSV text of export_rows() 'rows', header first, 'chunk_size' rows at a time. """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_gzip_stream(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields export_rows() 'rows' as gzip compressed newline delimited JSON, one object per line,
+    compressed 'chunk_size' rows at a time.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)    # gzip container
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+        if len(lines) == chunk_size:
+            data = compressor.compress(''.join(lines).encode('utf-8'))
+            lines = []
+            if data:
+                yield data
+    yield compressor.compress(''.join(lines).encode('utf-8')) + compressor.flush()
+
+
+def export_stream(transactions, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """ Returns a generator of the chunks of the 'transactions' queryset exported in 'export_format'. """
+    rows = export_rows(transactions, chunk_size=chunk_size)
+    if export_format == 'ndjson':
+        return ndjson_gzip_stream(rows, chunk_size=chunk_size)
+    return csv_stream(rows, chunk_size=chunk_size)
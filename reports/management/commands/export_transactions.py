@@ -0,0 +1,101 @@
+import datetime
+import os
+import sys
+import time
+
+import pytz
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from inventories.models import Transaction, MaterialGroup, Material
+from reports.export import EXPORT_FORMATS, export_rows, csv_stream, ndjson_gzip_stream
+
+tz = pytz.timezone(settings.TIME_ZONE)
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Exports transactions joined with material group, partner and GRN/GDN numbers as CSV or gzip '
+        'compressed NDJSON, e.g. for nightly dumps. Rows are streamed from a server-side cursor, a file '
+        'is written under a temporary name and renamed when complete.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Output file, - writes to standard output.')
+        parser.add_argument(
+            '--format', choices=EXPORT_FORMATS, default='csv',
+            help='csv (default) or ndjson (gzip compressed, one JSON object per line).'
+        )
+        parser.add_argument(
+            '--transaction-type', choices=[Transaction.TYPE_IN, Transaction.TYPE_OUT], action='append',
+            help='Only transactions of this type, can be repeated.'
+        )
+        parser.add_argument('--material-group', help='Only transactions of the material group with this id.')
+        parser.add_argument('--material', help='Only transactions of the material with this id.')
+        parser.add_argument(
+            '--date-from', type=datetime.date.fromisoformat,
+            help='Only transactions on or after this date (YYYY-MM-DD).'
+        )
+        parser.add_argument(
+            '--date-to', type=datetime.date.fromisoformat,
+            help='Only transactions on or before this date (YYYY-MM-DD).'
+        )
+
+    def handle(self, *args, **options):
+        filters = {'transaction_types': options['transaction_type']}
+        for name, model in (('material_group', MaterialGroup), ('material', Material)):
+            filters[name] = None
+            if options[name] is not None:
+                try:
+                    filters[name] = model.objects.get(pk=options[name])
+                except (model.DoesNotExist, ValidationError):
+                    raise CommandError(f'{model._meta.verbose_name.capitalize()} not found: {options[name]}')
+        filters['date_from'] = None
+        if options['date_from'] is not None:
+            filters['date_from'] = tz.localize(datetime.datetime.combine(options['date_from'], datetime.time()))
+        filters['date_to'] = None
+        if options['date_to'] is not None:
+            filters['date_to'] = tz.localize(datetime.datetime.combine(options['date_to'], datetime.time.max))
+
+        count = 0
+        def counted(rows):
+            nonlocal count
+            for row in rows:
+                count += 1
+                yield row
+
+        rows = counted(export_rows(Transaction.filtered_transactions(**filters)))
+        if options['format'] == 'ndjson':
+            chunks = ndjson_gzip_stream(rows)
+        else:
+            chunks = (chunk.encode('utf-8') for chunk in csv_stream(rows))
+
+        started = time.monotonic()
+        if options['path'] == '-':
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            # readers of the file never see a partial export
+            partial_path = f'{options["path"]}.part'
+            try:
+                with open(partial_path, 'wb') as file:
+                    for chunk in chunks:
+                        file.write(chunk)
+                os.replace(partial_path, options['path'])
+            except OSError as error:
+                raise CommandError(str(error))
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+        elapsed = time.monotonic() - started
+
+        message = f'{count} transaction(s) exported in {elapsed:.1f} s.'
+        if options['path'] == '-':
+            # standard output carries the export
+            self.stderr.write(message, style_func=lambda text: text)
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from reports.models import purge_report_cache
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes cached report results older than REPORT_CACHE_TIMEOUT seconds. Expired results are '
+        'not served but stay in the database until this command runs, schedule it e.g. daily.'
+    )
+
+    def handle(self, *args, **options):
+        deleted = purge_report_cache()
+        self.stdout.write(self.style.SUCCESS(
+            f'{deleted} expired cached report(s) deleted (timeout {settings.REPORT_CACHE_TIMEOUT} s).'
+        ))
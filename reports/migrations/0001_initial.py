@@ -0,0 +1,35 @@
+# Generated by Django 3.2.4 on 2026-10-18 21:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('inventories', '0010_weighted_avg_price_aggregate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('report', models.CharField(max_length=255)),
+                ('date_from', models.DateTimeField()),
+                ('date_to', models.DateTimeField()),
+                ('cumulative', models.BooleanField(default=False)),
+                ('result', models.BinaryField()),
+                ('created_time', models.DateTimeField(auto_now=True)),
+                ('material', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventories.material')),
+                ('material_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='inventories.materialgroup')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reportcacheentry',
+            index=models.Index(fields=['date_to', 'date_from'], name='report_cache_span_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import uuid
+
+
+def delete_cached_reports(apps, schema_editor):
+    # pickled results cannot be converted, reports are recomputed on demand
+    apps.get_model('reports', 'ReportCacheEntry').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_cached_reports, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='reportcacheentry',
+            name='result',
+        ),
+        migrations.AddField(
+            model_name='reportcacheentry',
+            name='result',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='reportcacheentry',
+            name='version',
+            field=models.UUIDField(default=uuid.uuid4),
+        ),
+    ]
@@ -1,9 +1,25 @@
 import datetime
+import functools
+import hashlib
+import inspect
+import json
+import time
+import uuid
+import pytz
 from enum import Enum
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, connection
+from django.db.transaction import on_commit
+from django.utils import timezone
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import Q, F, Sum, Case, When, Value, ExpressionWrapper, OuterRef, Subquery, Exists, FilteredRelation
+from django.db.models.functions import TruncDate, TruncWeek
+
 from inventories.models import (
-    Transaction, MaterialGroup, Material,
-    balance, movement_between, sales_and_purchases, weighted_avg_price, period_weighted_avg_price
+    Transaction, MaterialGroup, Material, StockSnapshot,
+    get_q_filter, weighted_avg_price_step
 )
 
 
@@ -55,6 +71,185 @@ def datetime_range(start=None, end=None, resolution=Resolution.DAY):
             end_of_period = start_of_period + monthdelta(start_of_period, months=1) - datetime.timedelta(microseconds=1)
 
 
+class ReportCacheEntry(models.Model):
+    """
+    Cached result of a report function.
+    Rows know the material/group filter and the time span the result depends on, so that a changed
+    transaction evicts only the results it affects (see invalidate_reports).
+    """
+    key = models.CharField(max_length=64, unique=True)
+    report = models.CharField(max_length=255)
+    material = models.ForeignKey(Material, related_name='+', on_delete=models.CASCADE, null=True, blank=True)
+    material_group = models.ForeignKey(MaterialGroup, related_name='+', on_delete=models.CASCADE, null=True, blank=True)
+    date_from = models.DateTimeField()
+    date_to = models.DateTimeField()
+    # balances and prices depend on all transactions before date_to, not only those in the span
+    cumulative = models.BooleanField(default=False)
+    # JSON of the result (see ReportJSONEncoder), null while the result is being computed
+    result = models.TextField(null=True)
+    version = models.UUIDField(default=uuid.uuid4)
+    created_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_to', 'date_from'], name='report_cache_span_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.report} ({self.date_from} - {self.date_to})'
+
+
+class ReportJSONEncoder(json.JSONEncoder):
+    """ Encodes report results, datetimes as {'__datetime__': iso_string} (see report_json_object). """
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return {'__datetime__': o.isoformat()}
+        return super().default(o)
+
+
+def report_json_object(data):
+    """ object_hook of json.loads restoring the datetimes of ReportJSONEncoder. """
+    if data.keys() == {'__datetime__'}:
+        return datetime.datetime.fromisoformat(data['__datetime__'])
+    return data
+
+
+def report_cache_expiry():
+    return timezone.now() - datetime.timedelta(seconds=settings.REPORT_CACHE_TIMEOUT)
+
+
+def purge_report_cache():
+    """
+    Deletes cached reports older than REPORT_CACHE_TIMEOUT, returns their number.
+    Expired results are never served, run this periodically (manage.py purge_report_cache) to reclaim them.
+    """
+    return ReportCacheEntry.objects.filter(created_time__lt=report_cache_expiry()).delete()[0]
+
+
+def report_cache_key(report, arguments):
+    def normalized_argument(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        if isinstance(value, models.Model):
+            return f'{value.__class__.__name__}:{value.pk}'
+        if isinstance(value, Enum):
+            return value.value
+        return repr(value)
+    data = repr([report] + [(name, normalized_argument(value)) for name, value in arguments.items()])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def cached_report(resolution=None, cumulative=False):
+    """
+    Caches the results of the decorated report function in ReportCacheEntry, keyed by its arguments.
+    The cached span is widened to the periods of datetime_range at 'resolution' (or the 'resolution'
+    argument of the report), as results cover whole periods.
+    The entry is registered with a new version before the report is computed and the result is stored
+    only if that version is still there: an invalidation meanwhile deletes the entry, so results computed
+    from data changed in the meantime are never stored.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.REPORT_CACHE_ENABLED:
+                return func(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            arguments = arguments.arguments
+            key = report_cache_key(func.__name__, arguments)
+
+            cached = ReportCacheEntry.objects\
+                .filter(key=key, created_time__gte=report_cache_expiry(), result__isnull=False)\
+                .values_list('result', flat=True)\
+                .first()
+            if cached is not None:
+                return json.loads(cached, object_hook=report_json_object)
+
+            date_from, date_to = arguments['date_from'], arguments['date_to']
+            period_resolution = arguments.get('resolution', resolution)
+            periods = list(datetime_range(date_from, date_to, period_resolution)) if period_resolution else []
+            if periods:
+                date_from, date_to = periods[0][0], periods[-1][1]
+            filter_by = arguments.get('filter_by')
+            version = uuid.uuid4()
+            ReportCacheEntry.objects.update_or_create(key=key, defaults={
+                'report': func.__name__,
+                'material': filter_by if isinstance(filter_by, Material) else None,
+                'material_group': filter_by if isinstance(filter_by, MaterialGroup) else None,
+                'date_from': date_from,
+                'date_to': date_to,
+                'cumulative': cumulative,
+                'result': None,
+                'version': version,
+            })
+
+            result = func(*args, **kwargs)
+
+            ReportCacheEntry.objects\
+                .filter(key=key, version=version)\
+                .update(result=json.dumps(result, cls=ReportJSONEncoder), created_time=timezone.now())
+            return result
+
+        return wrapper
+    return decorator
+
+
+def invalidate_reports(transaction_time=None, material_id=None, until=None):
+    """
+    Evicts cached reports affected by a transaction of 'material_id' at 'transaction_time':
+    reports of all materials or of the material (or its group) whose span covers transaction_time,
+    or - for cumulative reports - ends after it. Without arguments all cached reports are evicted.
+    With 'until', transactions from 'transaction_time' to 'until' are covered at once (bulk writes).
+    Inside a database transaction the entries are evicted again on commit, as results computed
+    from the data before the commit may have been stored meanwhile.
+    """
+    entries = ReportCacheEntry.objects.all()
+    if transaction_time is not None:
+        until = until if until is not None else transaction_time
+        entries = entries.filter(Q(date_to__gte=transaction_time) & (Q(cumulative=True) | Q(date_from__lte=until)))
+    if material_id is not None:
+        entries = entries.filter(
+            Q(material__isnull=True, material_group__isnull=True) |
+            Q(material_id=material_id) |
+            Q(material_group__in=MaterialGroup.objects.filter(materials=material_id))
+        )
+    entries.delete()
+    if connection.in_atomic_block:
+        on_commit(entries.delete)
+
+
+DASHBOARD_GENERATION_KEY = 'reports:dashboard:generation'
+
+
+def dashboard_fragment_key(panel, day):
+    """
+    Returns the cache key of the rendered dashboard 'panel' of 'day' in the current dashboard generation.
+    """
+    # a lost generation restarts from the clock, never from a value used before
+    generation = cache.get_or_set(DASHBOARD_GENERATION_KEY, lambda: int(time.time() * 1000000), None)
+    return f'reports:dashboard:{panel}:{day.isoformat()}:{generation}'
+
+
+def next_dashboard_generation():
+    try:
+        cache.incr(DASHBOARD_GENERATION_KEY)
+    except ValueError:
+        cache.set(DASHBOARD_GENERATION_KEY, int(time.time() * 1000000), None)
+
+
+def invalidate_dashboard_fragments():
+    """
+    Makes all rendered dashboard fragments stale by moving to a new generation.
+    Inside a database transaction the generation moves again on commit, as fragments rendered
+    from the data before the commit may have been stored under the new generation meanwhile.
+    """
+    next_dashboard_generation()
+    if connection.in_atomic_block:
+        on_commit(next_dashboard_generation)
+
+
 def normalized(data):
     assert isinstance(data, list)
 
@@ -68,24 +263,64 @@ def normalized(data):
     return [x / sum_of_data for x in data]
 
 
+@cached_report(cumulative=True)
 def summary_report(date_from, date_to, resolution, filter_by=None):
+    """
+    Returns a list of period summaries (opening/in/out/closing quantities, prices and values).
+    Transactions of the filter are read once, ordered by time, and merged with the period
+    boundaries of datetime_range in a single pass.
+    """
     assert isinstance(date_from, datetime.datetime)
     assert isinstance(date_to, datetime.datetime)
     assert isinstance(resolution, Resolution)
     assert isinstance(filter_by, (MaterialGroup, Material)) or filter_by is None
-    
-    qty_closing = None
-    price_closing = None
+
+    periods = list(datetime_range(start=date_from, end=date_to, resolution=resolution))
+    if not periods:
+        return []
+
+    net_weight_exp = ExpressionWrapper((F('gross_weight') - F('tare_weight')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
+    transactions = Transaction.objects\
+        .filter(get_q_filter(filter_by) & Q(transaction_time__lte=periods[-1][1]))\
+        .annotate(net_weight=net_weight_exp)\
+        .order_by('transaction_time', 'id')\
+        .values_list('transaction_time', 'transaction_type', 'net_weight', 'unit_price')\
+        .iterator()
+
+    b = 0   # running balance
+    wap = 0 # running weighted average price
+    transaction = next(transactions, None)
     report = []
-    for start_of_period, end_of_period in datetime_range(start=date_from, end=date_to, resolution=resolution):
-        qty_opening = qty_closing if qty_closing is not None else balance(start_of_period - datetime.timedelta(microseconds=1), filter_by)
-        qty_in = movement_between(Transaction.TYPE_IN, start_of_period, end_of_period, filter_by)
-        qty_out = movement_between(Transaction.TYPE_OUT, start_of_period, end_of_period, filter_by)
+    for start_of_period, end_of_period in periods:
+        # replay history before the first period
+        while transaction is not None and transaction[0] < start_of_period:
+            b, wap = weighted_avg_price_step(b, wap, *transaction[1:])
+            transaction = next(transactions, None)
+        qty_opening = b
+        price_opening = wap
+        # merge transactions of the period
+        qty_in, qty_out = 0, 0
+        sum_val_in, sum_val_out = 0, 0
+        while transaction is not None and transaction[0] <= end_of_period:
+            _, transaction_type, net_weight, unit_price = transaction
+            if transaction_type == Transaction.TYPE_IN:
+                qty_in += net_weight
+                sum_val_in += net_weight * unit_price
+            else:
+                qty_out += net_weight
+                sum_val_out += net_weight * unit_price
+            b, wap = weighted_avg_price_step(b, wap, transaction_type, net_weight, unit_price)
+            transaction = next(transactions, None)
         qty_closing = qty_opening + qty_in - qty_out
-        price_opening = price_closing if price_closing is not None else weighted_avg_price(start_of_period - datetime.timedelta(microseconds=1), filter_by)
-        price_in = period_weighted_avg_price(Transaction.TYPE_IN, start_of_period, end_of_period, filter_by)
-        price_out = period_weighted_avg_price(Transaction.TYPE_OUT, start_of_period, end_of_period, filter_by)
-        price_closing = weighted_avg_price(end_of_period, filter_by)
+        try:
+            price_in = sum_val_in / qty_in
+        except ZeroDivisionError:
+            price_in = 0
+        try:
+            price_out = sum_val_out / qty_out
+        except ZeroDivisionError:
+            price_out = 0
+        price_closing = wap
         val_opening = qty_opening * price_opening
         val_in = qty_in * price_in
         val_out = qty_out * price_out
@@ -111,6 +346,125 @@ def summary_report(date_from, date_to, resolution, filter_by=None):
     return report
 
 
+def stock_level_items(by_material_group=False):
+    """
+    Returns the fields (id, name) of the items of stock_level_report, relative to MaterialGroup.
+    Rows are read from material groups joined to materials, so groups without materials are kept.
+    """
+    if by_material_group:
+        return 'id', 'name'
+    return 'materials__id', 'materials__name'
+
+
+def snapshot_stock_levels(dt_range, by_material_group=False):
+    """
+    Returns {'material_or_materialgroup_name': [list_of_daily_balances]} read from daily stock snapshots
+    or None if snapshots cannot serve the range (missing snapshots or periods not aligned to local days).
+    Snapshots within the range and the opening balance are read per material with one grouped query.
+    """
+    if not dt_range or not all(StockSnapshot.is_end_of_day(d) for _, d in dt_range):
+        return None
+    days = [StockSnapshot.local_day(d) for _, d in dt_range]
+
+    latest = StockSnapshot.objects\
+        .filter(material=OuterRef('materials__id'), day__lt=days[0])\
+        .order_by('-day')
+    in_range = Q(snapshots__day__isnull=False)
+    _, item_name = stock_level_items(by_material_group)
+    rows = MaterialGroup.objects\
+        .annotate(snapshots=FilteredRelation('materials__stock_snapshots', condition=Q(
+            materials__stock_snapshots__day__gte=days[0], materials__stock_snapshots__day__lte=days[-1]
+        )))\
+        .values('id', 'name', 'materials__id', 'materials__name')\
+        .annotate(
+            opening=Subquery(latest.values('balance')[:1]),
+            has_snapshots=Exists(StockSnapshot.objects.filter(material=OuterRef('materials__id'))),
+            has_transactions=Exists(Transaction.objects.filter(material=OuterRef('materials__id'), transaction_time__lte=dt_range[-1][1])),
+            snapshot_days=ArrayAgg('snapshots__day', filter=in_range, ordering='snapshots__day'),
+            snapshot_balances=ArrayAgg('snapshots__balance', filter=in_range, ordering='snapshots__day'),
+        )\
+        .order_by(item_name)\
+        .values_list(item_name, 'materials__id', 'opening', 'has_snapshots', 'has_transactions', 'snapshot_days', 'snapshot_balances')
+
+    result = {}
+    for name, material_id, opening, has_snapshots, has_transactions, snapshot_days, snapshot_balances in rows:
+        if has_transactions and not has_snapshots:
+            return None
+        if name is None:
+            # group without materials, by material
+            continue
+        series = result.setdefault(name, [0] * len(days))
+        if material_id is None:
+            continue
+        snapshots = dict(zip(snapshot_days, snapshot_balances))
+        b = opening or 0
+        for i, day in enumerate(days):
+            b = snapshots.get(day, b)
+            series[i] += b
+    return {name: [float(x) for x in series] for name, series in result.items()}
+
+
+def period_local_time(start_of_range, field='transaction_time'):
+    """
+    Returns 'field' (transaction_time) shifted by the UTC offset of 'start_of_range' (to be truncated in UTC).
+    datetime_range keeps the fixed offset of its start for all periods, across DST changes too,
+    so truncating this expression buckets transactions exactly into the periods of datetime_range.
+    """
+    return ExpressionWrapper(F(field) + Value(start_of_range.utcoffset()), output_field=models.DateTimeField())
+
+
+def grouped_stock_levels(dt_range, by_material_group=False):
+    """
+    Returns {'material_or_materialgroup_name': [list_of_daily_balances]} computed from one grouped query:
+    net movement per (material or group, day) within the range, with all earlier transactions collapsed
+    into an opening bucket. Names are read in the same query, items without movements are kept.
+    """
+    start_of_range = dt_range[0][0]
+    days = [d.date() for d, _ in dt_range]
+    opening_day = days[0] - datetime.timedelta(days=1)
+
+    net_weight_exp = ExpressionWrapper((F('movements__gross_weight') - F('movements__tare_weight')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
+    day_exp = Case(
+        When(movements__transaction_time__lt=start_of_range, then=Value(opening_day)),
+        default=TruncDate(period_local_time(start_of_range, 'movements__transaction_time'), tzinfo=pytz.utc),
+        output_field=models.DateField()
+    )
+    item_id, item_name = stock_level_items(by_material_group)
+    movements = MaterialGroup.objects\
+        .annotate(movements=FilteredRelation('materials__transactions', condition=Q(
+            materials__transactions__transaction_time__lte=dt_range[-1][1]
+        )))\
+        .annotate(day=day_exp)\
+        .values(item_id, item_name, 'day')\
+        .annotate(movement=Sum(Case(
+            When(movements__transaction_type=Transaction.TYPE_IN, then=net_weight_exp),
+            default=-net_weight_exp
+        )))\
+        .order_by(item_name)\
+        .values_list(item_id, item_name, 'day', 'movement')
+    names, openings, daily = {}, {}, {}
+    for pk, name, day, movement in movements:
+        if pk is None:
+            # group without materials, by material
+            continue
+        names.setdefault(pk, name)
+        if day == opening_day:
+            openings[pk] = movement
+        elif day is not None:
+            daily[(pk, day)] = movement
+
+    result = {}
+    for pk, name in names.items():
+        b = openings.get(pk, 0)
+        series = []
+        for day in days:
+            b += daily.get((pk, day), 0)
+            series.append(float(b))
+        result[name] = series
+    return result
+
+
+@cached_report(resolution=Resolution.DAY, cumulative=True)
 def stock_level_report(date_from, date_to, by_material_group=False):
     """
     Returns : {
@@ -126,16 +480,19 @@ def stock_level_report(date_from, date_to, by_material_group=False):
     dt_range = list(datetime_range(date_from, date_to))
     dates = [d for _, d in dt_range]
     result['dates'] = dates
+    # get balances from snapshots
+    balances = snapshot_stock_levels(dt_range, by_material_group)
+    if balances is not None:
+        result.update(balances)
+        return result
     # get balances
-    filters = MaterialGroup.objects.order_by('name').all() if by_material_group else Material.objects.order_by('name').all()
-    for filter_by in filters:
-        name = filter_by.name
-        balances = [float(balance(d, filter_by=filter_by)) for _, d in dt_range]
-        result[name] = balances
+    if dt_range:
+        result.update(grouped_stock_levels(dt_range, by_material_group))
 
     return result
 
 
+@cached_report(resolution=Resolution.WEEK)
 def weekly_sales_and_purchases_report(date_from, date_to):
     """
     Returns : {
@@ -149,10 +506,25 @@ def weekly_sales_and_purchases_report(date_from, date_to):
     dt_range = list(datetime_range(date_from, date_to, resolution=Resolution.WEEK))
     weeks = [f'W{d.date().isocalendar()[1]}' for d, _ in dt_range]
     result['week'] = weeks
-    # get financials
+    # get financials grouped by week
+    financials = {}
+    if dt_range:
+        net_value_exp = ExpressionWrapper(((F('gross_weight') - F('tare_weight')) * F('unit_price')), output_field=models.DecimalField(max_digits=7, decimal_places=2))
+        rows = Transaction.objects\
+            .filter(transaction_time__gte=dt_range[0][0], transaction_time__lte=dt_range[-1][1])\
+            .annotate(week=TruncWeek(period_local_time(dt_range[0][0]), tzinfo=pytz.utc))\
+            .values('week')\
+            .annotate(
+                sales=Sum(net_value_exp, filter=Q(transaction_type=Transaction.TYPE_OUT)),
+                purchases=Sum(net_value_exp, filter=Q(transaction_type=Transaction.TYPE_IN))
+            )\
+            .order_by()\
+            .values_list('week', 'sales', 'purchases')
+        for week, sales, purchases in rows:
+            financials[week.date()] = (sales or 0, -(purchases or 0))
     sales, purchases = [], []
-    for df, dt in dt_range:
-        temp = sales_and_purchases(df, dt)
+    for df, _ in dt_range:
+        temp = financials.get(df.date(), (0, 0))
         sales.append(float(temp[0]))
         purchases.append(float(temp[1]))
     result['sales'] = sales
@@ -161,6 +533,64 @@ def weekly_sales_and_purchases_report(date_from, date_to):
     return result
 
 
+@cached_report()
+def sales_and_purchases_breakdown(date_from, date_to, normalize=False):
+    """
+    Returns (report_by_material_group, report_by_material), both in the format of sales_and_purchases_report.
+    Sales and purchases are summed per material over the transactions of the period only, then merged
+    with the ordered list of material groups and materials, so groups and materials without activity are kept.
+    Group totals are added up from the material rows.
+    """
+    net_value_exp = ExpressionWrapper(
+        ((F('gross_weight') - F('tare_weight')) * F('unit_price')),
+        output_field=models.DecimalField(max_digits=7, decimal_places=2)
+    )
+    totals = {
+        material_id: (sales, purchases)
+        for material_id, sales, purchases in Transaction.objects
+            .filter(transaction_time__gte=date_from, transaction_time__lte=date_to)
+            .values('material_id')
+            .annotate(
+                sales=Sum(net_value_exp, filter=Q(transaction_type=Transaction.TYPE_OUT)),
+                purchases=Sum(net_value_exp, filter=Q(transaction_type=Transaction.TYPE_IN))
+            )
+            .order_by()
+            .values_list('material_id', 'sales', 'purchases')
+    }
+    # material groups without materials are kept by the left join (material is None)
+    rows = MaterialGroup.objects\
+        .values('id', 'name', 'materials__id', 'materials__name')\
+        .order_by('name', 'id', 'materials__name', 'materials__id')
+
+    report_material_group = {'item': [], 'sales': [], 'purchases': []}
+    report_material = {'item': [], 'sales': [], 'purchases': []}
+    material_group_id = None
+    for row in rows:
+        sales, purchases = totals.get(row['materials__id'], (None, None))
+        sales = sales or 0
+        purchases = purchases or 0
+        if row['id'] != material_group_id:
+            material_group_id = row['id']
+            report_material_group['item'].append(row['name'])
+            report_material_group['sales'].append(0)
+            report_material_group['purchases'].append(0)
+        report_material_group['sales'][-1] += sales
+        report_material_group['purchases'][-1] += purchases
+        if row['materials__id'] is not None:
+            report_material['item'].append(row['materials__name'])
+            report_material['sales'].append(float(sales))
+            report_material['purchases'].append(float(purchases))
+    report_material_group['sales'] = [float(x) for x in report_material_group['sales']]
+    report_material_group['purchases'] = [float(x) for x in report_material_group['purchases']]
+
+    if normalize:
+        for report in (report_material_group, report_material):
+            report['sales'] = normalized(report['sales'])
+            report['purchases'] = normalized(report['purchases'])
+
+    return report_material_group, report_material
+
+
 def sales_and_purchases_report(date_from, date_to, by_material_group=False, normalize=False):
     """
     Returns : {
@@ -169,23 +599,5 @@ def sales_and_purchases_report(date_from, date_to, by_material_group=False, norm
         'purchases': [list_of_period_purchaases_per_item],
     }
     """
-    result = {}
-    result['item'] = []
-    result['sales'] = []
-    result['purchases'] = []
-    
-    material_groups = MaterialGroup.objects.order_by('name').all()
-    materials = Material.objects.order_by('material_group__name','name').filter(material_group__in=material_groups)
-    filters = material_groups if by_material_group else materials
-    # filters = MaterialGroup.objects.order_by('name').all() if by_material_group else Material.objects.order_by('material_group__name','name').all()
-    for filter in filters:
-        sales, purchases = sales_and_purchases(date_from, date_to, filter_by=filter)
-        result['item'].append(filter.name)
-        result['sales'].append(float(sales))
-        result['purchases'].append(float(-purchases)) 
-    
-    if normalize: 
-        result['sales'] = normalized(result['sales'])
-        result['purchases'] = normalized(result['purchases'])
-
-    return result
\ No newline at end of file
+    report_material_group, report_material = sales_and_purchases_breakdown(date_from, date_to, normalize)
+    return report_material_group if by_material_group else report_material
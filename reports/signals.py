@@ -0,0 +1,57 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from inventories.models import Transaction, Material, MaterialGroup
+from inventories.signals import transactions_bulk_changed
+
+from .models import invalidate_reports, invalidate_dashboard_fragments
+
+
+
+@receiver(pre_save, sender=Transaction)
+def invalidate_reports_of_previous_state(sender, instance, raw, **kwargs):
+    if raw or instance._state.adding:
+        return
+    previous = getattr(instance, '_loaded_values', {})
+    if not all(field in previous for field in Transaction.LEDGER_FIELDS):
+        previous = Transaction.objects.filter(pk=instance.pk).values(*Transaction.LEDGER_FIELDS).first() or {}
+    # reports depend on the same fields as the ledger
+    instance._reports_changed = not previous or any(previous[field] != getattr(instance, field) for field in Transaction.LEDGER_FIELDS)
+    if previous and (previous['material_id'], previous['transaction_time']) != (instance.material_id, instance.transaction_time):
+        invalidate_reports(previous['transaction_time'], previous['material_id'])
+        invalidate_dashboard_fragments()
+
+
+@receiver(post_save, sender=Transaction)
+def invalidate_reports_on_save(sender, instance, created, raw, **kwargs):
+    if raw or not (created or getattr(instance, '_reports_changed', True)):
+        return
+    invalidate_reports(instance.transaction_time, instance.material_id)
+    invalidate_dashboard_fragments()
+
+
+@receiver(post_delete, sender=Transaction)
+def invalidate_reports_on_delete(sender, instance, **kwargs):
+    invalidate_reports(instance.transaction_time, instance.material_id)
+    invalidate_dashboard_fragments()
+
+
+@receiver(transactions_bulk_changed, sender=Transaction)
+def invalidate_reports_on_bulk_change(sender, periods, **kwargs):
+    if periods is None:
+        invalidate_reports()
+    else:
+        for material_id, (since, until) in periods.items():
+            invalidate_reports(since, material_id, until=until)
+    invalidate_dashboard_fragments()
+
+
+@receiver([post_save, post_delete], sender=Material)
+@receiver([post_save, post_delete], sender=MaterialGroup)
+def invalidate_all_reports(sender, **kwargs):
+    # fixtures are loaded raw, possibly before the cache table exists
+    if kwargs.get('raw'):
+        return
+    invalidate_dashboard_fragments()
+    # names and group membership appear in every report
+    invalidate_reports()
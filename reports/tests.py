@@ -1,20 +1,46 @@
+import csv
 import datetime
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
 import uuid
 import pytz
-
-from django.test import TestCase, Client
+from decimal import Decimal
+from unittest import mock
+
+from django.core import serializers
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.db import DatabaseCache
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 
-from inventories.models import MaterialGroup, Material, Transaction
+from partners.models import Vendor, Customer
+from documents.models import GoodsReceiptNote, GoodsDispatchNote
+from inventories.models import (
+    MaterialGroup, Material, Transaction, StockSnapshot,
+    balance, movement_between, weighted_avg_price, period_weighted_avg_price, sales_and_purchases
+)
+from inventories.bulk import ledger_values, transactions_changed
 
+from . import views
+from .export import EXPORT_FIELDS, export_rows, csv_stream, ndjson_gzip_stream
 from .models import (
-    Resolution,
-    datetime_range, normalized, summary_report, stock_level_report, 
-    weekly_sales_and_purchases_report, sales_and_purchases_report
+    Resolution, ReportCacheEntry, cached_report,
+    datetime_range, normalized, summary_report, stock_level_report, grouped_stock_levels,
+    weekly_sales_and_purchases_report, sales_and_purchases_report, sales_and_purchases_breakdown,
+    invalidate_dashboard_fragments
 )
 
 client = Client()
@@ -2051,3 +2077,870 @@ class SummaryFinancialsTests(TestCase):
 
     #     # Make sure status code is 302: redirect to /accounts/login/?next=/following
     #     self.assertEqual(response.status_code, 302)
+
+
+def reference_summary_report(date_from, date_to, resolution, filter_by=None):
+    """ Period-by-period implementation of summary_report, built from the inventories primitives. """
+    qty_closing = None
+    price_closing = None
+    report = []
+    for start_of_period, end_of_period in datetime_range(start=date_from, end=date_to, resolution=resolution):
+        qty_opening = qty_closing if qty_closing is not None else balance(start_of_period - datetime.timedelta(microseconds=1), filter_by)
+        qty_in = movement_between(Transaction.TYPE_IN, start_of_period, end_of_period, filter_by)
+        qty_out = movement_between(Transaction.TYPE_OUT, start_of_period, end_of_period, filter_by)
+        qty_closing = qty_opening + qty_in - qty_out
+        price_opening = price_closing if price_closing is not None else weighted_avg_price(start_of_period - datetime.timedelta(microseconds=1), filter_by)
+        price_in = period_weighted_avg_price(Transaction.TYPE_IN, start_of_period, end_of_period, filter_by)
+        price_out = period_weighted_avg_price(Transaction.TYPE_OUT, start_of_period, end_of_period, filter_by)
+        price_closing = weighted_avg_price(end_of_period, filter_by)
+        report.append({
+            'start_of_period':  start_of_period.strftime('%Y-%m-%d'),
+            'end_of_period':    end_of_period.strftime('%Y-%m-%d'),
+            'qty_opening':      round(float(qty_opening), 2),
+            'qty_in':           round(float(qty_in), 2),
+            'qty_out':          round(float(qty_out), 2),
+            'qty_closing':      round(float(qty_closing), 2),
+            'val_opening':      round(float(qty_opening * price_opening), 2),
+            'val_in':           round(float(qty_in * price_in), 2),
+            'val_out':          round(float(qty_out * price_out), 2),
+            'val_closing':      round(float(qty_closing * price_closing), 2),
+            'price_opening':    round(float(price_opening), 2),
+            'price_in':         round(float(price_in), 2),
+            'price_out':        round(float(price_out), 2),
+            'price_closing':    round(float(price_closing), 2),
+        })
+    return report
+
+
+def create_random_transactions(materials, date_from, date_to, count, seed=0):
+    rnd = random.Random(seed)
+    span = int((date_to - date_from).total_seconds())
+    transactions = []
+    for _ in range(count):
+        transaction_type = Transaction.TYPE_IN if rnd.random() < 0.6 else Transaction.TYPE_OUT
+        gross_weight = Decimal(rnd.randint(1000, 99999)) / 100
+        tare_weight = Decimal(rnd.randint(0, 999)) / 100
+        transactions.append(Transaction.objects.create(
+            transaction_type=transaction_type,
+            material=rnd.choice(materials),
+            transaction_time=date_from + datetime.timedelta(seconds=rnd.randint(0, span)),
+            gross_weight=gross_weight,
+            tare_weight=tare_weight,
+            unit_price=Decimal(rnd.randint(100, 9999)) / 100,
+        ))
+    return transactions
+
+
+@override_settings(REPORT_CACHE_ENABLED=False)
+class SummaryReportEngineTests(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.mat_group_1 = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_group_2 = MaterialGroup.objects.get_or_create(name = 'steel')[0]
+        self.mat_11 = Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group_1)[0]
+        self.mat_12 = Material.objects.get_or_create(name='alu can', material_group=self.mat_group_1)[0]
+        self.mat_21 = Material.objects.get_or_create(name='steel can', material_group=self.mat_group_2)[0]
+        # the period covers both DST changes of 2021
+        create_random_transactions(
+            [self.mat_11, self.mat_12, self.mat_21],
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=120
+        )
+
+    def test_report_matches_period_by_period_calculation(self):
+        date_from = tz.localize(datetime.datetime(2021,2,15))
+        date_to = tz.localize(datetime.datetime(2021,11,20))
+        for resolution in Resolution:
+            for filter_by in (None, self.mat_group_1, self.mat_group_2, self.mat_11, self.mat_21):
+                with self.subTest(resolution=resolution, filter_by=filter_by):
+                    self.assertListEqual(
+                        summary_report(date_from, date_to, resolution, filter_by),
+                        reference_summary_report(date_from, date_to, resolution, filter_by)
+                    )
+
+    def test_query_count_does_not_depend_on_number_of_periods(self):
+        date_from = tz.localize(datetime.datetime(2020,1,1))
+        date_to = tz.localize(datetime.datetime(2021,12,31))
+        with self.assertNumQueries(1):
+            report = summary_report(date_from, date_to, Resolution.DAY, self.mat_group_1)
+        self.assertEqual(len(report), 731)
+
+
+@override_settings(REPORT_CACHE_ENABLED=False)
+class StockLevelSnapshotTests(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.mat_group_1 = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_group_2 = MaterialGroup.objects.get_or_create(name = 'steel')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='alu can', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='steel can', material_group=self.mat_group_2)[0],
+        ]
+        create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=80
+        )
+
+    def test_snapshot_report_matches_raw_report(self):
+        date_from = tz.localize(datetime.datetime(2021,3,15))
+        date_to = tz.localize(datetime.datetime(2021,4,15))
+        for by_material_group in (True, False):
+            with self.subTest(by_material_group=by_material_group):
+                # DST changes within the range -> periods are not aligned to local days, raw fallback
+                raw = stock_level_report(date_from, date_to, by_material_group)
+                report = stock_level_report(tz.localize(datetime.datetime(2021,4,1)), date_to, by_material_group)
+                StockSnapshot.objects.all().delete()
+                self.assertDictEqual(stock_level_report(date_from, date_to, by_material_group), raw)
+                self.assertDictEqual(stock_level_report(tz.localize(datetime.datetime(2021,4,1)), date_to, by_material_group), report)
+                StockSnapshot.rebuild()
+
+    def test_snapshot_report_query_count(self):
+        date_from = tz.localize(datetime.datetime(2021,4,1))
+        date_to = tz.localize(datetime.datetime(2021,10,1))
+        with self.assertNumQueries(1):
+            stock_level_report(date_from, date_to, by_material_group=True)
+        with self.assertNumQueries(1):
+            stock_level_report(date_from, date_to, by_material_group=False)
+
+
+@override_settings(REPORT_CACHE_ENABLED=False)
+class GroupedStockLevelsTests(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.mat_group_1 = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_group_2 = MaterialGroup.objects.get_or_create(name = 'steel')[0]
+        self.mat_group_3 = MaterialGroup.objects.get_or_create(name = 'copper')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='alu can', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='steel can', material_group=self.mat_group_2)[0],
+        ]
+        Material.objects.get_or_create(name='steel wire', material_group=self.mat_group_2)
+        create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=150
+        )
+
+    def test_grouped_stock_levels_match_daily_balances(self):
+        for date_from, date_to in (
+            (tz.localize(datetime.datetime(2021,3,1)), tz.localize(datetime.datetime(2021,4,15))),
+            (tz.localize(datetime.datetime(2021,10,20)), tz.localize(datetime.datetime(2021,11,5))),
+            (tz.localize(datetime.datetime(2021,6,1)), tz.localize(datetime.datetime(2021,6,30))),
+        ):
+            dt_range = list(datetime_range(date_from, date_to))
+            for by_material_group in (True, False):
+                with self.subTest(date_from=date_from, by_material_group=by_material_group):
+                    filters = MaterialGroup.objects.order_by('name') if by_material_group else Material.objects.order_by('name')
+                    expected = {
+                        filter_by.name: [float(balance(d, filter_by=filter_by)) for _, d in dt_range]
+                        for filter_by in filters
+                    }
+                    self.assertDictEqual(grouped_stock_levels(dt_range, by_material_group), expected)
+
+    def test_stock_level_report_query_count_is_constant(self):
+        StockSnapshot.objects.all().delete()
+        for date_to in (datetime.datetime(2021,4,5), datetime.datetime(2021,10,20)):
+            for by_material_group in (True, False):
+                with self.subTest(date_to=date_to, by_material_group=by_material_group):
+                    # snapshot lookup, grouped movements with names
+                    with self.assertNumQueries(2):
+                        stock_level_report(tz.localize(datetime.datetime(2021,4,1)), tz.localize(date_to), by_material_group)
+                    # periods not aligned to local days are not looked up in snapshots
+                    with self.assertNumQueries(1):
+                        stock_level_report(tz.localize(datetime.datetime(2021,3,15)), tz.localize(date_to), by_material_group)
+
+
+@override_settings(REPORT_CACHE_ENABLED=False)
+class SalesAndPurchasesBreakdownTests(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.mat_group_1 = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_group_2 = MaterialGroup.objects.get_or_create(name = 'steel')[0]
+        MaterialGroup.objects.get_or_create(name = 'copper')
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='alu can', material_group=self.mat_group_1)[0],
+            Material.objects.get_or_create(name='steel can', material_group=self.mat_group_2)[0],
+        ]
+        Material.objects.get_or_create(name='steel wire', material_group=self.mat_group_2)
+        create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=100
+        )
+
+    def reference_report(self, date_from, date_to, by_material_group):
+        material_groups = MaterialGroup.objects.order_by('name').all()
+        materials = Material.objects.order_by('material_group__name','name').filter(material_group__in=material_groups)
+        result = {'item': [], 'sales': [], 'purchases': []}
+        for filter_by in (material_groups if by_material_group else materials):
+            sales, purchases = sales_and_purchases(date_from, date_to, filter_by=filter_by)
+            result['item'].append(filter_by.name)
+            result['sales'].append(float(sales))
+            result['purchases'].append(float(-purchases))
+        return result
+
+    def test_breakdown_matches_per_item_aggregates(self):
+        date_from = tz.localize(datetime.datetime(2021,3,1))
+        date_to = tz.localize(datetime.datetime(2021,9,1) - datetime.timedelta(microseconds=1))
+        report_material_group, report_material = sales_and_purchases_breakdown(date_from, date_to)
+        self.assertDictEqual(report_material_group, self.reference_report(date_from, date_to, True))
+        self.assertDictEqual(report_material, self.reference_report(date_from, date_to, False))
+        self.assertIn('copper', report_material_group['item'])
+        self.assertIn('steel wire', report_material['item'])
+
+    def test_breakdown_query_count(self):
+        date_from = tz.localize(datetime.datetime(2021,3,1))
+        date_to = tz.localize(datetime.datetime(2021,9,1))
+        # period totals per material, then the list of material groups and materials
+        with self.assertNumQueries(2) as queries:
+            sales_and_purchases_breakdown(date_from, date_to, normalize=True)
+        where = queries.captured_queries[0]['sql'].split(' WHERE ', 1)[-1]
+        self.assertIn('"transaction_time" >=', where)
+
+
+@override_settings(REPORT_CACHE_ENABLED=False)
+class WeeklyFinancialsEngineTests(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0],
+            Material.objects.get_or_create(name='alu can', material_group=mat_group)[0],
+        ]
+        create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2020,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=200
+        )
+
+    def test_weekly_report_matches_per_week_aggregates(self):
+        for date_from, date_to in (
+            (tz.localize(datetime.datetime(2020,2,1)), tz.localize(datetime.datetime(2021,11,30))),
+            (tz.localize(datetime.datetime(2021,7,1)), tz.localize(datetime.datetime(2021,12,15))),
+        ):
+            with self.subTest(date_from=date_from):
+                dt_range = list(datetime_range(date_from, date_to, resolution=Resolution.WEEK))
+                temp = [sales_and_purchases(df, dt) for df, dt in dt_range]
+                expected = {
+                    'week': [f'W{d.date().isocalendar()[1]}' for d, _ in dt_range],
+                    'sales': [float(x[0]) for x in temp],
+                    'purchases': [float(x[1]) for x in temp],
+                }
+                self.assertDictEqual(weekly_sales_and_purchases_report(date_from, date_to), expected)
+
+    def test_weekly_report_query_count(self):
+        with self.assertNumQueries(1):
+            weekly_sales_and_purchases_report(tz.localize(datetime.datetime(2020,1,1)), tz.localize(datetime.datetime(2021,12,31)))
+
+
+class ReportCacheTests(TestCase):
+
+    def setUp(self):
+        self.mat_group_1 = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.mat_group_2 = MaterialGroup.objects.get_or_create(name = 'steel')[0]
+        self.mat_1 = Material.objects.get_or_create(name='alu can', material_group=self.mat_group_1)[0]
+        self.mat_2 = Material.objects.get_or_create(name='steel can', material_group=self.mat_group_2)[0]
+        self.transaction = self.create_transaction(self.mat_1, datetime.datetime(2021,7,5))
+        self.create_transaction(self.mat_2, datetime.datetime(2021,7,6))
+        self.date_from = tz.localize(datetime.datetime(2021,7,1))
+        self.date_to = tz.localize(datetime.datetime(2021,7,31))
+
+    def create_transaction(self, material, transaction_time, transaction_type=Transaction.TYPE_IN):
+        return Transaction.objects.create(
+            transaction_type=transaction_type,
+            material=material,
+            transaction_time=tz.localize(transaction_time),
+            gross_weight=10.0,
+            tare_weight=0.0,
+            unit_price=5.0,
+        )
+
+    def cached_reports(self):
+        return sorted(ReportCacheEntry.objects.values_list('report', flat=True))
+
+    def test_repeated_report_is_served_from_cache(self):
+        report = summary_report(self.date_from, self.date_to, Resolution.WEEK, filter_by=self.mat_1)
+        with self.assertNumQueries(1):
+            self.assertListEqual(summary_report(self.date_from, self.date_to, Resolution.WEEK, filter_by=self.mat_1), report)
+        with self.assertNumQueries(1):
+            self.assertListEqual(summary_report(self.date_from, self.date_to, resolution=Resolution.WEEK, filter_by=self.mat_1), report)
+
+    def test_report_is_recomputed_after_invalidation(self):
+        report = summary_report(self.date_from, self.date_to, Resolution.MONTH, filter_by=self.mat_1)
+        self.assertEqual(report[0]['qty_in'], 10)
+        self.create_transaction(self.mat_1, datetime.datetime(2021,7,20))
+        report = summary_report(self.date_from, self.date_to, Resolution.MONTH, filter_by=self.mat_1)
+        self.assertEqual(report[0]['qty_in'], 20)
+
+    def test_other_materials_do_not_invalidate(self):
+        summary_report(self.date_from, self.date_to, Resolution.DAY, filter_by=self.mat_1)
+        summary_report(self.date_from, self.date_to, Resolution.DAY, filter_by=self.mat_group_1)
+        self.create_transaction(self.mat_2, datetime.datetime(2021,7,10))
+        self.assertListEqual(self.cached_reports(), ['summary_report', 'summary_report'])
+        self.create_transaction(self.mat_1, datetime.datetime(2021,7,10))
+        self.assertListEqual(self.cached_reports(), [])
+
+    def test_only_covering_spans_are_invalidated(self):
+        weekly_sales_and_purchases_report(self.date_from, self.date_to)
+        stock_level_report(self.date_from, self.date_to)
+        sales_and_purchases_report(self.date_from, self.date_to)
+        # after all spans (the weekly report runs until Sunday 2021-08-01)
+        self.create_transaction(self.mat_1, datetime.datetime(2021,8,2))
+        self.assertListEqual(self.cached_reports(), ['sales_and_purchases_breakdown', 'stock_level_report', 'weekly_sales_and_purchases_report'])
+        # in the last week only
+        self.create_transaction(self.mat_1, datetime.datetime(2021,8,1,12))
+        self.assertListEqual(self.cached_reports(), ['sales_and_purchases_breakdown', 'stock_level_report'])
+        # before all spans: balances change
+        self.create_transaction(self.mat_1, datetime.datetime(2021,6,1))
+        self.assertListEqual(self.cached_reports(), ['sales_and_purchases_breakdown'])
+
+    def test_moving_a_transaction_out_of_a_span_invalidates(self):
+        sales_and_purchases_report(self.date_from, self.date_to)
+        self.transaction.transaction_time = tz.localize(datetime.datetime(2021,9,1))
+        self.transaction.save()
+        self.assertListEqual(self.cached_reports(), [])
+
+    def test_deleting_a_transaction_invalidates(self):
+        stock_level_report(self.date_from, self.date_to)
+        self.transaction.delete()
+        self.assertListEqual(self.cached_reports(), [])
+
+    def test_bulk_writes_invalidate(self):
+        summary_report(self.date_from, self.date_to, Resolution.DAY, filter_by=self.mat_2)
+        sales_and_purchases_report(self.date_from, self.date_to)
+        self.transaction.refresh_from_db()
+        previous = [ledger_values(self.transaction)]
+        # bypasses signals
+        Transaction.objects.filter(pk=self.transaction.pk).update(gross_weight=20.0)
+        self.transaction.refresh_from_db()
+        transactions_changed(previous, [ledger_values(self.transaction)])
+        self.assertListEqual(self.cached_reports(), ['summary_report'])
+
+    def test_renaming_a_material_invalidates_all(self):
+        summary_report(self.date_from, self.date_to, Resolution.DAY, filter_by=self.mat_2)
+        stock_level_report(self.date_from, self.date_to)
+        self.mat_1.name = 'alu cooler'
+        self.mat_1.save()
+        self.assertListEqual(self.cached_reports(), [])
+
+    def test_raw_saves_do_not_invalidate(self):
+        stock_level_report(self.date_from, self.date_to)
+        # as done by loaddata
+        for obj in serializers.deserialize('json', serializers.serialize('json', [self.mat_group_1, self.mat_1])):
+            obj.save()
+        self.assertListEqual(self.cached_reports(), ['stock_level_report'])
+
+    def test_expired_results_are_recomputed(self):
+        self.assertEqual(min(weekly_sales_and_purchases_report(self.date_from, self.date_to)['purchases']), -100)
+        # bypasses signals
+        Transaction.objects.filter(pk=self.transaction.pk).update(unit_price=6.0)
+        self.assertEqual(min(weekly_sales_and_purchases_report(self.date_from, self.date_to)['purchases']), -100)
+        with self.settings(REPORT_CACHE_TIMEOUT=0):
+            self.assertEqual(min(weekly_sales_and_purchases_report(self.date_from, self.date_to)['purchases']), -110)
+
+    def test_results_are_stored_as_json(self):
+        report = stock_level_report(self.date_from, self.date_to)
+        stored = json.loads(ReportCacheEntry.objects.get().result)
+        self.assertEqual(stored['dates'][0], {'__datetime__': report['dates'][0].isoformat()})
+        cached = stock_level_report(self.date_from, self.date_to)
+        self.assertDictEqual(cached, report)
+        self.assertListEqual(list(cached), list(report))
+
+    def test_result_invalidated_while_computing_is_not_stored(self):
+        @cached_report()
+        def report(date_from, date_to):
+            qty_in = summary_report(date_from, date_to, Resolution.MONTH, filter_by=self.mat_1)[0]['qty_in']
+            # written by another request meanwhile
+            self.create_transaction(self.mat_1, datetime.datetime(2021,7,20))
+            return qty_in
+
+        self.assertEqual(report(self.date_from, self.date_to), 10)
+        self.assertListEqual(self.cached_reports(), [])
+        self.assertEqual(report(self.date_from, self.date_to), 20)
+
+    def test_results_stored_before_commit_are_invalidated_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_transaction(self.mat_1, datetime.datetime(2021,7,20))
+            # computed by another request from the data before the commit
+            summary_report(self.date_from, self.date_to, Resolution.MONTH, filter_by=self.mat_1)
+            self.assertListEqual(self.cached_reports(), ['summary_report'])
+        self.assertListEqual(self.cached_reports(), [])
+
+    def test_purge_deletes_expired_results_only(self):
+        summary_report(self.date_from, self.date_to, Resolution.MONTH, filter_by=self.mat_1)
+        stock_level_report(self.date_from, self.date_to)
+        ReportCacheEntry.objects\
+            .filter(report='stock_level_report')\
+            .update(created_time=timezone.now() - datetime.timedelta(seconds=settings.REPORT_CACHE_TIMEOUT + 1))
+        # lookups do not delete expired results
+        summary_report(self.date_from, self.date_to, Resolution.MONTH, filter_by=self.mat_2)
+        self.assertListEqual(self.cached_reports(), ['stock_level_report', 'summary_report', 'summary_report'])
+        out = io.StringIO()
+        call_command('purge_report_cache', stdout=out)
+        self.assertIn('1 expired cached report(s) deleted', out.getvalue())
+        self.assertListEqual(self.cached_reports(), ['summary_report', 'summary_report'])
+
+
+class DashboardFragmentCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.manager_permission = Permission.objects.get(codename='can_view_all_transactions')
+        self.users = []
+        for i in range(2):
+            user = get_user_model().objects.create_user(
+                username=f'manager{i}',
+                email=f'manager{i}@email.com',
+                password='testPass123'
+            )
+            user.user_permissions.add(self.manager_permission)
+            self.users.append(user)
+        self.mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.material = Material.objects.get_or_create(name='alu can', material_group=self.mat_group)[0]
+
+    def get_panels(self, email):
+        client = Client()
+        client.login(email=email, password='testPass123')
+        for url in ('get_stock_levels', 'get_weekly_financials', 'get_summary_financials'):
+            response = client.get(reverse(url))
+            self.assertEqual(response.status_code, 200)
+            self.assertTemplateUsed(response, 'reports/dashboard_content.html')
+
+    def count_reports(self, email):
+        with mock.patch.object(views, 'stock_level_report', wraps=views.stock_level_report) as stock_level_report,\
+                mock.patch.object(views, 'weekly_sales_and_purchases_report', wraps=views.weekly_sales_and_purchases_report) as weekly_report,\
+                mock.patch.object(views, 'sales_and_purchases_breakdown', wraps=views.sales_and_purchases_breakdown) as breakdown:
+            self.get_panels(email)
+        return stock_level_report.call_count + weekly_report.call_count + breakdown.call_count
+
+    def test_fragments_are_shared_between_users(self):
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+        self.assertEqual(self.count_reports('manager0@email.com'), 0)
+        self.assertEqual(self.count_reports('manager1@email.com'), 0)
+
+    def test_transaction_writes_invalidate_fragments(self):
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+        transaction = Transaction.objects.create(
+            transaction_type=Transaction.TYPE_IN,
+            material=self.material,
+            transaction_time=tz.localize(datetime.datetime.now()),
+            gross_weight=10.0,
+            unit_price=5.0,
+        )
+        self.assertEqual(self.count_reports('manager1@email.com'), 3)
+        self.assertEqual(self.count_reports('manager1@email.com'), 0)
+        transaction.delete()
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+
+    def test_fragments_are_shared_between_processes(self):
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+        # cache connection of another worker process
+        other = DatabaseCache(settings.CACHES['default']['LOCATION'], {})
+        with mock.patch.object(views, 'cache', other), mock.patch('reports.models.cache', other):
+            self.assertEqual(self.count_reports('manager1@email.com'), 0)
+            invalidate_dashboard_fragments()
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+
+    def test_fragments_rendered_before_commit_are_invalidated_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Transaction.objects.create(
+                transaction_type=Transaction.TYPE_IN,
+                material=self.material,
+                transaction_time=tz.localize(datetime.datetime.now()),
+                gross_weight=10.0,
+                unit_price=5.0,
+            )
+            # rendered by another request from the data before the commit
+            self.assertEqual(self.count_reports('manager0@email.com'), 3)
+            self.assertEqual(self.count_reports('manager0@email.com'), 0)
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+
+    @override_settings(DASHBOARD_CACHE_TIMEOUT=0)
+    def test_fragments_expire(self):
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+        self.assertEqual(self.count_reports('manager0@email.com'), 3)
+
+
+class StreamingTransactionsTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0],
+            Material.objects.get_or_create(name='alu can', material_group=mat_group)[0],
+        ]
+        create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=30
+        )
+        user = get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        user.user_permissions.add(Permission.objects.get(codename='can_view_all_transactions'))
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def test_json_array_stream_matches_json_encoding(self):
+        items = [{'a': Decimal('1.50'), 'b': tz.localize(datetime.datetime(2021,1,1))}, {'c': None}, [1, 'x']]
+        for count in range(len(items) + 1):
+            for chunk_size in (1, 2, 100):
+                with self.subTest(count=count, chunk_size=chunk_size):
+                    self.assertEqual(
+                        ''.join(views.json_array_stream(iter(items[:count]), chunk_size=chunk_size)),
+                        views.JsonResponse(items[:count], safe=False).content.decode()
+                    )
+
+    def test_streamed_transactions_match_json_response(self):
+        for params in (
+            {},
+            {'material': self.materials[0].id, 'transaction_types': ['IN']},
+            {'date_from': '2021-03-01', 'date_to': '2021-06-30'},
+        ):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('get_transactions'), params)
+                streamed = self.client.get(reverse('get_transactions'), {**params, 'stream': '1'})
+                self.assertTrue(streamed.streaming)
+                self.assertEqual(streamed['Content-Type'], 'application/json')
+                self.assertEqual(b''.join(streamed.streaming_content), response.content)
+
+
+class BulkSerializeTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0],
+            Material.objects.get_or_create(name='alu can', material_group=mat_group)[0],
+        ]
+        transactions = create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=20
+        )
+        vendor = Vendor.objects.create(name='Scrap Vendor Ltd', country='HU', postcode='1234', city='Budapest', address='Main street 1')
+        customer = Customer.objects.create(name='Foundry Customer Ltd', country='HU', postcode='1234', city='Budapest', address='Main street 2')
+        grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,5,1), vendor=vendor)
+        gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,5,1), customer=customer)
+        Transaction.objects.filter(pk__in=[t.pk for t in transactions[:3]]).update(goods_receipt_note=grn)
+        Transaction.objects.filter(pk__in=[t.pk for t in transactions[3:5]]).update(goods_dispatch_note=gdn)
+        Transaction.objects.filter(pk=transactions[5].pk).update(notes='wet scrap')
+        # net values on a tie of rounding: 0.125 -> 0.12, 0.135 -> 0.14, -0.125 -> -0.12
+        for transaction, (gross, tare, price) in zip(transactions[6:], (
+            ('0.25', '0.00', '0.50'), ('0.27', '0.00', '0.50'), ('0.00', '0.25', '0.50'),
+            ('1.05', '0.00', '0.05'), ('99999.99', '0.01', '0.01'),
+        )):
+            Transaction.objects.filter(pk=transaction.pk).update(
+                gross_weight=Decimal(gross), tare_weight=Decimal(tare), unit_price=Decimal(price)
+            )
+
+    def test_bulk_serialize_matches_serialize(self):
+        transactions = Transaction.objects.order_by('-transaction_time')
+        expected = [transaction.serialize() for transaction in transactions]
+        for chunk_size in (None, 3):
+            with self.subTest(chunk_size=chunk_size):
+                rows = list(Transaction.bulk_serialize(transactions, chunk_size=chunk_size))
+                self.assertEqual(rows, expected)
+                self.assertEqual(
+                    views.JsonResponse(rows, safe=False).content,
+                    views.JsonResponse(expected, safe=False).content
+                )
+
+    def test_bulk_serialize_uses_one_query(self):
+        with self.assertNumQueries(1):
+            rows = list(Transaction.bulk_serialize(Transaction.objects.all()))
+        self.assertEqual(len(rows), 20)
+
+
+class TransactionsPagingTests(TestCase):
+
+    def setUp(self):
+        mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=mat_group)[0],
+            Material.objects.get_or_create(name='alu can', material_group=mat_group)[0],
+        ]
+        self.transactions = create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=40
+        )
+        # ties on transaction_time are broken by id
+        for transaction in self.transactions[:5]:
+            transaction.transaction_time = tz.localize(datetime.datetime(2021,6,1,12))
+            transaction.save()
+        vendor = Vendor.objects.create(name='Scrap Vendor Ltd', country='HU', postcode='1234', city='Budapest', address='Main street 1')
+        customer = Customer.objects.create(name='Foundry Customer Ltd', country='HU', postcode='1234', city='Budapest', address='Main street 2')
+        grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,5,1), vendor=vendor)
+        gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,5,1), customer=customer)
+        Transaction.objects.filter(pk__in=[t.pk for t in self.transactions[5:8]]).update(goods_receipt_note=grn)
+        Transaction.objects.filter(pk__in=[t.pk for t in self.transactions[8:10]]).update(goods_dispatch_note=gdn)
+        Transaction.objects.filter(pk=self.transactions[10].pk).update(notes='wet scrap')
+
+        user = get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        user.user_permissions.add(Permission.objects.get(codename='can_view_all_transactions'))
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def get_page(self, **params):
+        response = self.client.get(reverse('get_transactions'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_keyset_pages_cover_all_transactions_in_order(self):
+        for order in ('desc', 'asc'):
+            with self.subTest(order=order):
+                expected = Transaction.objects.order_by(*[f'{"-" if order == "desc" else ""}{f}' for f in ('transaction_time', 'id')])
+                ids, after, offset = [], None, 0
+                while True:
+                    params = {'limit': 7, 'offset': offset, 'sort': 'transaction_time', 'order': order}
+                    if after:
+                        params['after'] = after
+                    page = self.get_page(**params)
+                    self.assertEqual(page['total'], 40)
+                    ids += [row['id'] for row in page['rows']]
+                    offset += 7
+                    after = page['next']
+                    if not after:
+                        break
+                self.assertListEqual(ids, [str(t.id) for t in expected])
+                # offset pages agree with keyset pages
+                page = self.get_page(limit=7, offset=14, sort='transaction_time', order=order)
+                self.assertListEqual([row['id'] for row in page['rows']], ids[14:21])
+
+    def test_keyset_pages_in_every_sort_order(self):
+        # ties on the sort column, partners are NULL for most rows
+        Transaction.objects.filter(pk__in=[t.pk for t in self.transactions[20:26]]).update(unit_price=9.99)
+        for sort in views.TRANSACTION_SORT_FIELDS:
+            for order in ('desc', 'asc'):
+                with self.subTest(sort=sort, order=order):
+                    expected = [row['id'] for row in self.get_page(limit=40, offset=0, sort=sort, order=order)['rows']]
+                    ids, after, offset = [], None, 0
+                    while True:
+                        params = {'limit': 6, 'offset': offset, 'sort': sort, 'order': order}
+                        if after:
+                            params['after'] = after
+                        page = self.get_page(**params)
+                        ids += [row['id'] for row in page['rows']]
+                        offset += 6
+                        after = page['next']
+                        if not after:
+                            break
+                    self.assertEqual(len(expected), 40)
+                    self.assertListEqual(ids, expected)
+
+    def test_total_is_counted_for_the_first_page_only(self):
+        first = self.get_page(limit=7, offset=0, sort='material', order='asc')
+        self.assertEqual(first['total'], 40)
+        self.assertNotIn('cursor_0', first['rows'][0])
+        with CaptureQueriesContext(connection) as queries:
+            page = self.get_page(limit=7, offset=7, sort='material', order='asc', after=first['next'], total=first['total'])
+        self.assertEqual(page['total'], 40)
+        self.assertFalse([query for query in queries.captured_queries if 'COUNT(' in query['sql'] or 'EXPLAIN' in query['sql']])
+        # a total that is too low is raised while rows follow, an estimate that is too high ends at the last row
+        self.assertEqual(self.get_page(limit=7, offset=7, total=10)['total'], 15)
+        self.assertEqual(self.get_page(limit=7, offset=35, total=100)['total'], 40)
+
+    def test_default_order_is_newest_first(self):
+        page = self.get_page(limit=10, offset=0)
+        expected = Transaction.objects.order_by('-transaction_time', '-id')[:10]
+        self.assertListEqual([row['id'] for row in page['rows']], [str(t.id) for t in expected])
+
+    def test_sorting_by_whitelisted_columns(self):
+        page = self.get_page(limit=40, offset=0, sort='net_value', order='asc')
+        values = [row['net_value'] for row in page['rows']]
+        self.assertListEqual(values, sorted(values, key=Decimal))
+        self.assertIsNone(page['next'])
+        page = self.get_page(limit=40, offset=0, sort='partner', order='desc')
+        self.assertListEqual([row['partner'] for row in page['rows'][:5]], ['Scrap Vendor Ltd'] * 3 + ['Foundry Customer Ltd'] * 2)
+
+    def test_search_on_notes_material_and_partner(self):
+        self.assertEqual(self.get_page(limit=10, search='vendor')['total'], 3)
+        self.assertEqual(self.get_page(limit=10, search='FOUNDRY')['total'], 2)
+        self.assertEqual(self.get_page(limit=10, search='wet')['total'], 1)
+        self.assertEqual(
+            self.get_page(limit=10, search='cooler')['total'],
+            Transaction.objects.filter(material=self.materials[0]).count()
+        )
+
+    def test_invalid_parameters(self):
+        for params in (
+            {'limit': 0},
+            {'limit': 10000},
+            {'limit': 'x'},
+            {'limit': 10, 'offset': -1},
+            {'limit': 10, 'sort': 'created_time'},
+            {'limit': 10, 'sort': 'material', 'order': 'up'},
+            {'limit': 10, 'after': 'abc'},
+            {'limit': 10, 'after': '["2021-06-01T12:00:00+02:00"]'},
+            {'limit': 10, 'after': '["not a time", "abc"]'},
+            {'limit': 10, 'offset': 10, 'total': 'x'},
+        ):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('get_transactions'), params)
+                self.assertEqual(response.status_code, 400)
+
+
+class TransactionExportTests(TestCase):
+
+    def setUp(self):
+        self.mat_group = MaterialGroup.objects.get_or_create(name = 'aluminium')[0]
+        self.materials = [
+            Material.objects.get_or_create(name='alu cooler', material_group=self.mat_group)[0],
+            Material.objects.get_or_create(name='alu can', material_group=self.mat_group)[0],
+        ]
+        self.transactions = create_random_transactions(
+            self.materials,
+            tz.localize(datetime.datetime(2021,1,1)),
+            tz.localize(datetime.datetime(2021,12,31)),
+            count=20
+        )
+        vendor = Vendor.objects.create(name='Scrap Vendor Ltd', country='HU', postcode='1234', city='Budapest', address='Main street 1')
+        customer = Customer.objects.create(name='Foundry Customer Ltd', country='HU', postcode='1234', city='Budapest', address='Main street 2')
+        self.grn = GoodsReceiptNote.objects.create(date=datetime.date(2021,5,1), vendor=vendor)
+        self.gdn = GoodsDispatchNote.objects.create(date=datetime.date(2021,5,1), customer=customer)
+        Transaction.objects.filter(pk=self.transactions[0].pk).update(goods_receipt_note=self.grn, notes='wet, "mixed"\nscrap')
+        Transaction.objects.filter(pk=self.transactions[1].pk).update(goods_dispatch_note=self.gdn)
+
+        user = get_user_model().objects.create_user(
+            username='authorizeruser', 
+            email='user@email.com', 
+            password='testPass123'
+        )
+        user.user_permissions.add(Permission.objects.get(codename='can_view_all_transactions'))
+        self.client.login(email='user@email.com', password='testPass123')
+
+    def expected_rows(self, transactions):
+        return [
+            {
+                'id': str(t.id),
+                'transaction_time': t.transaction_time.astimezone(tz).isoformat(),
+                'transaction_type': t.transaction_type,
+                'material_group': t.material.material_group.name,
+                'material': t.material.name,
+                'partner': t.partner_name,
+                'goods_receipt_note': t.goods_receipt_note.grn if t.goods_receipt_note else None,
+                'goods_dispatch_note': t.goods_dispatch_note.gdn if t.goods_dispatch_note else None,
+                'gross_weight': t.gross_weight,
+                'tare_weight': t.tare_weight,
+                'net_weight': t.net_weight,
+                'unit_price': t.unit_price,
+                'net_value': t.net_value,
+                'notes': t.notes,
+                'created_time': t.created_time.astimezone(tz).isoformat(),
+                'last_modified': t.last_modified.astimezone(tz).isoformat(),
+            }
+            for t in transactions.order_by('transaction_time', 'id')
+        ]
+
+    def test_export_rows(self):
+        with mock.patch.object(connection, 'chunked_cursor', wraps=connection.chunked_cursor) as chunked_cursor:
+            rows = list(export_rows(Transaction.objects.all(), chunk_size=3))
+        # read through a server-side cursor
+        chunked_cursor.assert_called_once()
+        self.assertEqual(rows, self.expected_rows(Transaction.objects.all()))
+        self.assertEqual(rows[[row['id'] for row in rows].index(str(self.transactions[0].id))]['goods_receipt_note'], self.grn.grn)
+        self.assertEqual(rows[[row['id'] for row in rows].index(str(self.transactions[1].id))]['partner'], 'Foundry Customer Ltd')
+
+    def test_streams_are_chunked(self):
+        rows = self.expected_rows(Transaction.objects.all())
+        chunks = list(csv_stream(iter(rows), chunk_size=5))
+        self.assertEqual(len(chunks), 5)
+        parsed = list(csv.DictReader(io.StringIO(''.join(chunks))))
+        self.assertEqual(len(parsed), 20)
+        self.assertEqual(list(parsed[0]), list(EXPORT_FIELDS))
+
+        chunks = list(ndjson_gzip_stream(iter(rows), chunk_size=5))
+        lines = gzip.decompress(b''.join(chunks)).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [row['id'] for row in rows])
+        self.assertEqual(gzip.decompress(b''.join(ndjson_gzip_stream(iter([])))), b'')
+
+    def test_export_csv_view(self):
+        params = {'material': self.materials[0].id, 'transaction_types': ['IN'], 'date_from': '2021-03-01', 'date_to': '2021-10-31'}
+        response = self.client.get(reverse('export_transactions'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertRegex(response['Content-Disposition'], r'^attachment; filename="transactions_\d{8}_\d{6}\.csv"$')
+
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        expected = self.expected_rows(Transaction.filtered_transactions(
+            transaction_types=['IN'], material=self.materials[0],
+            date_from=tz.localize(datetime.datetime(2021,3,1)), date_to=tz.localize(datetime.datetime(2021,10,31))
+        ))
+        self.assertTrue(expected)
+        self.assertEqual(rows, [{k: '' if v is None else str(v) for k, v in row.items()} for row in expected])
+
+    def test_export_ndjson_view(self):
+        response = self.client.get(reverse('export_transactions'), {'format': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue(response['Content-Disposition'].endswith('.ndjson.gz"'))
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode('utf-8').splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            json.loads(views.JsonResponse(self.expected_rows(Transaction.objects.all()), safe=False).content)
+        )
+
+    def test_export_view_errors(self):
+        for params, status in (
+            ({'format': 'xml'}, 404),
+            ({'material': uuid.uuid4()}, 404),
+            ({'transaction_types': ['XX']}, 404),
+            ({'date_from': '2021-13-01'}, 400),
+        ):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('export_transactions'), params)
+                self.assertEqual(response.status_code, status)
+        response = self.client.post(reverse('export_transactions'))
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.get(reverse('export_transactions'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_export_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'transactions.csv')
+            out = io.StringIO()
+            call_command(
+                'export_transactions', path, material_group=str(self.mat_group.id), transaction_type=['OUT'],
+                date_from=datetime.date(2021,2,1), date_to=datetime.date(2021,11,30), stdout=out
+            )
+            expected = self.expected_rows(Transaction.filtered_transactions(
+                transaction_types=['OUT'], material_group=self.mat_group,
+                date_from=tz.localize(datetime.datetime(2021,2,1)),
+                date_to=tz.localize(datetime.datetime(2021,11,30,23,59,59,999999))
+            ))
+            self.assertIn(f'{len(expected)} transaction(s) exported', out.getvalue())
+            with open(path, newline='', encoding='utf-8') as file:
+                rows = list(csv.DictReader(file))
+            self.assertEqual([row['id'] for row in rows], [row['id'] for row in expected])
+
+            path = os.path.join(directory, 'transactions.ndjson.gz')
+            call_command('export_transactions', path, format='ndjson', stdout=io.StringIO())
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                self.assertEqual(len(file.readlines()), 20)
+            self.assertListEqual(sorted(os.listdir(directory)), ['transactions.csv', 'transactions.ndjson.gz'])
+
+            with self.assertRaisesMessage(CommandError, 'Material not found'):
+                call_command('export_transactions', path, material='abc', stdout=io.StringIO())
@@ -3,7 +3,7 @@ from django.urls import path
 from .views import (
     DashboardView, TransactionsView, SummaryView, 
     get_stock_levels, get_weekly_sales_and_purchases, get_summary_sales_and_purchases, get_user_statuses,
-    get_summary, get_transactions, get_material_groups, get_materials
+    get_summary, get_transactions, export_transactions, get_material_groups, get_materials
 )
 
 urlpatterns = [
@@ -17,6 +17,7 @@ urlpatterns = [
     path('get-user-statuses/', get_user_statuses, name='get_user_statuses'), 
     path('get-summary/', get_summary, name='get_summary'), 
     path('get-transactions/', get_transactions, name='get_transactions'),    
+    path('export-transactions/', export_transactions, name='export_transactions'),
     path('get-material-groups/', get_material_groups, name='get_material_groups'), 
     path('get-materials/<str:material_group_id>', get_materials, name='get_materials'), 
 ]
\ No newline at end of file
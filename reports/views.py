@@ -1,8 +1,14 @@
 import datetime
+import json
 import pytz
 from math import pi
 
-from django.http import JsonResponse
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, F, ExpressionWrapper, DecimalField
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.generic import TemplateView
 from django.shortcuts import render
 from django.conf import settings
@@ -19,14 +25,160 @@ from bokeh.palettes import viridis
 from bokeh.transform import cumsum
 
 from inventories.models import Transaction, MaterialGroup, Material
+from pages.pagination import EstimatedCountPaginator
+from reports.export import EXPORT_FORMATS, export_stream
 from reports.models import (
     Resolution, 
     summary_report, 
-    stock_level_report, weekly_sales_and_purchases_report, sales_and_purchases_report
+    stock_level_report, weekly_sales_and_purchases_report, sales_and_purchases_breakdown,
+    dashboard_fragment_key
 )
 
 tz = pytz.timezone(settings.TIME_ZONE)
 
+# rows fetched per round trip of the server-side cursor when streaming
+STREAM_CHUNK_SIZE = 2000
+
+# server-side pagination of the transactions report (Bootstrap Table)
+MAX_PAGE_SIZE = 500
+TRANSACTION_SORT_FIELDS = {
+    'transaction_time':     'transaction_time',
+    'transaction_type':     'transaction_type',
+    'partner':              'partner_sort',
+    'material_group':       'material__material_group__name',
+    'material':             'material__name',
+    'net_weight':           'net_weight_sort',
+    'unit_price':           'unit_price',
+    'net_value':            'net_value_sort',
+}
+TRANSACTION_NULLABLE_SORT_FIELDS = ('partner_sort',)
+
+
+
+def cached_dashboard_fragment(panel, build):
+    """
+    Returns the (script, div) pair of a dashboard panel.
+    'build' renders it once per day, the result is shared by all users until transactions change
+    or DASHBOARD_CACHE_TIMEOUT expires.
+    """
+    key = dashboard_fragment_key(panel, datetime.datetime.now().date())
+    fragment = cache.get(key)
+    if fragment is None:
+        fragment = build()
+        cache.set(key, fragment, settings.DASHBOARD_CACHE_TIMEOUT)
+    return fragment
+
+
+def json_array_stream(items, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the JSON array of 'items' piece by piece, encoded exactly like JsonResponse would encode the list.
+    """
+    yield '['
+    separator = ''
+    buffer = []
+    for item in items:
+        buffer.append(separator + json.dumps(item, cls=DjangoJSONEncoder))
+        separator = ', '
+        if len(buffer) == chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+    yield ''.join(buffer) + ']'
+
+
+def keyset_filter(fields, values, lookup, nullable=()):
+    """
+    Returns the Q of the rows following 'values' in the order of 'fields' ('lookup' is 'lt' for descending,
+    'gt' for ascending order, nulls last). The last field must be unique, fields in 'nullable' may be NULL.
+    """
+    q = Q(**{f'{fields[-1]}__{lookup}': values[-1]})
+    for field, value in reversed(list(zip(fields[:-1], values[:-1]))):
+        if value is None:
+            q = Q(**{f'{field}__isnull': True}) & q
+            continue
+        following = Q(**{f'{field}__{lookup}': value}) | (Q(**{field: value}) & q)
+        if field in nullable:
+            following |= Q(**{f'{field}__isnull': True})
+        q = following
+    return q
+
+
+def encode_cursor(values):
+    """ Returns the 'next' cursor of a page from the sort key values of its last row. """
+    return json.dumps([
+        value.isoformat() if isinstance(value, datetime.datetime) else None if value is None else str(value)
+        for value in values
+    ])
+
+
+def decode_cursor(cursor, length):
+    """ Returns the sort key values of an encode_cursor() cursor, raises ValueError if it is invalid. """
+    try:
+        values = json.loads(cursor)
+    except ValueError:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != length or not all(v is None or isinstance(v, str) for v in values):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def transactions_page(transactions, search=None, sort=None, order='desc', offset=0, limit=MAX_PAGE_SIZE, after=None, total=None):
+    """
+    Returns a page of 'transactions' for Bootstrap Table's server-side mode: {'total', 'rows', 'next'}.
+    Pages are read by keyset in every order: 'after' is the 'next' cursor of the previous page (sort key
+    of its last row, with transaction time and id as tiebreakers). Without a cursor the page is read by offset.
+    The total is counted (or estimated, see EstimatedCountPaginator) unless the 'total' returned
+    for an earlier page of the same query is passed. Raises ValueError for an invalid cursor.
+    """
+    if search:
+        transactions = transactions.filter(
+            Q(notes__icontains=search) |
+            Q(material__name__icontains=search) |
+            Q(goods_receipt_note__vendor__name__icontains=search) |
+            Q(goods_dispatch_note__customer__name__icontains=search)
+        )
+
+    sort = sort or 'transaction_time'
+    if sort != 'transaction_time':
+        transactions = transactions.annotate(
+            partner_sort=Coalesce('goods_receipt_note__vendor__name', 'goods_dispatch_note__customer__name'),
+            net_weight_sort=ExpressionWrapper(F('gross_weight') - F('tare_weight'), output_field=DecimalField()),
+            net_value_sort=ExpressionWrapper((F('gross_weight') - F('tare_weight')) * F('unit_price'), output_field=DecimalField()),
+        )
+    key_fields = list(dict.fromkeys((TRANSACTION_SORT_FIELDS[sort], 'transaction_time', 'id')))
+    ordering = [F(field).desc(nulls_last=True) if order == 'desc' else F(field).asc(nulls_last=True) for field in key_fields]
+    transactions = transactions.order_by(*ordering)
+
+    if total is None:
+        total = EstimatedCountPaginator(transactions, limit).count
+
+    cursor_fields = [f'cursor_{i}' for i in range(len(key_fields))]
+    transactions = transactions.annotate(**{name: F(field) for name, field in zip(cursor_fields, key_fields)})
+    if after is not None:
+        values = decode_cursor(after, len(key_fields))
+        try:
+            transactions = transactions.filter(keyset_filter(
+                key_fields, values, 'lt' if order == 'desc' else 'gt', nullable=TRANSACTION_NULLABLE_SORT_FIELDS
+            ))
+        except ValidationError:
+            raise ValueError('Invalid cursor')
+    else:
+        transactions = transactions[offset:]
+    # one row more tells whether there is a next page
+    page = list(Transaction.bulk_serialize(transactions[:limit + 1], extra_fields=cursor_fields))
+    has_next = len(page) > limit
+    page = page[:limit]
+    keys = [[row.pop(name) for name in cursor_fields] for row in page]
+
+    # an estimated total may be off: keep the next page reachable, end at the last row
+    if has_next:
+        total = max(total, offset + limit + 1)
+    else:
+        total = offset + len(page)
+    return {
+        'total': total,
+        'rows': page,
+        'next': encode_cursor(keys[-1]) if has_next else None,
+    }
 
 
 class DashboardView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
@@ -73,31 +225,26 @@ def get_materials(request, material_group_id):
     return JsonResponse(materials, safe=False) 
 
 
-@login_required
-@permission_required('inventories.can_view_all_transactions', raise_exception=True)
-def get_transactions(request):
-
-    # only GET method is accepted
-    if request.method != "GET":
-        return JsonResponse({"error": "GET request required."}, status=400) 
-
-    # check inputs
-    data = request.GET
+def transaction_filters(data):
+    """
+    Reads the transaction filters of get_transactions and export_transactions from the query 'data'.
+    Returns (keyword arguments of Transaction.filtered_transactions, None) or (None, error response).
+    """
     # transaction type
     transaction_types = data.getlist('transaction_types')
 
     if transaction_types:
         if isinstance(transaction_types, list):
             if not set(transaction_types).issubset(set([Transaction.TYPE_IN, Transaction.TYPE_OUT, ''])):
-                return JsonResponse({"error": "Transaction Type not found."}, status=404)
+                return None, JsonResponse({"error": "Transaction Type not found."}, status=404)
         elif transaction_types not in (Transaction.TYPE_IN, Transaction.TYPE_OUT):
-            return JsonResponse({"error": "Transaction Type not found."}, status=404)
+            return None, JsonResponse({"error": "Transaction Type not found."}, status=404)
     # material group
     if data.get('material_group') is not None:
         try:
             material_group = MaterialGroup.objects.get(pk=data['material_group']) 
         except MaterialGroup.DoesNotExist:
-            return JsonResponse({"error": "Material Group not found."}, status=404)
+            return None, JsonResponse({"error": "Material Group not found."}, status=404)
     else:
         material_group = None
     # material
@@ -105,7 +252,7 @@ def get_transactions(request):
         try:
             material = Material.objects.get(pk=data['material']) 
         except Material.DoesNotExist:
-            return JsonResponse({"error": "Material not found."}, status=404)
+            return None, JsonResponse({"error": "Material not found."}, status=404)
     else:
         material = None
     # start date
@@ -115,7 +262,7 @@ def get_transactions(request):
             if date_from.tzinfo is None:
                 date_from = tz.localize(date_from)
         except ValueError:
-            return JsonResponse({"error": "Invalid date"}, status=400)
+            return None, JsonResponse({"error": "Invalid date"}, status=400)
     else:
         date_from = None
     # end date
@@ -125,21 +272,104 @@ def get_transactions(request):
             if date_to.tzinfo is None:
                 date_to = tz.localize(date_to)
         except ValueError:
-            return JsonResponse({"error": "Invalid date"}, status=400)
+            return None, JsonResponse({"error": "Invalid date"}, status=400)
     else:
         date_to = None
-    
-    result = Transaction.serialized_filtered_transactions(
-        transaction_types=transaction_types,
-        material_group=material_group,
-        material=material,
-        date_from=date_from,
-        date_to=date_to
-    )
+
+    filters = {
+        'transaction_types': transaction_types,
+        'material_group': material_group,
+        'material': material,
+        'date_from': date_from,
+        'date_to': date_to,
+    }
+    return filters, None
+
+
+@login_required
+@permission_required('inventories.can_view_all_transactions', raise_exception=True)
+def get_transactions(request):
+
+    # only GET method is accepted
+    if request.method != "GET":
+        return JsonResponse({"error": "GET request required."}, status=400) 
+
+    # check inputs
+    data = request.GET
+    filters, error = transaction_filters(data)
+    if error is not None:
+        return error
+
+    # server-side pagination mode (Bootstrap Table)
+    if data.get('limit') is not None:
+        try:
+            limit = int(data['limit'])
+            offset = int(data.get('offset', 0))
+        except ValueError:
+            return JsonResponse({"error": "Invalid page"}, status=400)
+        if not 0 < limit <= MAX_PAGE_SIZE or offset < 0:
+            return JsonResponse({"error": "Invalid page"}, status=400)
+        sort = data.get('sort') or None
+        if sort is not None and sort not in TRANSACTION_SORT_FIELDS:
+            return JsonResponse({"error": "Invalid sort column"}, status=400)
+        order = data.get('order') or 'desc'
+        if order not in ('asc', 'desc'):
+            return JsonResponse({"error": "Invalid sort order"}, status=400)
+        # total of the first page of the same query, echoed back by the client
+        total = None
+        if offset > 0 and data.get('total'):
+            try:
+                total = int(data['total'])
+            except ValueError:
+                return JsonResponse({"error": "Invalid total"}, status=400)
+        transactions = Transaction.filtered_transactions(**filters)
+        try:
+            result = transactions_page(transactions, data.get('search'), sort, order, offset, limit, data.get('after') or None, total)
+        except ValueError:
+            return JsonResponse({"error": "Invalid cursor"}, status=400)
+        return JsonResponse(result)
+
+    # streaming mode: rows are read with a server-side cursor and written as they come
+    if data.get('stream') in ('1', 'true'):
+        transactions = Transaction.filtered_transactions(**filters)
+        rows = Transaction.bulk_serialize(transactions, chunk_size=STREAM_CHUNK_SIZE)
+        return StreamingHttpResponse(json_array_stream(rows), content_type='application/json')
+
+    result = Transaction.serialized_filtered_transactions(**filters)
 
     return JsonResponse(result, safe=False) 
 
 
+@login_required
+@permission_required('inventories.can_view_all_transactions', raise_exception=True)
+def export_transactions(request):
+    """
+    Streams the transactions selected by the filters of get_transactions as a CSV file ('format=csv', default)
+    or a gzip compressed NDJSON file ('format=ndjson'), see reports.export.
+    """
+    # only GET method is accepted
+    if request.method != "GET":
+        return JsonResponse({"error": "GET request required."}, status=400) 
+
+    data = request.GET
+    export_format = data.get('format') or 'csv'
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({"error": "Format not found."}, status=404)
+    filters, error = transaction_filters(data)
+    if error is not None:
+        return error
+
+    transactions = Transaction.filtered_transactions(**filters)
+    if export_format == 'ndjson':
+        content_type, extension = 'application/gzip', 'ndjson.gz'
+    else:
+        content_type, extension = 'text/csv; charset=utf-8', 'csv'
+    response = StreamingHttpResponse(export_stream(transactions, export_format), content_type=content_type)
+    filename = f'transactions_{datetime.datetime.now(tz).strftime("%Y%m%d_%H%M%S")}.{extension}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 @login_required
 @permission_required('inventories.can_view_all_transactions', raise_exception=True)
 def get_summary(request):
@@ -198,13 +428,7 @@ def get_summary(request):
     return JsonResponse(result, safe=False)
 
 
-@login_required
-@permission_required('inventories.can_view_all_transactions', raise_exception=True)
-def get_stock_levels(request):
-    # only GET method is accepted
-    if request.method != "GET":
-        return JsonResponse({"error": "GET request required."}, status=400) 
-
+def stock_levels_fragment():
     date_from = tz.localize(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=30))
     date_to = tz.localize(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1, microseconds=-1))
     report = stock_level_report(date_from, date_to, by_material_group=True)
@@ -256,20 +480,24 @@ def get_stock_levels(request):
         tab = Panel(child=plot, title=key)   
         chart_tabs.tabs.append(tab)
 
-    script, div = components(chart_tabs)
-
-    return render(request, 'reports/dashboard_content.html', 
-        {'div': div, 'script':script}
-    )
+    return components(chart_tabs)
 
 
 @login_required
 @permission_required('inventories.can_view_all_transactions', raise_exception=True)
-def get_weekly_sales_and_purchases(request):
+def get_stock_levels(request):
     # only GET method is accepted
     if request.method != "GET":
         return JsonResponse({"error": "GET request required."}, status=400) 
 
+    script, div = cached_dashboard_fragment('stock_levels', stock_levels_fragment)
+
+    return render(request, 'reports/dashboard_content.html', 
+        {'div': div, 'script':script}
+    )
+
+
+def weekly_sales_and_purchases_fragment():
     date_from = tz.localize(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=30))
     # min_timestamp = date_from.timestamp() * 1000
     date_to = tz.localize(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1, microseconds=-1))
@@ -342,16 +570,24 @@ def get_weekly_sales_and_purchases(request):
     )
     plot.yaxis.formatter = NumeralTickFormatter(format="0,0")
 
-    script, div = components(plot)
+    return components(plot)
+
+
+@login_required
+@permission_required('inventories.can_view_all_transactions', raise_exception=True)
+def get_weekly_sales_and_purchases(request):
+    # only GET method is accepted
+    if request.method != "GET":
+        return JsonResponse({"error": "GET request required."}, status=400) 
+
+    script, div = cached_dashboard_fragment('weekly_sales_and_purchases', weekly_sales_and_purchases_fragment)
 
     return render(request, 'reports/dashboard_content.html', 
         {'div': div, 'script':script}
     )
 
 
-@login_required
-@permission_required('inventories.can_view_all_transactions', raise_exception=True)
-def get_summary_sales_and_purchases(request):
+def summary_sales_and_purchases_fragment():
 
     def get_plot(report_material_group, report_material, field):
         hover = HoverTool(
@@ -435,11 +671,6 @@ def get_summary_sales_and_purchases(request):
 
         return plot
 
-
-    # only GET method is accepted
-    if request.method != "GET":
-        return JsonResponse({"error": "GET request required."}, status=400) 
-    
     date_from = tz.localize(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=30))
     # min_timestamp = date_from.timestamp() * 1000
     date_to = tz.localize(datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1, microseconds=-1))
@@ -448,8 +679,7 @@ def get_summary_sales_and_purchases(request):
     chart_tabs = Tabs()
 
     # get report data
-    report_material_group = sales_and_purchases_report(date_from, date_to, by_material_group=True, normalize=False)
-    report_material = sales_and_purchases_report(date_from, date_to, by_material_group=False, normalize=False)
+    report_material_group, report_material = sales_and_purchases_breakdown(date_from, date_to, normalize=False)
 
     # get plots
     plot_sales = get_plot(report_material_group, report_material, 'sales')
@@ -459,7 +689,17 @@ def get_summary_sales_and_purchases(request):
     tab_purchases = Panel(child=plot_purchases, title='Purchases')   
     chart_tabs.tabs = [tab_sales, tab_purchases]
 
-    script, div = components(chart_tabs)
+    return components(chart_tabs)
+
+
+@login_required
+@permission_required('inventories.can_view_all_transactions', raise_exception=True)
+def get_summary_sales_and_purchases(request):
+    # only GET method is accepted
+    if request.method != "GET":
+        return JsonResponse({"error": "GET request required."}, status=400) 
+
+    script, div = cached_dashboard_fragment('summary_sales_and_purchases', summary_sales_and_purchases_fragment)
 
     return render(request, 'reports/dashboard_content.html', 
         {'div': div, 'script':script}
@@ -1,4 +1,6 @@
 const pdfButton = document.getElementById("pdf-button");
+// milliseconds between job status requests
+const PDF_POLL_INTERVAL = 1000;
 
 document.addEventListener('DOMContentLoaded', function() {
     pdfButton.addEventListener('click', (event) => {
@@ -17,7 +19,9 @@ function updatePdfButton() {
         pdfButton.className = 'btn btn-primary btn-sm mx-3';
         pdfButton.setAttribute('href', `${uuid}/pdf`);
     } else {
-        pdfButton.innerHTML = 'Create PDF';
+        // data of a stale pdf has changed since it was rendered
+        const pdfStale = (parseInt(pdfButton.dataset.pdfStale) == 1 ? true : false);
+        pdfButton.innerHTML = pdfStale ? 'Update PDF' : 'Create PDF';
         pdfButton.className = 'btn btn-success btn-sm mx-3';
     }
 }
@@ -31,6 +35,10 @@ function onPdfButtonClicked(event) {
     } else {
         // generate pdf
         event.preventDefault();
+        if (pdfButton.dataset.pdfPending == "1") {
+            // already queued, wait for it
+            return;
+        }
 
         const csrftoken = getCookie('csrftoken');
         fetch(`generate/${uuid}`, {
@@ -45,12 +53,12 @@ function onPdfButtonClicked(event) {
                 throw response;
             }
         })
-        .then(doc => {
-            // update button data attribute
-            pdfButton.dataset.pdfExists = "1"
-            updatePdfButton();
-            // open pdf in new tab
-            window.open(`${uuid}/pdf`, '_blank').focus();
+        .then(job => {
+            // pdf is rendered in the background -> poll the job until it is finished
+            pdfButton.dataset.pdfPending = "1";
+            pdfButton.innerHTML = 'Creating PDF...';
+            pdfButton.className = 'btn btn-secondary btn-sm mx-3 disabled';
+            pollPdfJob(job.status_url, job, uuid);
         })
         // Catch any errors and log them to the console
         .catch(error => {
@@ -60,6 +68,47 @@ function onPdfButtonClicked(event) {
 }
 
 
+function pollPdfJob(statusUrl, job, uuid) {
+    if (job.status == 'done') {
+        // update button data attribute
+        pdfButton.dataset.pdfPending = "0";
+        pdfButton.dataset.pdfExists = "1"
+        pdfButton.dataset.pdfStale = "0"
+        updatePdfButton();
+        // open pdf in new tab
+        window.open(`${uuid}/pdf`, '_blank').focus();
+        return;
+    }
+    if (job.status == 'failed') {
+        pdfButton.dataset.pdfPending = "0";
+        updatePdfButton();
+        console.log('Error:', job.error);
+        return;
+    }
+    if (job.status == 'queued' && job.queued_ahead > 0) {
+        pdfButton.innerHTML = `Creating PDF... (${job.queued_ahead} ahead)`;
+    } else {
+        pdfButton.innerHTML = 'Creating PDF...';
+    }
+    setTimeout(() => {
+        fetch(statusUrl, { credentials: 'same-origin' })
+        .then(response => {
+            if (response.ok) {
+                return response.json();
+            } else {
+                throw response;
+            }
+        })
+        .then(job => pollPdfJob(statusUrl, job, uuid))
+        .catch(error => {
+            pdfButton.dataset.pdfPending = "0";
+            updatePdfButton();
+            console.log('Error:', error);
+        });
+    }, PDF_POLL_INTERVAL);
+}
+
+
 // The following function are copying from 
 // https://docs.djangoproject.com/en/dev/ref/csrf/#ajax
 function getCookie(name) {
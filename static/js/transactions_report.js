@@ -6,10 +6,18 @@ const materialSelect = document.getElementById("material");
 const dateFromBox = document.getElementById("date-from");
 const dateToBox = document.getElementById("date-to");
 const resultsTable = $('#results-table');
+const exportCsvLink = document.getElementById("export-csv");
+const exportNdjsonLink = document.getElementById("export-ndjson");
 
 var DateTime = luxon.DateTime; // https://moment.github.io/luxon/#/install
 const ALL_VALUES_ID = 'all';
 
+// keyset cursors of the pages read with the current query: offset -> 'next' cursor of the previous page
+var pageCursors = {};
+var pageCursorsQuery = '';
+// total of the current query, counted for its first page only
+var pageTotal = null;
+
 document.addEventListener('DOMContentLoaded', function() {
 
     // fill Date boxes
@@ -205,6 +213,32 @@ function ajaxRequest(params) {
             searchParams.append('material', material);
         }
         transactionTypes.forEach(t => searchParams.append('transaction_types', t))
+        // exports download every transaction matching the filters
+        exportCsvLink.href = `/reports/export-transactions/?${searchParams.toString()}&format=csv`;
+        exportNdjsonLink.href = `/reports/export-transactions/?${searchParams.toString()}&format=ndjson`;
+        // server-side search and sorting
+        if (params.data.search) {
+            searchParams.append('search', params.data.search);
+        }
+        if (params.data.sort) {
+            searchParams.append('sort', params.data.sort);
+            searchParams.append('order', params.data.order);
+        }
+        // cursors are valid for the same query only
+        if (searchParams.toString() !== pageCursorsQuery) {
+            pageCursors = {};
+            pageCursorsQuery = searchParams.toString();
+            pageTotal = null;
+        }
+        // server-side pagination
+        searchParams.append('offset', params.data.offset);
+        searchParams.append('limit', params.data.limit);
+        if (pageCursors[params.data.offset]) {
+            searchParams.append('after', pageCursors[params.data.offset]);
+        }
+        if (params.data.offset > 0 && pageTotal !== null) {
+            searchParams.append('total', pageTotal);
+        }
 
         u.search = searchParams.toString();
         return u;
@@ -215,8 +249,12 @@ function ajaxRequest(params) {
         method: 'GET',
     })
     .then(response => response.json())
-    .then(transactions => {
-        params.success(transactions)
+    .then(page => {
+        if (page.next) {
+            pageCursors[params.data.offset + params.data.limit] = page.next;
+        }
+        pageTotal = page.total;
+        params.success({total: page.total, rows: page.rows})
     })
     // Catch any errors and log them to the console
     .catch(error => {
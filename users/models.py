@@ -15,6 +15,9 @@ class CustomUser(AbstractUser):
             ('can_update_all_users', 'Can update all users'),
             ('can_delete_all_users', 'Can delete all users'),
         ]
+        indexes = [
+            models.Index(fields=['last_name', 'first_name'], name='user_name_idx'),
+        ]
 
     @property
     def full_name(self):
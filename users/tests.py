@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
@@ -104,6 +104,16 @@ class EmployeesTests(TestCase):
         self.assertContains(response, 'employee@email.com')
         self.assertTemplateUsed(response, 'users/employee_list.html')
 
+
+    @override_settings(LIST_PAGE_SIZE=1)
+    def test_employee_list_view_is_paginated(self):
+        self.client.login(email='user@email.com', password='testPass123')
+        self.user.user_permissions.add(self.special_permission)
+        response = self.client.get(reverse('employee_list'))
+        self.assertTrue(response.context['is_paginated'])
+        self.assertEqual(len(response.context['employee_list']), 1)
+        self.assertEqual(response.context['paginator'].count, 2)
+
     def test_employee_detail_view_for_logged_out_user(self):
         url = reverse('employee_detail', args=[f'{self.employee.id}'])
         # log-out user
@@ -9,16 +9,18 @@ from allauth.account.views import SignupView
 from allauth.exceptions import ImmediateHttpResponse
 from allauth.account import signals
 
+from pages.pagination import PaginatedListMixin
+
 from .forms import UserCreationForm, UserChangeForm
 
 
 
-class EmployeeListView(LoginRequiredMixin, PermissionRequiredMixin, ListView):
+class EmployeeListView(LoginRequiredMixin, PermissionRequiredMixin, PaginatedListMixin, ListView):
     permission_required = ('users.can_view_all_users')
     model = get_user_model()
     context_object_name = 'employee_list'
     template_name = 'users/employee_list.html'
-    ordering = ['last_name']
+    ordering = ['last_name', 'first_name', 'id']
 
 
 class EmployeeDetailView(LoginRequiredMixin, PermissionRequiredMixin, DetailView):